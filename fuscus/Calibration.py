@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Multi-point calibration of temperature sensors."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# A sensor can have its own section in calibrate.ini, named by its ID:
+#
+#   [28-031590ed07ff]
+#   points = -0.25:0.0, 20.1:20.0, 65.6:65.0
+#   scale = 1.0
+#   offset = 0.0
+#
+# Each point is reading:actual, what the sensor read and what a
+# reference thermometer read at the same time.  Between points the
+# correction is interpolated, and beyond the first and last points it
+# stays as it is at those points.  The corrected reading is then
+# multiplied by scale and offset is added.  All of these are optional.
+#
+# The curve is compiled into a table with one segment per step of the
+# DS18B20 at 12 bits, over its whole range, so correcting a reading is
+# an index into the table and one multiply-add.  Readings and points
+# from the sensor fall on the table's nodes, where it is exact.
+
+# Range of the table, the range of the DS18B20, in degrees C
+TABLE_MIN = -55.0
+TABLE_MAX = 125.0
+
+# Steps per degree: the 12 bit resolution of the DS18B20
+TABLE_SCALE = 16
+
+
+def parsePoints(text):
+    """Return the list of (reading, actual) pairs in text, sorted by
+    reading.  Raises ValueError if text can't be parsed."""
+    points = []
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        reading, sep, actual = item.partition(':')
+        if not sep:
+            raise ValueError("Calibration point '%s' should be reading:actual." % item)
+        points.append((float(reading), float(actual)))
+    points.sort()
+    for (a, _), (b, _) in zip(points, points[1:]):
+        if a == b:
+            raise ValueError("Two calibration points for a reading of %s." % a)
+    return points
+
+
+class CalibrationCurve:
+    """Corrects the readings of one sensor with a precomputed table."""
+
+    __slots__ = ('points', 'scale', 'offset', 'intercepts', 'slopes', 'last')
+
+    def __init__(self, points=(), scale=1.0, offset=0.0):
+        """points is a list of (reading, actual) pairs.  scale and offset
+        are applied after the points."""
+        self.points = sorted(points)
+        self.scale = float(scale)
+        self.offset = float(offset)
+        self.compile()
+
+    def exact(self, temperature):
+        """Return the corrected temperature, worked out from the points
+        rather than the table."""
+        points = self.points
+        if not points:
+            corrected = temperature
+        elif temperature <= points[0][0]:
+            corrected = temperature + points[0][1] - points[0][0]
+        elif temperature >= points[-1][0]:
+            corrected = temperature + points[-1][1] - points[-1][0]
+        else:
+            for (x0, y0), (x1, y1) in zip(points, points[1:]):
+                if temperature <= x1:
+                    corrected = y0 + (y1 - y0) * (temperature - x0) / (x1 - x0)
+                    break
+        return corrected * self.scale + self.offset
+
+    def compile(self):
+        """Build the table from the points, scale and offset."""
+        steps = int((TABLE_MAX - TABLE_MIN) * TABLE_SCALE)
+        self.intercepts = [0.0] * steps
+        self.slopes = [0.0] * steps
+        self.last = steps - 1
+
+        x0 = TABLE_MIN
+        y0 = self.exact(x0)
+        for i in range(steps):
+            x1 = TABLE_MIN + (i + 1) / TABLE_SCALE
+            y1 = self.exact(x1)
+            slope = (y1 - y0) * TABLE_SCALE
+            self.slopes[i] = slope
+            self.intercepts[i] = y0 - slope * x0
+            x0, y0 = x1, y1
+
+    def correct(self, temperature):
+        """Return the corrected temperature."""
+        i = int((temperature - TABLE_MIN) * TABLE_SCALE)
+        if i < 0:
+            i = 0
+        elif i > self.last:
+            i = self.last
+        return self.intercepts[i] + self.slopes[i] * temperature
+
+    def __repr__(self):
+        return "CalibrationCurve(%r, scale=%r, offset=%r)" % (self.points, self.scale, self.offset)
+
+
+def fromConfig(calibration, deviceID):
+    """Return the CalibrationCurve for deviceID from calibration (a
+    ConfigParser of calibrate.ini), or None if it only has an offset
+    there.  An offset in the [offset] section is included in the curve
+    unless the sensor's own section has one."""
+    if not deviceID or deviceID not in calibration:
+        return None
+    section = calibration[deviceID]
+
+    offset = 0.0
+    if 'offset' in calibration:
+        offset = calibration['offset'].getfloat(deviceID, 0.0)
+    try:
+        return CalibrationCurve(points=parsePoints(section.get('points', '')),
+                                scale=section.getfloat('scale', 1.0),
+                                offset=section.getfloat('offset', offset))
+    except ValueError as e:
+        raise ValueError("Calibration of '%s' in 'calibrate.ini': %s" % (deviceID, e))
@@ -0,0 +1,648 @@
+#!/usr/bin/env python3
+"""Record what tempController sees, and replay it through a fresh
+controller as fast as it will go."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# A Recorder sits between tempController and everything it reads.  While
+# the controller updates, it logs every reading of the clock, every batch
+# of samples taken from a sensor, every read of the door switch and any
+# sensors plugged in or unplugged, and after the update the state, the
+# fridge setting and the outputs the controller chose.  Commands from
+# piLink and the menu are logged with the controller's settings after
+# them, if they changed any.  Each event is a tag byte and a struct, so
+# an hour at one update a second is about half a megabyte.  The file is
+# only appended to, and each run starts with a header holding what is
+# needed to build a controller in the same state.  e.g.
+#
+#   ./fuscus.py --record fuscus.rec
+#   ./ControlRecorder.py fuscus.rec
+#
+# The replay builds a tempController whose clock, sensors, door and
+# relays are fed from the recording, runs every update, sets the
+# settings at each command, and checks the controller's decisions after
+# every update against the recording.  The same inputs must give the
+# same decisions, so any difference is a change in behaviour, and the
+# time taken is a benchmark of the control code alone.
+#
+# Commands are replayed as the settings they left rather than run again,
+# as piLink and the menu need the pty and the display.
+
+import argparse
+import contextlib
+import os
+import pickle
+import struct
+import sys
+import threading
+import time
+
+import FridgeSimulator
+import tempControl
+import tempSensor
+import ticks
+
+VERSION = 1
+
+# Event tags
+HEADER = b'H'
+CLOCK = b'C'
+SAMPLES = b'S'
+DOOR = b'D'
+DEVICES = b'W'
+COMMAND = b'P'
+OUTPUTS = b'O'
+
+EVENT_NAMES = {HEADER: 'header', CLOCK: 'clock', SAMPLES: 'samples', DOOR: 'door',
+               DEVICES: 'devices', COMMAND: 'command', OUTPUTS: 'outputs'}
+
+CLOCK_FORMAT = struct.Struct('<d')
+DOOR_FORMAT = struct.Struct('<?')
+# Sensor, number of samples, its temperature before and after taking them
+SAMPLES_FORMAT = struct.Struct('<BHdd')
+# Time and temperature of a sample
+SAMPLE_FORMAT = struct.Struct('<dd')
+# State, outputs and fridge setting
+OUTPUTS_FORMAT = struct.Struct('<BBd')
+# Length of a pickled event
+LENGTH_FORMAT = struct.Struct('<I')
+
+# Bits of the outputs
+COOLER = 1
+HEATER = 2
+
+# Sensors in the order they are numbered in events
+ROLES = ('fridge', 'beer', 'ambient')
+SENSORS = ('fridgeSensor', 'beerSensor', 'ambientSensor')
+
+# Attributes of tempController restored from a recording
+PLAIN_TYPES = (type(None), bool, int, float, str)
+
+
+def packValue(value):
+    """Temperatures are stored as doubles, with NaN for None."""
+    return float('nan') if value is None else value
+
+
+def unpackValue(value):
+    return None if value != value else value
+
+
+def outputs(tempControl):
+    """Return the decisions of tempControl that a replay must match."""
+    bits = ((COOLER if tempControl.cooler.state else 0) |
+            (HEATER if tempControl.heater.state else 0))
+    return tempControl.state, bits, tempControl.cs.fridgeSetting
+
+
+def sensorOptions(sensor):
+    """Return the keyword arguments to make another sensor like sensor.
+    Its resolution and calibration are left out, as the readings in a
+    recording are already calibrated."""
+    options = {'filterEngine': sensor.fastFilter.engine, 'slopeSource': 'filter'}
+    if sensor.regressionSlope is not None:
+        options['slopeSource'] = 'regression'
+        options['slopeWindow'] = sensor.regressionSlope.window
+    if sensor.medianFilter is not None:
+        options['medianWindow'] = sensor.medianFilter.window
+        options['spikeLimit'] = sensor.medianFilter.spikeLimit
+    return options
+
+
+def sensorState(sensor):
+    """Return the filters of sensor and their settings."""
+    return {'filters': sensor.getFilterState(),
+            'filterBValues': dict(sensor.filterBValues),
+            'periodShift': sensor.periodShift,
+            'samplePeriod': sensor.samplePeriod,
+            'peaks': (sensor.posPeak, sensor.negPeak),
+            }
+
+
+def restoreSensor(sensor, state):
+    """Put the filters of sensor back as sensorState() found them,
+    whether or not they had been initialised."""
+    sensor.filterBValues = dict(state['filterBValues'])
+    sensor.periodShift = state['periodShift']
+    sensor.samplePeriod = state['samplePeriod']
+    sensor.posPeak, sensor.negPeak = state['peaks']
+    filters = state['filters']
+    for name, filt in (('fast', sensor.fastFilter),
+                       ('slow', sensor.slowFilter),
+                       ('slope', sensor.slopeFilter)):
+        b = sensor.filterBValues[name]
+        if b is not None:
+            filt.setCoefficients(b - sensor.periodShift)
+        filt.setState(filters[name + 'Filter'])
+    if sensor.regressionSlope is not None and filters['regressionSlope'] is not None:
+        sensor.regressionSlope.setState(filters['regressionSlope'])
+    if sensor.medianFilter is not None and filters['medianFilter'] is not None:
+        sensor.medianFilter.setState(filters['medianFilter'])
+    sensor.prevOutputForSlope = filters['prevOutputForSlope']
+    sensor.failedReadCount = filters['failedReadCount']
+    sensor.updateCounter = filters['updateCounter']
+
+
+def controllerState(tempControl):
+    """Return everything a command can change in tempControl: its
+    settings, constants and variables, its state, and the filters."""
+    return {'controller': {name: value for name, value in vars(tempControl).items()
+                           if isinstance(value, PLAIN_TYPES)},
+            'cs': dict(vars(tempControl.cs)),
+            'cc': dict(vars(tempControl.cc)),
+            'cv': dict(vars(tempControl.cv)),
+            'sensors': [sensorState(getattr(tempControl, name)) for name in SENSORS],
+            }
+
+
+def restoreController(tempControl, state):
+    """Put tempControl back as controllerState() found it."""
+    for name, value in state['controller'].items():
+        if isinstance(getattr(tempControl, name, None), PLAIN_TYPES):
+            setattr(tempControl, name, value)
+    vars(tempControl.cs).update(state['cs'])
+    vars(tempControl.cc).update(state['cc'])
+    vars(tempControl.cv).update(state['cv'])
+    for name, sensor in zip(SENSORS, state['sensors']):
+        restoreSensor(getattr(tempControl, name), sensor)
+
+
+class RecordedDoor:
+    """Stands in for the door, and records each read of it."""
+
+    def __init__(self, recorder, door):
+        self.recorder = recorder
+        self.door = door
+
+    @property
+    def isOpen(self):
+        isOpen = self.door.isOpen
+        if self.recorder.recording:
+            self.recorder.file.write(DOOR + DOOR_FORMAT.pack(bool(isOpen)))
+        return isOpen
+
+
+class Recorder:
+    """Records what a tempController sees to a file."""
+
+    def __init__(self, path, tempControl):
+        """Start appending a run of tempControl to the file at path.
+        Updates are recorded when they are made through update(), and
+        commands through the handlers returned by command()."""
+        self.path = path
+        self.tempControl = tempControl
+        self.file = open(path, 'ab')
+        self.recording = False  # True during an update
+        self.samples = []  # Samples taken by the sensor being updated
+
+        # The sensors' bus threads read the clock too, to stamp their
+        # samples.  Those times are recorded with the samples, so only
+        # this thread's reads are recorded as clock events.
+        self.thread = threading.current_thread()
+        self.clock = ticks.getClock()
+        ticks.setClock(self.readClock)
+
+        self.door = tempControl.door
+        tempControl.door = RecordedDoor(self, self.door)
+
+        for index, name in enumerate(SENSORS):
+            self.recordSensor(index, getattr(tempControl, name))
+
+        if tempControl.deviceWatcher is not None:
+            self.recordDevices(tempControl.deviceWatcher)
+
+        self.writeObject(HEADER, self.header())
+        self.file.flush()
+
+    def header(self):
+        tc = self.tempControl
+        sensors = [getattr(tc, name) for name in SENSORS]
+        return {'version': VERSION,
+                'time': time.time(),
+                'clock': self.clock(),
+                'deviceIDs': [sensor.deviceID for sensor in sensors],
+                'sensorOptions': {role: sensorOptions(sensor)
+                                  for role, sensor in zip(ROLES, sensors)},
+                'minSamplePeriods': [sensor.minSamplePeriod() for sensor in sensors],
+                'temperatures': [sensor.temperature for sensor in sensors],
+                'lastSampleTimes': [sensor.lastSampleTime for sensor in sensors],
+                'beerEstimator': tc.beerEstimator,
+                'deviceWatcher': tc.deviceWatcher is not None,
+                'samplingPolicy': tc.samplingPolicy,
+                'outputs': outputs(tc),
+                'state': controllerState(tc),
+                }
+
+    def readClock(self):
+        now = self.clock()
+        if self.recording and threading.current_thread() is self.thread:
+            self.file.write(CLOCK + CLOCK_FORMAT.pack(now))
+        return now
+
+    def recordSensor(self, index, sensor):
+        """Record the samples each update takes from sensor, and its
+        temperature, which init() uses, before and after.  The bus
+        thread can change the temperature between the record and the
+        controller reading it, but only in the few microseconds
+        between them."""
+        newReadings = sensor.newReadings
+        takeSamples = sensor.takeSamples
+
+        def recordedNewReadings():
+            if not self.recording:
+                return newReadings()
+            before = sensor.temperature
+            self.samples = []
+            readings = newReadings()
+            samples = self.samples
+            self.file.write(b''.join(
+                [SAMPLES, SAMPLES_FORMAT.pack(index, len(samples), packValue(before),
+                                              packValue(sensor.temperature))] +
+                [SAMPLE_FORMAT.pack(t, packValue(temp)) for t, temp in samples]))
+            return readings
+
+        def recordedTakeSamples():
+            self.samples = takeSamples()
+            return self.samples
+
+        sensor.newReadings = recordedNewReadings
+        sensor.takeSamples = recordedTakeSamples
+
+    def recordDevices(self, watcher):
+        """Record the polls of the device watcher which found changes."""
+        poll = watcher.poll
+
+        def recordedPoll():
+            added, removed = poll()
+            if self.recording and (added or removed):
+                self.writeObject(DEVICES, (added, removed))
+            return added, removed
+
+        watcher.poll = recordedPoll
+
+    def writeObject(self, tag, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.file.write(tag + LENGTH_FORMAT.pack(len(data)) + data)
+
+    def update(self):
+        """Update the controller, as tempController.update(), recording
+        what it reads and what it decides."""
+        tc = self.tempControl
+        self.recording = True
+        try:
+            tc.update()
+        finally:
+            self.recording = False
+        state, bits, fridgeSetting = outputs(tc)
+        self.file.write(OUTPUTS + OUTPUTS_FORMAT.pack(state, bits, packValue(fridgeSetting)))
+        self.file.flush()
+
+    def command(self, source, handler):
+        """Return handler, wrapped to record source, its arguments and
+        what it returns, and the controller's settings after it if it
+        changed them."""
+
+        def recordedCommand(*args):
+            before = controllerState(self.tempControl)
+            result = handler(*args)
+            after = controllerState(self.tempControl)
+            self.writeObject(COMMAND, (source, args, result, after if after != before else None))
+            self.file.flush()
+            return result
+
+        return recordedCommand
+
+    def close(self):
+        """Stop recording, and give the controller back its clock, door
+        and sensors."""
+        tc = self.tempControl
+        ticks.setClock(self.clock)
+        tc.door = self.door
+        for name in SENSORS:
+            sensor = getattr(tc, name)
+            del sensor.newReadings
+            del sensor.takeSamples
+        if tc.deviceWatcher is not None:
+            del tc.deviceWatcher.poll
+        self.file.close()
+
+
+def readRecording(path):
+    """Return the runs in the recording at path, as a list of (header,
+    events), where each event is (tag, value).  A run cut off part way
+    through an update ends at the last complete one."""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    runs = []
+    events = None
+    pos = 0
+    try:
+        while pos < len(data):
+            start = pos
+            tag = data[pos:pos + 1]
+            pos += 1
+            if tag == CLOCK:
+                value = CLOCK_FORMAT.unpack_from(data, pos)[0]
+                pos += CLOCK_FORMAT.size
+            elif tag == SAMPLES:
+                index, count, before, after = SAMPLES_FORMAT.unpack_from(data, pos)
+                pos += SAMPLES_FORMAT.size
+                end = pos + count * SAMPLE_FORMAT.size
+                if end > len(data):
+                    break
+                samples = [(t, unpackValue(temp))
+                           for t, temp in SAMPLE_FORMAT.iter_unpack(data[pos:end])]
+                pos = end
+                value = (index, unpackValue(before), samples, unpackValue(after))
+            elif tag == DOOR:
+                value = DOOR_FORMAT.unpack_from(data, pos)[0]
+                pos += DOOR_FORMAT.size
+            elif tag == OUTPUTS:
+                state, bits, fridgeSetting = OUTPUTS_FORMAT.unpack_from(data, pos)
+                pos += OUTPUTS_FORMAT.size
+                value = (state, bits, unpackValue(fridgeSetting))
+            elif tag in (HEADER, DEVICES, COMMAND):
+                length = LENGTH_FORMAT.unpack_from(data, pos)[0]
+                pos += LENGTH_FORMAT.size
+                if pos + length > len(data):
+                    break
+                value = pickle.loads(data[pos:pos + length])
+                pos += length
+            else:
+                raise ValueError("Unknown event %r at byte %s of '%s'." % (tag, start, path))
+
+            if tag == HEADER:
+                if value.get('version') != VERSION:
+                    raise ValueError("'%s' is version %s of the format, not %s." %
+                                     (path, value.get('version'), VERSION))
+                events = []
+                runs.append((value, events))
+            elif events is None:
+                raise ValueError("'%s' does not start with a header." % path)
+            else:
+                events.append((tag, value))
+    except struct.error:
+        pass  # Cut off in the middle of an event
+
+    for header, events in runs:
+        while events and events[-1][0] not in (OUTPUTS, COMMAND):
+            events.pop()
+    return runs
+
+
+class ReplayTempSensor(tempSensor.sensor):
+    """A tempSensor.sensor which takes its readings from a Replayer."""
+
+    replayer = None
+    index = None
+    minimumPeriod = None
+
+    def start(self):
+        pass
+
+    def minSamplePeriod(self):
+        if self.minimumPeriod is None:
+            return super().minSamplePeriod()
+        return self.minimumPeriod
+
+    def newReadings(self):
+        if self.replayer is None:
+            return []
+        before, self.replaySamples, self.replayTemperature = self.replayer.nextSamples(self.index)
+        self.temperature = before
+        return super().newReadings()
+
+    def takeSamples(self):
+        self.temperature = self.replayTemperature
+        return self.replaySamples
+
+
+class ReplayDoor:
+    """A door switch read from a Replayer."""
+
+    def __init__(self, replayer):
+        self.replayer = replayer
+
+    @property
+    def isOpen(self):
+        return self.replayer.readDoor()
+
+
+class ReplayDeviceWatcher:
+    """A DeviceWatcher read from a Replayer."""
+
+    def __init__(self, replayer):
+        self.replayer = replayer
+
+    def poll(self):
+        return self.replayer.readDevices()
+
+
+class Replayer:
+    """Runs one recorded run through a fresh tempController."""
+
+    def __init__(self, header, events):
+        self.header = header
+        self.events = events
+        self.position = 0
+        self.updates = 0
+        self.replaying = False  # True during an update
+        self.now = header['clock']
+        self.doorOpen = False
+
+        ticks.setClock(self.readClock)
+
+        bits = header['outputs'][1]
+        self.cooler = FridgeSimulator.SimulatedRelay()
+        self.cooler.state = bool(bits & COOLER)
+        self.heater = FridgeSimulator.SimulatedRelay()
+        self.heater.state = bool(bits & HEATER)
+
+        deviceWatcher = ReplayDeviceWatcher(self) if header['deviceWatcher'] else None
+
+        # The beer estimator is given after the controller is made, so
+        # it can't be changed by the state in SENSORS.state.
+        tc = tempControl.tempController(*header['deviceIDs'],
+                                        cooler=self.cooler, heater=self.heater,
+                                        door=ReplayDoor(self),
+                                        sensorOptions=header['sensorOptions'],
+                                        deviceWatcher=deviceWatcher,
+                                        samplingPolicy=header['samplingPolicy'],
+                                        sensorClass=ReplayTempSensor)
+        tc.eepromManager = FridgeSimulator.SimulatedEeprom()
+        tc.piLink = FridgeSimulator.SimulatedPiLink()
+        tc.beerEstimator = header['beerEstimator']
+        for index, name in enumerate(SENSORS):
+            sensor = getattr(tc, name)
+            sensor.replayer = self
+            sensor.index = index
+            sensor.minimumPeriod = header['minSamplePeriods'][index]
+            sensor.temperature = header['temperatures'][index]
+            sensor.lastSampleTime = header['lastSampleTimes'][index]
+        restoreController(tc, header['state'])
+        self.tempControl = tc
+
+    def close(self):
+        ticks.setClock(None)
+
+    def next(self, tag):
+        """Return the value of the next event, which must be a tag
+        event."""
+        if self.position >= len(self.events):
+            raise ValueError("The controller read the %s after the end of the recording." %
+                             EVENT_NAMES[tag])
+        eventTag, value = self.events[self.position]
+        if eventTag != tag:
+            raise ValueError("Replay out of step in update %s: the controller read the %s, "
+                             "but the recording has the %s." %
+                             (self.updates + 1, EVENT_NAMES[tag], EVENT_NAMES[eventTag]))
+        self.position += 1
+        return value
+
+    def readClock(self):
+        if self.replaying:
+            self.now = self.next(CLOCK)
+        return self.now
+
+    def readDoor(self):
+        if self.replaying:
+            self.doorOpen = self.next(DOOR)
+        return self.doorOpen
+
+    def readDevices(self):
+        """Only polls which found changes are recorded."""
+        if (self.replaying and self.position < len(self.events) and
+                self.events[self.position][0] == DEVICES):
+            return self.next(DEVICES)
+        return set(), set()
+
+    def nextSamples(self, index):
+        """Return (temperature before, samples, temperature after) for
+        the sensor numbered index."""
+        if not self.replaying:
+            return None, [], None
+        sensorIndex, before, samples, after = self.next(SAMPLES)
+        if sensorIndex != index:
+            raise ValueError("Replay out of step in update %s: the controller read the %s "
+                             "sensor, but the recording has the %s sensor." %
+                             (self.updates + 1, ROLES[index], ROLES[sensorIndex]))
+        return before, samples, after
+
+    def run(self, verbose=False):
+        """Replay every update and command.  Returns a dict of the
+        results."""
+        tc = self.tempControl
+        events = self.events
+        commands = transitions = mismatches = 0
+        firstMismatch = None
+
+        start = time.perf_counter()
+        while self.position < len(events):
+            tag, value = events[self.position]
+            if tag == COMMAND:
+                self.position += 1
+                commands += 1
+                source, args, result, state = value
+                if state is not None:
+                    restoreController(tc, state)
+                if verbose:
+                    print("Command from %s%s: %r%s" % (source, args or '', result,
+                                                        '' if state is None else ', changed settings'),
+                          file=sys.stderr)
+                continue
+
+            oldState = tc.state
+            self.replaying = True
+            try:
+                tc.update()
+            finally:
+                self.replaying = False
+            expected = self.next(OUTPUTS)
+            actual = outputs(tc)
+            self.updates += 1
+            if tc.state != oldState:
+                transitions += 1
+            if actual != expected:
+                mismatches += 1
+                if firstMismatch is None:
+                    firstMismatch = self.updates
+                if verbose:
+                    print("Update %s: recorded state %s, outputs %s, fridge setting %s; "
+                          "replayed state %s, outputs %s, fridge setting %s" %
+                          ((self.updates,) + expected + actual), file=sys.stderr)
+        elapsed = time.perf_counter() - start
+
+        return {'updates': self.updates,
+                'commands': commands,
+                'transitions': transitions,
+                'mismatches': mismatches,
+                'firstMismatch': firstMismatch,
+                'seconds': self.now - self.header['clock'],
+                'elapsed': elapsed,
+                }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('recording',
+                        help='file written by fuscus.py --record or FridgeSimulator.py --record')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the commands and any differences, and what the controller prints')
+    args = parser.parse_args()
+
+    try:
+        runs = readRecording(args.recording)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
+    failed = False
+    for number, (header, events) in enumerate(runs, 1):
+        print("Run %s, recorded %s:" % (number, time.strftime('%Y-%m-%d %H:%M:%S',
+                                                               time.localtime(header['time']))))
+        if args.verbose:
+            controllerOutput = contextlib.nullcontext()
+        else:
+            controllerOutput = contextlib.redirect_stdout(open(os.devnull, 'w'))
+        replayer = None
+        try:
+            with controllerOutput:
+                replayer = Replayer(header, events)
+                result = replayer.run(verbose=args.verbose)
+        except ValueError as e:
+            print("  %s" % e)
+            failed = True
+            continue
+        finally:
+            if replayer is not None:
+                replayer.close()
+
+        print("  %s updates, %s commands, %s state changes, %.0f s recorded" % (
+            result['updates'], result['commands'], result['transitions'], result['seconds']))
+        print("  Replayed in %.3f s: %.1f us per update, %.0f times real time" % (
+            result['elapsed'], result['elapsed'] / max(1, result['updates']) * 1e6,
+            result['seconds'] / result['elapsed'] if result['elapsed'] else 0))
+        if result['mismatches']:
+            print("  %s updates differ from the recording, the first is update %s." % (
+                result['mismatches'], result['firstMismatch']))
+            failed = True
+        else:
+            print("  Every update matches the recording.")
+
+    sys.exit(1 if failed else 0)
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-"""Threaded class to read DS18B20 temperature sensors."""
+"""Class to read DS18B20 temperature sensors."""
 
 #
 # Copyright 2015 Andrew Errington
@@ -19,109 +19,269 @@
 #
 
 
+import logging
 import threading
 import time
+from collections import deque
 
-# How many times to try reading a stuck sensor before giving up.
+import OneWireBus
+import W1Slave
+import ticks
+
+# How many conversions in a row to try reading a stuck sensor before
+# giving up.
 RETRY_LIMIT = 10
 
+# Conversion time in seconds for each resolution in bits.  Each bit
+# halves the step (0.5, 0.25, 0.125 and 0.0625 C) and doubles the time.
+CONVERSION_TIMES = {9: 0.094, 10: 0.188, 11: 0.375, 12: 0.75}
+
+# Resolution of a sensor that has not been set up
+DEFAULT_RESOLUTION = 12
+
+# Readings kept for takeSamples().  If nobody takes them, the oldest are
+# dropped.
+SAMPLE_QUEUE_LENGTH = 16
+
 
-class DS18B20(threading.Thread):
-    """Threaded class to read DS18B20 sensor.
+class DS18B20:
+    """Class to read DS18B20 sensor.
 
-    You can read .temperature as often as you like, but it's only updated
-    every samplePeriod seconds (and the driver takes about 800ms to return
-    a value).
+    After start(), you can read .temperature as often as you like, but
+    it's only updated every samplePeriod seconds (and the driver takes
+    about 800ms to return a value).  The sensors on a bus are all read by
+    one OneWireBus thread, which converts them at the same time.
     Return value is a float, temperature in degrees C,
     or None if the sensor can not be read.
 
     A special deviceID of None is allowed.  This deviceID will always
     return a temperature of None.
+
+    The ready event is set when the first temperature is available, so
+    callers can wait for it instead of sleeping.
+
+    Every reading is also queued with the ticks.seconds() time it was
+    taken, and takeSamples() returns each of them once.  That is the
+    controller's clock, so the times follow a simulated clock too.
     """
 
-    def __init__(self, deviceID, samplePeriod=1, calibrationOffset=0.0):
+    def __init__(self, deviceID, samplePeriod=1, calibrationOffset=0.0,
+                 resolution=None, calibration=None):
         """deviceID is the 1-wire address.  samplePeriod is in seconds.  
         calibrationOffset is a float which will be added to the sensor
-        reading to correct it if necessary."""
-        threading.Thread.__init__(self)
+        reading to correct it if necessary.  If calibration (a
+        Calibration.CalibrationCurve) is given, it corrects the reading
+        instead.  resolution is 9 to 12 bits, and is written to the
+        sensor by start().  None leaves the sensor as it is."""
+        if resolution is not None and resolution not in CONVERSION_TIMES:
+            raise ValueError("Resolution must be 9 to 12 bits, not %s." % resolution)
 
         self.deviceID = deviceID
 
         self.samplePeriod = samplePeriod
 
+        self.resolution = resolution or DEFAULT_RESOLUTION
+        self.requestedResolution = resolution
+        self.conversionTime = CONVERSION_TIMES[self.resolution]
+
         self.calibrationOffset = float(calibrationOffset)
+        self.calibration = calibration
 
         # Initialise temperature to None, meaning no reading is available
         self.temperature = None
-
-        self.running = False
-
-    def run(self):
-
-        self.running = True
-
-        while (self.running):
-            # update temperature every time around this loop
-
-            retries = 0  # Sometimes the sensor gets 'stuck'
-
-            temperature = None  # Default temperature until we get a new one
-
-            # If deviceID is None, don't bother reading it.
-            while self.deviceID is not None:
-                # Attempt to read the sensor, and deal with common errors.
-
-                filename = "/sys/bus/w1/devices/%s/w1_slave" % self.deviceID
-
-                try:
-                    tfile = open(filename)
-                    text = tfile.read()
-                    tfile.close
-                except:
-                    print("Could not open '%s'" % filename)
-                    break
-
-                if text.split("\n")[0][-3:] == "YES":
-                    # New data is available.  Extract it from the string.
-                    new_temperature = float(text.split("\n")[1].split(" ")[9][2:]) / 1000
-                else:
-                    # Reading the sensor did not return "YES".
-                    # Let's try again a few times.
-                    print("Sensor '%s' did not return 'YES'" % self.deviceID)
-                    print("Sensor returned '%s'" % text)
-                    if retries < RETRY_LIMIT:
-                        retries += 1
-                        print("Re-reading '%s'.  Attempt %s of %s." % (self.deviceID, retries, RETRY_LIMIT))
-                        continue
-                    else:
-                        print("Sensor '%s' did not return 'YES' after %s retries.  Giving up." % (
-                        self.deviceID, RETRY_LIMIT))
-                        break
-
-                if new_temperature == 85.0:
-                    # A common error condition.  If your application
-                    # encounters this temperature genuinely in your
-                    # environment consider removing this test.
-                    if retries < RETRY_LIMIT:
-                        retries += 1
-                        print("Discarding 85.0 reading.  Re-reading '%s'.  Attempt %s of %s." % (
-                        self.deviceID, retries, RETRY_LIMIT))
-                        continue
-                    else:
-                        print("Sensor '%s' stuck on 85.0 after %s retries.  Giving up." % (self.deviceID, RETRY_LIMIT))
-                        break
-                else:
-                    # new temperature is acceptable
-                    temperature = new_temperature + self.calibrationOffset
-
-                break
-
-            self.temperature = temperature
-
-            time.sleep(self.samplePeriod)
+        self.ready = threading.Event()
+        # (time, temperature) of readings not yet taken.  The bus thread
+        # appends and the reader pops, which deque does safely.
+        self.samples = deque(maxlen=SAMPLE_QUEUE_LENGTH)
+
+        # The OneWireBus reading this sensor, while started
+        self.bus = None
+
+        # w1_slave of this sensor, opened by the first read()
+        self.slave = None
+
+        # False while the device is unplugged, so the bus does not try
+        # to read it.  Set by deviceRemoved() and deviceAdded().
+        self.present = True
+
+        # time.monotonic() time the bus should next read the sensor
+        self.nextSample = 0
+
+        # Bad readings in a row, and whether the bus should read the
+        # sensor again after the next conversion.  See read().
+        self.retries = 0
+        self.retry = False
+
+    def read(self):
+        """Read the sensor and return the temperature, or None.  This is
+        called by the OneWireBus thread, once per conversion.
+
+        A bad reading (no 'YES', or the 85.0 power on value) is not
+        retried here, as that would hold up every sensor on the bus.
+        Instead it sets retry, so the bus reads the sensor again after
+        its next conversion, up to RETRY_LIMIT times in a row."""
+        self.retry = False
+
+        # If deviceID is None, don't bother reading it.
+        if self.deviceID is None:
+            return None
+
+        if self.slave is None:
+            self.slave = W1Slave.W1Slave("%s/%s/w1_slave" % (OneWireBus.W1_DEVICES, self.deviceID))
+
+        # Attempt to read the sensor, and deal with common errors.
+        try:
+            crcOK, milliCelsius = self.slave.read()
+        except OSError:
+            print("Could not open '%s'" % self.slave.path)
+            return None
+
+        if not crcOK or milliCelsius is None:
+            # Reading the sensor did not return "YES".
+            print("Sensor '%s' did not return 'YES'" % self.deviceID)
+            print("Sensor returned '%s'" % self.slave.text())
+            return self.readFailed("did not return 'YES'")
+
+        new_temperature = milliCelsius / 1000
+        if new_temperature == 85.0:
+            # A common error condition.  If your application
+            # encounters this temperature genuinely in your
+            # environment consider removing this test.
+            print("Discarding 85.0 reading from '%s'." % self.deviceID)
+            return self.readFailed("stuck on 85.0")
+
+        # new temperature is acceptable
+        self.retries = 0
+        if self.calibration is not None:
+            return self.calibration.correct(new_temperature)
+        return new_temperature + self.calibrationOffset
+
+    def readFailed(self, reason):
+        """Count a bad reading, and ask for a retry at the next conversion
+        if there are any left.  Returns None."""
+        if self.retries < RETRY_LIMIT:
+            self.retries += 1
+            self.retry = True
+            print("Re-reading '%s' after the next conversion.  Attempt %s of %s." % (
+                self.deviceID, self.retries, RETRY_LIMIT))
+        elif self.retries == RETRY_LIMIT:
+            # Count it once more, so this is only said once.
+            self.retries += 1
+            print("Sensor '%s' %s after %s retries.  Giving up." % (self.deviceID, reason, RETRY_LIMIT))
+        return None
+
+    def setResolution(self, resolution):
+        """Write the resolution to the sensor and read it back.  Returns
+        the resolution the sensor reports, which is also used to set
+        conversionTime, or None if it can't be read."""
+        filename = "%s/%s/resolution" % (OneWireBus.W1_DEVICES, self.deviceID)
+        try:
+            with open(filename, 'w') as f:
+                f.write('%d\n' % resolution)
+        except OSError as e:
+            print("Could not set resolution of '%s': %s" % (self.deviceID, e))
+        try:
+            with open(filename) as f:
+                actual = int(f.read())
+        except (OSError, ValueError) as e:
+            print("Could not read resolution of '%s': %s" % (self.deviceID, e))
+            return None
+
+        if actual != resolution:
+            logging.warning("Sensor %s is at %s bits, not %s", self.deviceID, actual, resolution)
+            print("Sensor '%s' is at %s bits, not %s." % (self.deviceID, actual, resolution))
+        if actual in CONVERSION_TIMES:
+            self.resolution = actual
+            self.conversionTime = CONVERSION_TIMES[actual]
+            # There is no point sampling faster than the sensor converts.
+            self.samplePeriod = max(self.samplePeriod, self.conversionTime)
+        return actual
+
+    def minSamplePeriod(self):
+        """Return the shortest possible sample period.  The sensors on a
+        bus convert together, so this is the conversion time of the
+        slowest one."""
+        if self.bus is not None:
+            return max(self.bus.conversionTime(), self.conversionTime)
+        return self.conversionTime
+
+    def setSamplePeriod(self, samplePeriod):
+        """Change how often the sensor is read, from the next sample.  The
+        period is not allowed to be shorter than minSamplePeriod().
+        Returns the new period."""
+        self.samplePeriod = max(samplePeriod, self.minSamplePeriod())
+        if self.bus is not None:
+            # Bring the next sample forward if it is now due sooner.
+            self.nextSample = min(self.nextSample, time.monotonic() + self.samplePeriod)
+            self.bus.wake()
+        return self.samplePeriod
+
+    def readScratchpad(self):
+        """Return the raw scratchpad bytes from the last read, for
+        diagnostics, or None."""
+        if self.slave is None:
+            return None
+        return self.slave.scratchpad()
+
+    def setTemperature(self, temperature):
+        """Store a new reading.  This is called by the OneWireBus thread."""
+        self.temperature = temperature
+        self.samples.append((ticks.seconds(), temperature))
+        if temperature is not None:
+            self.ready.set()
+
+    def takeSamples(self):
+        """Return the readings since the last call, oldest first, as a
+        list of (ticks.seconds() time, temperature or None)."""
+        samples = []
+        try:
+            while True:
+                samples.append(self.samples.popleft())
+        except IndexError:
+            pass
+        return samples
+
+    def waitReady(self, timeout=None):
+        """Wait until the first temperature is available.  Returns False
+        if it was not available within timeout seconds."""
+        return self.ready.wait(timeout)
+
+    def deviceRemoved(self):
+        """The device has gone from the bus."""
+        self.present = False
+
+    def deviceAdded(self):
+        """The device is back.  Open it afresh, set its resolution again
+        (it may have lost it with its power) and read it as soon as
+        possible."""
+        if self.slave is not None:
+            self.slave.close()
+        if self.requestedResolution is not None:
+            self.setResolution(self.requestedResolution)
+        self.present = True
+        self.nextSample = 0
+        if self.bus is not None:
+            self.bus.wake()
+
+    def start(self):
+        """Start reading the sensor in the background."""
+        if self.deviceID is not None:
+            if self.requestedResolution is not None:
+                self.setResolution(self.requestedResolution)
+            self.bus = OneWireBus.attach(self)
 
     def stop(self):
-        self.running = False
+        """Stop reading the sensor."""
+        if self.bus is not None:
+            OneWireBus.detach(self, self.bus)
+
+    def join(self, timeout=None):
+        """Wait for the bus thread to finish, if this sensor's stop() has
+        stopped it (other sensors may still be using it)."""
+        if self.bus is not None and not self.bus.running:
+            self.bus.join(timeout)
+            if not self.bus.is_alive() and self.slave is not None:
+                self.slave.close()
 
 
 if __name__ == "__main__":
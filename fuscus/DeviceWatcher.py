@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Notice 1-wire sensors being plugged in and unplugged."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import time
+
+import OneWireBus
+
+# Family code of the DS18B20 at the start of its device ID
+DS18B20_FAMILY = '28-'
+
+# inotify flags, from <sys/inotify.h>
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+# Seconds between scans of the device directory when there is no
+# inotify.  With inotify, the directory is still scanned this much less
+# often in case a change was missed.
+SCAN_INTERVAL = 1
+INOTIFY_SCAN_FACTOR = 30
+
+# sysfs creates and removes its entries without fsnotify events, so
+# inotify is not used for directories under here, such as the real
+# /sys/bus/w1/devices.  It is for other trees, such as W1Simulator's.
+SYSFS = '/sys'
+
+
+def isSysfs(path):
+    """Return True if path is in sysfs."""
+    path = os.path.realpath(path)
+    return path == SYSFS or path.startswith(SYSFS + os.sep)
+
+
+def _inotify(path):
+    """Return a non-blocking inotify descriptor watching path for entries
+    being added or removed, or None if inotify is not available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class DeviceWatcher:
+    """Keeps an index of the DS18B20 sensors in the w1 device directory.
+
+    Call poll() once per tick.  It only scans the directory when inotify
+    says something changed, or every SCAN_INTERVAL seconds if inotify
+    can't be used, so reading the sensors never causes a scan.  sysfs
+    does not report changes to inotify, so it is always scanned every
+    SCAN_INTERVAL seconds.
+    """
+
+    def __init__(self, path=None):
+        """path is the w1 device directory, OneWireBus.W1_DEVICES if
+        None."""
+        self.path = path or OneWireBus.W1_DEVICES
+        self.devices = set()
+
+        if isSysfs(self.path):
+            self.fd = None
+        else:
+            self.fd = _inotify(self.path)
+        if self.fd is None:
+            logging.info("No inotify for %s.  Scanning every %s s.", self.path, SCAN_INTERVAL)
+            self.scanInterval = SCAN_INTERVAL
+        else:
+            self.scanInterval = SCAN_INTERVAL * INOTIFY_SCAN_FACTOR
+
+        self.devices = self.scan()
+        self.lastScan = time.monotonic()
+
+    def scan(self):
+        """Return the set of DS18B20 device IDs in the directory."""
+        try:
+            with os.scandir(self.path) as entries:
+                return {entry.name for entry in entries
+                        if entry.name.startswith(DS18B20_FAMILY)}
+        except OSError:
+            return set()
+
+    def changed(self):
+        """Return True if inotify has seen the directory change."""
+        if self.fd is None:
+            return False
+        seen = False
+        try:
+            # Drain all events.  Any event means a rescan, so they are
+            # not decoded.
+            while os.read(self.fd, 4096):
+                seen = True
+        except BlockingIOError:
+            pass
+        return seen
+
+    def poll(self):
+        """Return (added, removed), the sets of device IDs that have
+        appeared and gone since the last poll."""
+        now = time.monotonic()
+        if not self.changed() and now - self.lastScan < self.scanInterval:
+            return set(), set()
+
+        self.lastScan = now
+        devices = self.scan()
+        added = devices - self.devices
+        removed = self.devices - devices
+        self.devices = devices
+        return added, removed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
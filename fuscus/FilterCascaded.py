@@ -22,8 +22,6 @@
 #
 
 
-from decimal import Decimal
-
 import FilterFixed
 
 
@@ -37,29 +35,85 @@ import FilterFixed
 class CascadedFilter:
     """CascadedFilter implements a filter consisting of multiple second order sections."""
 
-    def __init__(self, NUM_SECTIONS=3):
+    __slots__ = ('NUM_SECTIONS', 'engine', 'sections')
+
+    def __init__(self, NUM_SECTIONS=3, engine='decimal'):
+        """engine selects the section implementation from
+        FilterFixed.ENGINES, 'decimal' or 'integer'."""
+        if engine not in FilterFixed.ENGINES:
+            raise ValueError("Unknown filter engine '%s'." % engine)
+
         self.NUM_SECTIONS = NUM_SECTIONS
-        self.sections = []
-        for i in range(self.NUM_SECTIONS):
-            self.sections.append(FilterFixed.FixedFilter(b=2))
+        self.engine = engine
+        # The sections never change, so keep them in a tuple.
+        self.sections = tuple(FilterFixed.ENGINES[engine](b=2)
+                              for i in range(self.NUM_SECTIONS))
 
     def setCoefficients(self, bValue):
         for section in self.sections:
             section.setCoefficients(bValue)
 
+    def changeCoefficients(self, bValue):
+        """Change coefficients of a running filter without a step in the
+        output.  See FilterFixed.rescaleState().  Sections which already
+        have bValue are left alone, as rescaling rounds their history."""
+        for section in self.sections:
+            if section.b == bValue:
+                continue
+            state = section.getState()
+            section.setCoefficients(bValue)
+            section.setState(FilterFixed.rescaleState(state, bValue))
+
     def init(self, val):
+        val = self.sections[0].toInternal(val)
         for section in self.sections:
             section.init(val)
 
     def add(self, val):
         # adds a value and returns the most recent filter output
         # val is input for next section, which is the output of the previous section
-        # Internally we use Decimal, but other callers expect float.
-        val = Decimal(val)
+        # Internally we use Decimal or scaled integers, but other callers
+        # expect float.
+        first = self.sections[0]
+        val = first.toInternal(val)
         for section in self.sections:
             val = section.add(val)
 
-        return float(val)
+        return first.toExternal(val)
+
+    def add_many(self, samples):
+        """Add every value in samples (any iterable of numbers, such as a
+        list or a NumPy array) in one call.
+
+        Returns (outputs, state), where outputs is a list of floats, one
+        for each sample, and state is the final filter state as returned
+        by getState().  The outputs and state are exactly the same as
+        calling add() for each sample in turn.
+
+        Each section filters the whole block before the next section
+        starts, which keeps the inner loop to a handful of local
+        variables."""
+        first = self.sections[0]
+        toInternal = first.toInternal
+        values = [toInternal(val) for val in samples]
+        for section in self.sections:
+            values = section.add_many(values)
+
+        toExternal = first.toExternal
+        return [toExternal(val) for val in values], self.getState()
+
+    def getState(self):
+        """Return the history of every section, in the filter's internal
+        representation, as a tuple of (x0, x1, x2, y0, y1, y2) tuples."""
+        return tuple(section.getState() for section in self.sections)
+
+    def setState(self, state):
+        """Restore the history of every section saved by getState()."""
+        if len(state) != self.NUM_SECTIONS:
+            raise ValueError("Filter state has %s sections, expected %s." %
+                             (len(state), self.NUM_SECTIONS))
+        for section, sectionState in zip(self.sections, state):
+            section.setState(sectionState)
 
     def readInput(self):
         """Returns the most recent filter input."""
@@ -69,6 +123,10 @@ class CascadedFilter:
         """Return output of last section."""
         return self.sections[-1].readOutput()
 
+    def readOutputDoublePrecision(self):
+        """Return output of last section at full internal precision."""
+        return self.sections[-1].readOutputDoublePrecision()
+
     def readPrevOutput(self):
         """Return previous output of last section."""
         return self.sections[-1].readPrevOutput()
@@ -80,3 +138,24 @@ class CascadedFilter:
     def detectNegPeak(self):
         """Detect peaks in last section."""
         return self.sections[-1].detectNegPeak()
+
+
+if __name__ == "__main__":
+
+    # Simple test code: changing b to the value it already has must not
+    # touch the history, and changing it back and forth must keep the
+    # output close to where it was.
+    for engine in FilterFixed.ENGINES:
+        cascade = CascadedFilter(engine=engine)
+        cascade.setCoefficients(2)
+        cascade.init(20.0)
+        for temp in (20.5, 21.0, 20.75, 20.25):
+            cascade.add(temp)
+        state = cascade.getState()
+        cascade.changeCoefficients(2)
+        assert cascade.getState() == state, "%s: unchanged b moved the state" % engine
+        output = cascade.readOutput()
+        cascade.changeCoefficients(4)
+        cascade.changeCoefficients(2)
+        assert abs(cascade.readOutput() - output) < 0.01, "%s: output stepped" % engine
+        print("%s: OK" % engine)
@@ -24,6 +24,30 @@
 
 from decimal import Decimal
 
+# Fixed point formats used by the integer engine, as in the Arduino
+# firmware.  A 'regular' temperature has 9 fraction bits (1/512 C), and
+# a 'precise' temperature carries 16 extra fraction bits for use inside
+# the filters.
+TEMP_FIXED_POINT_BITS = 9
+TEMP_FIXED_POINT_SCALE = 1 << TEMP_FIXED_POINT_BITS
+TEMP_PRECISE_EXTRA_FRACTION_BITS = 16
+TEMP_PRECISE_SCALE = TEMP_FIXED_POINT_SCALE << TEMP_PRECISE_EXTRA_FRACTION_BITS
+
+
+def tempToRegular(val):
+    """Convert a float temperature to the regular fixed point format."""
+    return int(round(val * TEMP_FIXED_POINT_SCALE))
+
+
+def tempRegularToPrecise(val):
+    """Convert a regular fixed point temperature to precise format."""
+    return val << TEMP_PRECISE_EXTRA_FRACTION_BITS
+
+
+def tempPreciseToRegular(val):
+    """Convert a precise fixed point temperature to regular format."""
+    return val >> TEMP_PRECISE_EXTRA_FRACTION_BITS
+
 
 class FixedFilter:
     """
@@ -60,6 +84,9 @@ Use this MATLAB script to visualize the filter:
     set(h,'FrequencyScale','Log')
     set(h,'FrequencyVector', logspace(-4,0,1000));
 
+Or run filterDesign.py, which prints the delay, bandwidth and step
+response for every b value and number of sections.
+
 Here are the specifications for a single stage filter, for values a=2b+4
 The delay time is the time it takes to rise to 0.5 in a step response.
 When cascaded filters are used, multiply the delay time by the number
@@ -79,62 +106,291 @@ of cascades.
     # Some functions may return NaN if the filter has no data in it,
     # or None if no result is ready yet.
 
+    # The three most recent inputs and outputs are held in fixed fields
+    # (x0 is the newest input, y0 the newest output) so that add() does
+    # not need to build or resize any lists.
+    __slots__ = ('x0', 'x1', 'x2', 'y0', 'y1', 'y2', 'a', 'b',
+                 '_divA', '_divA1', '_divA2', '_divB')
 
     def __init__(self, b=2):
-        self.xv = [Decimal('NaN')] * 3
-        self.yv = [Decimal('NaN')] * 3
-
-        self.a = Decimal('NaN')
-        self.b = Decimal('NaN')
+        self.x0 = self.x1 = self.x2 = Decimal('NaN')
+        self.y0 = self.y1 = self.y2 = Decimal('NaN')
 
         self.setCoefficients(b)  # Was 20
 
     def setCoefficients(self, b):
         self.a = b * 2 + 4
         self.b = b
+        # Divisors are exact powers of two, so dividing by them gives
+        # the same result as computing 2 ** n each time.
+        self._divA = Decimal(2 ** self.a)
+        self._divA1 = Decimal(2 ** (self.a - 1))
+        self._divA2 = Decimal(2 ** (self.a - 2))
+        self._divB = Decimal(2 ** self.b)
+
+    @property
+    def xv(self):
+        """Most recent inputs, newest first."""
+        return [self.x0, self.x1, self.x2]
+
+    @property
+    def yv(self):
+        """Most recent outputs, newest first."""
+        return [self.y0, self.y1, self.y2]
 
     def init(self, val):
-        self.xv[0] = self.xv[1] = self.xv[2] = Decimal(val)
-        self.yv[0] = self.yv[1] = self.yv[2] = Decimal(val)
+        self.x0 = self.x1 = self.x2 = Decimal(val)
+        self.y0 = self.y1 = self.y2 = Decimal(val)
 
     def add(self, val):
         # Move all values "up" in the pipeline
-        # val -> xv[0] -> xv[1] -> xv[2] -> discard
-        # new -> yv[0] -> yv[1] -> yv[2] -> discard
+        # val -> x0 -> x1 -> x2 -> discard
+        # new -> y0 -> y1 -> y2 -> discard
+
+        isDecimal = type(val) == Decimal
+        if not isDecimal:
+            val = Decimal(val)
+
+        x2 = self.x2 = self.x1
+        x1 = self.x1 = self.x0
+        self.x0 = val
+        y2 = self.y2 = self.y1
+        y1 = self.y1 = self.y0
+
+        y0 = self.y0 = (((y1 - y2) + y1) -
+                        (y1 / self._divB) + (y2 / self._divB) +
+                        (val / self._divA) + (x1 / self._divA1) +
+                        (x2 / self._divA) - (y2 / self._divA2))
+
+        return y0 if isDecimal else float(y0)
+
+    def add_many(self, values):
+        """Add a sequence of Decimal values and return a list of the
+        outputs.  The result is the same as calling add() for each value
+        in turn."""
+        divA = self._divA
+        divA1 = self._divA1
+        divA2 = self._divA2
+        divB = self._divB
+        x0, x1, x2 = self.x0, self.x1, self.x2
+        y0, y1, y2 = self.y0, self.y1, self.y2
+        outputs = []
+        append = outputs.append
+        for val in values:
+            x2 = x1
+            x1 = x0
+            x0 = val
+            y2 = y1
+            y1 = y0
+            y0 = (((y1 - y2) + y1) -
+                  (y1 / divB) + (y2 / divB) +
+                  (x0 / divA) + (x1 / divA1) +
+                  (x2 / divA) - (y2 / divA2))
+            append(y0)
+        self.x0, self.x1, self.x2 = x0, x1, x2
+        self.y0, self.y1, self.y2 = y0, y1, y2
+        return outputs
 
-        if type(val) != Decimal:
-            self.xv.insert(0, Decimal(val))
+    def getState(self):
+        """Return the filter history as (x0, x1, x2, y0, y1, y2)."""
+        return (self.x0, self.x1, self.x2, self.y0, self.y1, self.y2)
+
+    def setState(self, state):
+        """Restore the filter history saved by getState()."""
+        self.x0, self.x1, self.x2, self.y0, self.y1, self.y2 = state
+
+    @staticmethod
+    def toInternal(val):
+        """Convert a float to the representation used by add()."""
+        return Decimal(val)
+
+    @staticmethod
+    def toExternal(val):
+        """Convert a value returned by add() to float."""
+        return float(val)
+
+    def readInput(self):
+        return float(self.x0)
+
+    def readOutput(self):
+        return float(self.y0)
+
+    def readOutputDoublePrecision(self):
+        return float(self.y0)
+
+    def readPrevOutput(self):
+        return float(self.y1)
+
+    def detectPosPeak(self):
+        if (self.y0 < self.y1 and self.y1 >= self.y2):
+            return float(self.y1)
+        else:
+            return None
+
+    def detectNegPeak(self):
+        if (self.y0 > self.y1 and self.y1 <= self.y2):
+            return float(self.y1)
         else:
-            self.xv.insert(0, val)
-        self.xv.pop()
+            return None
+
+
+class IntegerFixedFilter:
+    """Integer implementation of the FixedFilter.
+
+The filter state is held as scaled integers in the firmware's precise
+format, and the coefficients are applied with arithmetic shifts in the
+same order as FixedFilter::addDoublePrecision() in the Arduino code, so
+the output matches the firmware bit for bit.  Python integers do not
+overflow, but the results are otherwise identical.
+
+add() accepts a float, which is converted to the regular format (as the
+firmware does when it reads a sensor) and returns a float, or accepts an
+int in precise format and returns an int in precise format, which is
+what CascadedFilter uses to pass values between sections.
+"""
+
+    __slots__ = ('x0', 'x1', 'x2', 'y0', 'y1', 'y2', 'a', 'b',
+                 '_a1', '_a2')
+
+    def __init__(self, b=2):
+        self.x0 = self.x1 = self.x2 = 0
+        self.y0 = self.y1 = self.y2 = 0
+
+        self.setCoefficients(b)
+
+    def setCoefficients(self, b):
+        self.a = b * 2 + 4
+        self.b = b
+        self._a1 = self.a - 1
+        self._a2 = self.a - 2
+
+    @property
+    def xv(self):
+        """Most recent inputs, newest first."""
+        return [self.x0, self.x1, self.x2]
+
+    @property
+    def yv(self):
+        """Most recent outputs, newest first."""
+        return [self.y0, self.y1, self.y2]
 
-        self.yv.insert(0, Decimal('NaN'))
-        self.yv.pop()
+    def init(self, val):
+        if type(val) != int:
+            val = tempRegularToPrecise(tempToRegular(val))
+        self.x0 = self.x1 = self.x2 = val
+        self.y0 = self.y1 = self.y2 = val
+
+    def add(self, val):
+        if type(val) != int:
+            return self.toExternal(self.add(self.toInternal(val)))
+
+        a = self.a
+        b = self.b
+
+        x2 = self.x2 = self.x1
+        x1 = self.x1 = self.x0
+        self.x0 = val
+        y2 = self.y2 = self.y1
+        y1 = self.y1 = self.y0
+
+        # Order of operations is the same as the firmware.
+        y0 = self.y0 = (((y1 - y2) + y1) -
+                        (y1 >> b) + (y2 >> b) +
+                        (val >> a) + (x1 >> self._a1) + (x2 >> a) -
+                        (y2 >> self._a2))
+
+        return y0
+
+    def add_many(self, values):
+        """Add a sequence of precise values and return a list of the
+        outputs.  The result is the same as calling add() for each value
+        in turn."""
+        a = self.a
+        a1 = self._a1
+        a2 = self._a2
+        b = self.b
+        x0, x1, x2 = self.x0, self.x1, self.x2
+        y0, y1, y2 = self.y0, self.y1, self.y2
+        outputs = []
+        append = outputs.append
+        for val in values:
+            x2 = x1
+            x1 = x0
+            x0 = val
+            y2 = y1
+            y1 = y0
+            y0 = (((y1 - y2) + y1) -
+                  (y1 >> b) + (y2 >> b) +
+                  (x0 >> a) + (x1 >> a1) + (x2 >> a) -
+                  (y2 >> a2))
+            append(y0)
+        self.x0, self.x1, self.x2 = x0, x1, x2
+        self.y0, self.y1, self.y2 = y0, y1, y2
+        return outputs
 
-        self.yv[0] = (((self.yv[1] - self.yv[2]) + self.yv[1]) -
-                      (self.yv[1] / (2 ** self.b)) + (self.yv[2] / (2 ** self.b)) +
-                      (self.xv[0] / (2 ** self.a)) + (self.xv[1] / (2 ** (self.a - 1))) +
-                      (self.xv[2] / (2 ** self.a)) - (self.yv[2] / (2 ** (self.a - 2))))
+    def getState(self):
+        """Return the filter history as (x0, x1, x2, y0, y1, y2)."""
+        return (self.x0, self.x1, self.x2, self.y0, self.y1, self.y2)
 
-        return self.yv[0] if type(val) == Decimal else float(self.yv[0])
+    def setState(self, state):
+        """Restore the filter history saved by getState()."""
+        self.x0, self.x1, self.x2, self.y0, self.y1, self.y2 = state
+
+    @staticmethod
+    def toInternal(val):
+        """Convert a float to the representation used by add()."""
+        return tempRegularToPrecise(tempToRegular(val))
+
+    @staticmethod
+    def toExternal(val):
+        """Convert a value returned by add() to float."""
+        return tempPreciseToRegular(val) / TEMP_FIXED_POINT_SCALE
 
     def readInput(self):
-        return float(self.xv[0])
+        return self.toExternal(self.x0)
 
     def readOutput(self):
-        return float(self.yv[0])
+        return self.toExternal(self.y0)
+
+    def readOutputDoublePrecision(self):
+        return self.y0 / TEMP_PRECISE_SCALE
 
     def readPrevOutput(self):
-        return float(self.yv[1])
+        return self.toExternal(self.y1)
 
     def detectPosPeak(self):
-        if (self.yv[0] < self.yv[1] and self.yv[1] >= self.yv[2]):
-            return float(self.yv[1])
+        if (self.y0 < self.y1 and self.y1 >= self.y2):
+            return self.toExternal(self.y1)
         else:
             return None
 
     def detectNegPeak(self):
-        if (self.yv[0] > self.yv[1] and self.yv[1] <= self.yv[2]):
-            return float(self.yv[1])
+        if (self.y0 > self.y1 and self.y1 <= self.y2):
+            return self.toExternal(self.y1)
         else:
             return None
+
+
+def rescaleState(state, b):
+    """Return filter section history (x0, x1, x2, y0, y1, y2) adjusted for
+    a new coefficient b.
+
+    The outputs keep their value and slope, and the inputs are replaced
+    by the ramp which the new filter would follow with exactly those
+    outputs.  For a ramp the output lags the input by the DC group delay
+    of the filter, 2^(a-b-2) - 1 = 2^(b+2) - 1 samples when a = 2b+4.  The
+    output then continues smoothly from where it was and settles with
+    the new filter's step response, instead of a transient caused by
+    history that does not match the coefficients.  Works with Decimal or
+    integer state."""
+    x0, x1, x2, y0, y1, y2 = state
+    slope = y0 - y1
+    y2 = y1 - slope
+    lag = slope * ((1 << (b + 2)) - 1)
+    return (y0 + lag, y1 + lag, y2 + lag, y0, y1, y2)
+
+
+# Filter implementations that can be selected for each sensor.
+ENGINES = {'decimal': FixedFilter,
+           'integer': IntegerFixedFilter,
+           }
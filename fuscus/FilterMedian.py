@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""Reject spikes in temperature readings with a rolling median."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This file is part of BrewPi.
+#
+# BrewPi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BrewPi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import heapq
+from collections import deque
+
+import FilterFixed
+
+
+class MedianFilter:
+    """Rolling median of the most recent window samples, used to reject
+    spikes before they reach the IIR filters.
+
+    Every sample goes into the window.  If it is further than spikeLimit
+    degrees from the median of the window, add() returns the median
+    instead and counts a rejection.  A real step in temperature is
+    passed on once it fills half the window, because the median then
+    follows it.  With spikeLimit None, add() always returns the median.
+
+    The window is kept in arrival order in a deque, to find the oldest
+    sample, and split between two heaps, to find the median: a max-heap
+    of the lower half and a min-heap of the upper half, whose smallest
+    entry is the median.  Dropping the oldest sample only marks it as
+    gone; it is popped when it reaches the top of its heap.  So each
+    sample costs O(log window) rather than the O(window) of keeping a
+    sorted list.  Entries that never reach the top would pile up, so the
+    heaps are rebuilt from the window once they hold more than twice its
+    size.  Each entry carries a sequence number, so entries with
+    the same value are still told apart.  The samples are held as
+    integers in the filters' regular fixed point format (1/512 C), so
+    they compare exactly.
+    """
+
+    __slots__ = ('window', 'spikeLimit', 'rejectedCount', '_limit',
+                 '_samples', '_low', '_high', '_lowSize', '_highSize',
+                 '_gone', '_sequence')
+
+    def __init__(self, window=5, spikeLimit=2.0):
+        """window is the number of samples, and should be odd.  spikeLimit
+        is in degrees C."""
+        if window < 1:
+            raise ValueError("Median window must be at least 1 sample.")
+
+        self.window = window
+        self.spikeLimit = spikeLimit
+        if spikeLimit is None:
+            self._limit = None
+        else:
+            self._limit = FilterFixed.tempToRegular(spikeLimit)
+        self.rejectedCount = 0
+        self._samples = deque(maxlen=window)
+        self._sequence = 0
+        self.init()
+
+    def init(self):
+        """Discard all samples.  The rejection count is kept."""
+        self._samples.clear()
+        self._low = []  # (-value, -sequence), so the largest is on top
+        self._high = []  # (value, sequence)
+        self._lowSize = 0  # entries in each heap not yet dropped
+        self._highSize = 0
+        self._gone = set()  # sequence numbers of dropped entries
+
+    def _rebuild(self):
+        """Make the heaps again from the samples in the window, leaving
+        out the dropped entries."""
+        entries = sorted(self._samples)
+        half = len(entries) // 2
+        self._low = [(-value, -sequence) for value, sequence in entries[:half]]
+        self._high = entries[half:]
+        heapq.heapify(self._low)
+        heapq.heapify(self._high)
+        self._lowSize = len(self._low)
+        self._highSize = len(self._high)
+        self._gone.clear()
+
+    def _prune(self, heap):
+        """Pop dropped entries from the top of heap."""
+        gone = self._gone
+        while heap and abs(heap[0][1]) in gone:
+            gone.remove(abs(heap[0][1]))
+            heapq.heappop(heap)
+
+    def _balance(self):
+        """Keep the upper half equal to, or one more than, the lower half,
+        so the median is on top of the upper half."""
+        while self._lowSize > self._highSize:
+            value, sequence = heapq.heappop(self._low)
+            heapq.heappush(self._high, (-value, -sequence))
+            self._lowSize -= 1
+            self._highSize += 1
+            self._prune(self._low)
+        while self._highSize > self._lowSize + 1:
+            value, sequence = heapq.heappop(self._high)
+            heapq.heappush(self._low, (-value, -sequence))
+            self._highSize -= 1
+            self._lowSize += 1
+            self._prune(self._high)
+
+    def _insert(self, entry):
+        value, sequence = entry
+        if self._low and entry <= (-self._low[0][0], -self._low[0][1]):
+            heapq.heappush(self._low, (-value, -sequence))
+            self._lowSize += 1
+        else:
+            heapq.heappush(self._high, entry)
+            self._highSize += 1
+
+    def _drop(self, entry):
+        value, sequence = entry
+        self._gone.add(sequence)
+        if self._low and entry <= (-self._low[0][0], -self._low[0][1]):
+            self._lowSize -= 1
+            self._prune(self._low)
+        else:
+            self._highSize -= 1
+            self._prune(self._high)
+
+    def add(self, val):
+        """Add a sample and return the value to pass on to the filters."""
+        y = FilterFixed.tempToRegular(val)
+        if len(self._samples) == self.window:
+            # The deque drops the oldest sample when we append below.
+            self._drop(self._samples[0])
+        entry = (y, self._sequence)
+        self._sequence += 1
+        self._samples.append(entry)
+        self._insert(entry)
+        self._balance()
+        if len(self._low) + len(self._high) > 2 * self.window:
+            self._rebuild()
+
+        median = self._high[0][0]
+        if self._limit is None:
+            return median / FilterFixed.TEMP_FIXED_POINT_SCALE
+        if abs(y - median) > self._limit:
+            self.rejectedCount += 1
+            return median / FilterFixed.TEMP_FIXED_POINT_SCALE
+        return val
+
+    def readMedian(self):
+        """Return the median of the window, or None if it is empty."""
+        if not self._samples:
+            return None
+        return self._high[0][0] / FilterFixed.TEMP_FIXED_POINT_SCALE
+
+    def getState(self):
+        """Return the samples in the window, oldest first."""
+        return tuple(y for y, sequence in self._samples)
+
+    def setState(self, state):
+        """Restore samples saved by getState()."""
+        self.init()
+        for y in state[-self.window:]:
+            entry = (y, self._sequence)
+            self._sequence += 1
+            self._samples.append(entry)
+            self._insert(entry)
+            self._balance()
+
+
+if __name__ == "__main__":
+
+    # Simple test code: the median must match a sorted copy of the
+    # window, and a long run of equal samples must not grow the heaps.
+    import random
+
+    random.seed(1)
+    for window in (1, 2, 5, 31):
+        median = MedianFilter(window=window, spikeLimit=None)
+        recent = []
+        for i in range(5000):
+            temp = random.choice((20.0, 20.5, round(random.uniform(18, 22), 1)))
+            median.add(temp)
+            recent = (recent + [FilterFixed.tempToRegular(temp)])[-window:]
+            expected = sorted(recent)[len(recent) // 2] / FilterFixed.TEMP_FIXED_POINT_SCALE
+            assert median.readMedian() == expected, "window %s: wrong median" % window
+
+        for i in range(10000):
+            median.add(20.0)
+            heapSize = len(median._low) + len(median._high)
+            assert heapSize <= 2 * window, "window %s: heaps hold %s entries" % (window, heapSize)
+        print("window %s: OK" % window)
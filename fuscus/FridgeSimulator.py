@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""Simulate a fridge with beer in it, and run tempController against it
+faster than real time."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# This is what BREWPI_SIMULATE is for.  The model has three temperatures:
+#
+#   ambient  the room, which can swing daily
+#   fridge   the air (and shelves) in the fridge, heated by the heater,
+#            cooled by the compressor, and leaking heat to and from the
+#            room and the beer
+#   beer     the beer, which only exchanges heat with the fridge air,
+#            plus the heat of fermentation
+#
+# and is stepped one second at a time.  The real tempController, with
+# its real filters, PID and state machine, is run once per simulated
+# second with simulated sensors and relays.  ticks is switched to the
+# simulated clock, so the minimum on and off times and the peak detect
+# windows run in simulated time.  e.g.
+#
+#   ./FridgeSimulator.py --days 14 --fermentation 10 --csv run.csv
+#
+# runs a two week ale profile and reports how well the beer followed it.
+# With --record, what the controller saw is written for
+# ControlRecorder.py to replay.
+
+import argparse
+import contextlib
+import math
+import os
+import random
+import sys
+import time
+
+import AppConfigDefault
+import ControlRecorder
+import W1Simulator
+import tempControl
+import tempSensor
+import ticks
+
+# Specific heat of beer, J/(L K)
+BEER_SPECIFIC_HEAT = 4100
+
+# Steps of the DS18B20 at 12 bits, per degree
+SENSOR_STEPS = 16
+
+# A two week ale: ferment at 18, diacetyl rest at 21, crash to 2.
+# (day, beer setting) points.
+DEFAULT_PROFILE = [(0, 18.0), (4, 18.0), (6, 21.0), (9, 21.0), (10, 2.0), (14, 2.0)]
+
+
+class SimulatedClock:
+    """Simulated time, in seconds, which only moves when told to."""
+
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def advance(self, seconds):
+        self.time += seconds
+
+
+class SimulatedRelay:
+    """Stands in for relay.relay, and counts its switching."""
+
+    def __init__(self):
+        self.state = False
+        self.switches = 0
+
+    def set_output(self, state):
+        state = bool(state)
+        if state and not self.state:
+            self.switches += 1
+        self.state = state
+
+    def on(self):
+        self.set_output(True)
+
+    def off(self):
+        self.set_output(False)
+
+
+class SimulatedDoor:
+    """A door which stays shut."""
+    isOpen = False
+
+
+class SimulatedEeprom:
+    """Stands in for EepromManager, so simulating doesn't write over the
+    real settings."""
+
+    def storeTempSettings(self):
+        pass
+
+
+class SimulatedPiLink:
+    """Stands in for piLink, as there is no BrewPi to tell."""
+
+    def printBeerAnnotation(self, annotation):
+        pass
+
+    def printFridgeAnnotation(self, annotation):
+        pass
+
+    def printTemperatures(self):
+        pass
+
+
+class SimulatedTempSensor(tempSensor.sensor):
+    """A tempSensor.sensor which is given its readings by simulate()
+    instead of reading a DS18B20."""
+
+    def start(self):
+        pass
+
+    def simulate(self, temperature):
+        """Give the sensor a reading, rounded as the DS18B20 would."""
+        if self.deviceID is not None:
+            self.setTemperature(math.floor(temperature * SENSOR_STEPS) / SENSOR_STEPS)
+
+
+class ThermalModel:
+    """Heat flow between the room, the fridge air and the beer."""
+
+    def __init__(self, beer=18.0, ambient=20.0, ambientSwing=0.0,
+                 beerVolume=20.0, fridgeCapacity=8000.0,
+                 beerConductance=4.0, wallConductance=2.0,
+                 coolerPower=120.0, heaterPower=80.0, fermentationPower=0.0):
+        """Temperatures are in degrees C, beerVolume in litres,
+        fridgeCapacity in J/K, conductances in W/K and powers in W.
+        ambientSwing is the daily swing of the room either side of
+        ambient, coldest at dawn.  fermentationPower is the heat from the
+        yeast at its peak, two days in."""
+        self.ambientMean = ambient
+        self.ambientSwing = ambientSwing
+        self.beerCapacity = beerVolume * BEER_SPECIFIC_HEAT
+        self.fridgeCapacity = fridgeCapacity
+        self.beerConductance = beerConductance
+        self.wallConductance = wallConductance
+        self.coolerPower = coolerPower
+        self.heaterPower = heaterPower
+        self.fermentationPower = fermentationPower
+
+        self.beer = beer
+        self.fridge = beer
+        self.ambient = self.ambientAt(0)
+
+    def ambientAt(self, t):
+        return self.ambientMean - self.ambientSwing * math.cos(2 * math.pi * (t - 6 * 3600) / 86400)
+
+    def fermentationAt(self, t):
+        """Return the heat from fermentation at t seconds, in W."""
+        days = t / 86400
+        return self.fermentationPower * (days / 2) * math.exp(1 - days / 2)
+
+    def step(self, t, dt, heating, cooling):
+        """Move the model on dt seconds from t."""
+        self.ambient = self.ambientAt(t)
+        toBeer = self.beerConductance * (self.fridge - self.beer)
+        fromRoom = self.wallConductance * (self.ambient - self.fridge)
+        power = fromRoom - toBeer
+        if heating:
+            power += self.heaterPower
+        if cooling:
+            power -= self.coolerPower
+        self.fridge += power * dt / self.fridgeCapacity
+        self.beer += (toBeer + self.fermentationAt(t)) * dt / self.beerCapacity
+
+
+class FridgeSimulator:
+    """Runs a tempController against a ThermalModel."""
+
+    def __init__(self, model, profile=None, beerSetting=None, noise=0.02, seed=1):
+        """profile is a list of (day, beer setting) points, for beer
+        profile mode.  If beerSetting is given instead, the beer is held
+        at that.  noise is the sd of the sensor noise."""
+        self.model = model
+        self.noise = noise
+        self.random = random.Random(seed)
+
+        self.clock = SimulatedClock()
+        ticks.setClock(self.clock.now)
+        AppConfigDefault.BREWPI_SIMULATE = 1
+
+        self.cooler = SimulatedRelay()
+        self.heater = SimulatedRelay()
+        self.tempControl = tempControl.tempController('sim-fridge', 'sim-beer', 'sim-ambient',
+                                                      cooler=self.cooler, heater=self.heater,
+                                                      door=SimulatedDoor(),
+                                                      sensorClass=SimulatedTempSensor)
+        self.tempControl.eepromManager = SimulatedEeprom()
+        self.tempControl.piLink = SimulatedPiLink()
+        self.tempControl.loadDefaultConstants()
+        self.tempControl.loadDefaultSettings()
+
+        if beerSetting is not None:
+            self.profile = None
+            self.tempControl.setMode(tempControl.MODES['MODE_BEER_CONSTANT'])
+            self.tempControl.setBeerTemp(beerSetting)
+        else:
+            self.profile = W1Simulator.traceFromPoints(
+                [(day * 86400, temp) for day, temp in (profile or DEFAULT_PROFILE)])
+            self.tempControl.setMode(tempControl.MODES['MODE_BEER_PROFILE'])
+            self.tempControl.setBeerTemp(self.profile(0))
+
+        self.seconds = 0
+        self.heaterSeconds = 0
+        self.coolerSeconds = 0
+
+        self.recorder = None
+        self.update = self.tempControl.update
+        self.setBeerTemp = self.tempControl.setBeerTemp
+
+    def record(self, path):
+        """Record what the controller sees from now on to the file at
+        path, for ControlRecorder.py to replay."""
+        self.recorder = ControlRecorder.Recorder(path, self.tempControl)
+        self.update = self.recorder.update
+        self.setBeerTemp = self.recorder.command('profile', self.tempControl.setBeerTemp)
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+        ticks.setClock(None)
+        AppConfigDefault.BREWPI_SIMULATE = 0
+
+    def read(self, sensor, temperature):
+        sensor.simulate(temperature + self.random.gauss(0, self.noise))
+
+    def step(self):
+        """Simulate one second, and update the controller as the main
+        loop would."""
+        t = self.clock.now()
+        tc = self.tempControl
+        self.model.step(t, 1, self.heater.state, self.cooler.state)
+        self.clock.advance(1)
+        self.seconds += 1
+        self.heaterSeconds += self.heater.state
+        self.coolerSeconds += self.cooler.state
+
+        # The profile is followed as BrewPi does, by setting the beer
+        # temperature every minute.
+        if self.profile is not None and self.seconds % 60 == 0:
+            setting = round(self.profile(t), 2)
+            if setting != tc.cs.beerSetting:
+                self.setBeerTemp(setting)
+
+        self.read(tc.fridgeSensor, self.model.fridge)
+        self.read(tc.beerSensor, self.model.beer)
+        self.read(tc.ambientSensor, self.model.ambient)
+
+        self.update()
+
+    def run(self, seconds, record=None, interval=60):
+        """Simulate seconds seconds.  record(simulator) is called every
+        interval seconds.  Returns a dict of how well the beer followed
+        its setting."""
+        squaredError = 0.0
+        worstError = 0.0
+        count = 0
+        for i in range(int(seconds)):
+            self.step()
+            setting = self.tempControl.cs.beerSetting
+            if setting is not None:
+                error = self.model.beer - setting
+                squaredError += error * error
+                worstError = max(worstError, abs(error))
+                count += 1
+            if record is not None and self.seconds % interval == 0:
+                record(self)
+
+        return {'rmsError': math.sqrt(squaredError / count) if count else None,
+                'worstError': worstError,
+                'heaterDuty': self.heaterSeconds / self.seconds,
+                'coolerDuty': self.coolerSeconds / self.seconds,
+                'heaterStarts': self.heater.switches,
+                'coolerStarts': self.cooler.switches,
+                }
+
+
+CSV_HEADER = "hours,beerSetting,beer,beerSensor,fridgeSetting,fridge,ambient,state,heater,cooler"
+
+
+def csvLine(simulator):
+    tc = simulator.tempControl
+    model = simulator.model
+    return "%.4f,%s,%.3f,%.3f,%s,%.3f,%.3f,%s,%d,%d" % (
+        simulator.seconds / 3600, tc.cs.beerSetting, model.beer,
+        tc.beerSensor.readFastFiltered(), tc.cs.fridgeSetting, model.fridge,
+        model.ambient, tc.state, simulator.heater.state, simulator.cooler.state)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=float, default=14,
+                        help='length of the simulation')
+    parser.add_argument('--profile', metavar='CSV',
+                        help="file of 'day,temperature' lines for the beer setting, "
+                             "instead of the built in ale profile")
+    parser.add_argument('--beer', type=float,
+                        help='hold the beer at this temperature instead of following a profile')
+    parser.add_argument('--start', type=float, default=18.0,
+                        help='starting temperature of the beer and fridge')
+    parser.add_argument('--ambient', type=float, default=20.0,
+                        help='room temperature')
+    parser.add_argument('--ambient-swing', type=float, default=3.0,
+                        help='daily swing of the room temperature either side of --ambient')
+    parser.add_argument('--volume', type=float, default=20.0,
+                        help='litres of beer')
+    parser.add_argument('--fermentation', type=float, default=0.0,
+                        help='peak heat of fermentation in W')
+    parser.add_argument('--noise', type=float, default=0.02,
+                        help='sd of the sensor noise')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for the sensor noise')
+    parser.add_argument('--csv', metavar='FILE',
+                        help='write the temperatures and outputs to FILE')
+    parser.add_argument('--interval', type=int, default=60,
+                        help='seconds between lines of the CSV file')
+    parser.add_argument('--record', metavar='FILE',
+                        help='record what the controller sees to FILE, for ControlRecorder.py')
+    parser.add_argument('--verbose', action='store_true',
+                        help="show what the controller prints, which is slower")
+    args = parser.parse_args()
+
+    profile = None
+    if args.profile:
+        with open(args.profile) as f:
+            profile = [tuple(float(v) for v in line.split(',')) for line in f if line.strip()]
+
+    model = ThermalModel(beer=args.start, ambient=args.ambient, ambientSwing=args.ambient_swing,
+                         beerVolume=args.volume, fermentationPower=args.fermentation)
+    simulator = FridgeSimulator(model, profile=profile, beerSetting=args.beer,
+                                noise=args.noise, seed=args.seed)
+    if args.record:
+        simulator.record(args.record)
+
+    record = None
+    out = None
+    if args.csv:
+        out = open(args.csv, 'w')
+        print(CSV_HEADER, file=out)
+        record = lambda s: print(csvLine(s), file=out)
+
+    if args.verbose:
+        controllerOutput = contextlib.nullcontext()
+    else:
+        controllerOutput = contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    start = time.perf_counter()
+    try:
+        with controllerOutput:
+            result = simulator.run(args.days * 86400, record=record, interval=args.interval)
+    except KeyboardInterrupt:
+        print("Ctrl-C detected.  Stopping.")
+        sys.exit(1)
+    finally:
+        elapsed = time.perf_counter() - start
+        simulator.close()
+        if out is not None:
+            out.close()
+
+    print("Simulated %.1f days in %.1f s (%.0f times real time)." % (
+        simulator.seconds / 86400, elapsed, simulator.seconds / elapsed))
+    print("Beer error: %.3f C rms, %.3f C worst" % (result['rmsError'], result['worstError']))
+    print("Heater: %.1f%% on, %d starts" % (result['heaterDuty'] * 100, result['heaterStarts']))
+    print("Cooler: %.1f%% on, %d starts" % (result['coolerDuty'] * 100, result['coolerStarts']))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Estimate beer temperature and slope from beer, fridge and relays."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This file is part of BrewPi.
+#
+# BrewPi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BrewPi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# The thermal model, per second:
+#
+#   beer   += (fridge - beer) / beerTimeConstant + drift
+#   fridge += (beer - fridge) / fridgeTimeConstant + heaterRate * heating
+#                                                  - coolerRate * cooling
+#   drift  unchanged
+#
+# drift is the part of the beer slope the model does not explain, such
+# as heat from fermentation.  The fridge is measured well, so errors in
+# its model are taken up by FRIDGE_PROCESS_NOISE, and the rates only
+# need to be roughly right.
+
+# Default model parameters, in seconds and degrees C per second
+BEER_TIME_CONSTANT = 4 * 3600
+FRIDGE_TIME_CONSTANT = 900
+HEATER_RATE = 0.01
+COOLER_RATE = 0.005
+
+# Default standard deviation of the readings, degrees C
+BEER_NOISE = 0.1
+FRIDGE_NOISE = 0.1
+
+# Standard deviation of the change in each state per second which the
+# model does not explain
+BEER_PROCESS_NOISE = 2e-4
+FRIDGE_PROCESS_NOISE = 0.02
+DRIFT_PROCESS_NOISE = 1e-7
+
+# Uncertainty of the temperatures before the first reading, and of the
+# drift (1 degree C per hour), as variances
+INITIAL_VARIANCE = 100.0
+INITIAL_DRIFT_VARIANCE = (1 / 3600) ** 2
+
+# Indices of the states
+BEER, FRIDGE, DRIFT = range(3)
+
+
+class BeerEstimator:
+    """Kalman filter fusing the beer and fridge readings and the relay
+    state, to estimate the beer temperature and slope.
+
+    The filter smooths the beer reading as much as the slow filter, but
+    follows changes sooner because the model predicts them from the
+    fridge temperature and the relays.
+
+    There are three states, so the matrices are small lists allocated
+    once, and update() works on them in place.  The covariance is
+    symmetric and only its six distinct entries are calculated.  Each
+    reading is applied on its own, so there is no matrix to invert and a
+    missing reading just skips its step.
+    """
+
+    __slots__ = ('samplePeriod', '_f', '_q', '_r', '_heat', '_cool',
+                 'x', 'P', '_k', 'ready')
+
+    def __init__(self, samplePeriod=1,
+                 beerTimeConstant=BEER_TIME_CONSTANT,
+                 fridgeTimeConstant=FRIDGE_TIME_CONSTANT,
+                 heaterRate=HEATER_RATE, coolerRate=COOLER_RATE,
+                 beerNoise=BEER_NOISE, fridgeNoise=FRIDGE_NOISE):
+        """samplePeriod is the time between update() calls in seconds.
+        The time constants are in seconds, the rates in degrees C per
+        second and the noise is the standard deviation of each reading in
+        degrees C."""
+        dt = samplePeriod
+        self.samplePeriod = samplePeriod
+        a = dt / beerTimeConstant
+        c = dt / fridgeTimeConstant
+        # State transition, row by row
+        self._f = [1 - a, a, dt,
+                   c, 1 - c, 0.0,
+                   0.0, 0.0, 1.0]
+        # Process noise variance per step, diagonal
+        self._q = [BEER_PROCESS_NOISE ** 2 * dt,
+                   FRIDGE_PROCESS_NOISE ** 2 * dt,
+                   DRIFT_PROCESS_NOISE ** 2 * dt]
+        # Reading noise variance, beer then fridge
+        self._r = [beerNoise ** 2, fridgeNoise ** 2]
+        self._heat = heaterRate * dt
+        self._cool = coolerRate * dt
+
+        self.x = [0.0, 0.0, 0.0]
+        self.P = [[0.0] * 3 for i in range(3)]
+        self._k = [0.0, 0.0, 0.0]  # gain, reused by each correction
+        self.init()
+
+    def init(self):
+        """Forget the estimate.  The next readings start it again."""
+        x = self.x
+        P = self.P
+        x[BEER] = x[FRIDGE] = x[DRIFT] = 0.0
+        for i in range(3):
+            for j in range(3):
+                P[i][j] = 0.0
+            P[i][i] = INITIAL_VARIANCE
+        P[DRIFT][DRIFT] = INITIAL_DRIFT_VARIANCE
+        self.ready = False
+
+    def update(self, beer, fridge, heating=False, cooling=False):
+        """Advance one sample period and apply the readings.
+
+        beer and fridge are in degrees C, or None if there is no reading.
+        heating and cooling are the relay states during the last sample
+        period."""
+        if not self.ready:
+            # Start from the first pair of readings, with no drift.
+            if beer is None or fridge is None:
+                return
+            self.x[BEER] = beer
+            self.x[FRIDGE] = fridge
+            self.ready = True
+        else:
+            self._predict(heating, cooling)
+
+        if beer is not None:
+            self._correct(BEER, beer, self._r[0])
+        if fridge is not None:
+            self._correct(FRIDGE, fridge, self._r[1])
+
+    def _predict(self, heating, cooling):
+        f00, f01, f02, f10, f11, f12, f20, f21, f22 = self._f
+        x = self.x
+        P = self.P
+
+        b, fr, d = x
+        x[BEER] = f00 * b + f01 * fr + f02 * d
+        x[FRIDGE] = f10 * b + f11 * fr
+        if heating:
+            x[FRIDGE] += self._heat
+        if cooling:
+            x[FRIDGE] -= self._cool
+
+        # P = F P F' + Q.  The last row of F is (0, 0, 1) and F[1][2] is
+        # 0, which leaves these terms.
+        p00, p01, p02 = P[0]
+        p11, p12 = P[1][1], P[1][2]
+        p22 = P[2][2]
+        # F P, first two rows
+        a00 = f00 * p00 + f01 * p01 + f02 * p02
+        a01 = f00 * p01 + f01 * p11 + f02 * p12
+        a02 = f00 * p02 + f01 * p12 + f02 * p22
+        a10 = f10 * p00 + f11 * p01
+        a11 = f10 * p01 + f11 * p11
+        a12 = f10 * p02 + f11 * p12
+        q = self._q
+        n00 = a00 * f00 + a01 * f01 + a02 * f02 + q[0]
+        n01 = a00 * f10 + a01 * f11
+        n11 = a10 * f10 + a11 * f11 + q[1]
+        P[0][0] = n00
+        P[0][1] = P[1][0] = n01
+        P[0][2] = P[2][0] = a02
+        P[1][1] = n11
+        P[1][2] = P[2][1] = a12
+        P[2][2] = p22 + q[2]
+
+    def _correct(self, i, z, r):
+        """Apply reading z of state i, with variance r."""
+        x = self.x
+        P = self.P
+        k = self._k
+        Pi = P[i]
+        s = Pi[i] + r
+        k[0] = Pi[0] / s
+        k[1] = Pi[1] / s
+        k[2] = Pi[2] / s
+        innovation = z - x[i]
+        x[0] += k[0] * innovation
+        x[1] += k[1] * innovation
+        x[2] += k[2] * innovation
+        # P = P - k Pi.  Copy row i first, as it changes in the loop.
+        p0, p1, p2 = Pi
+        for row in range(3):
+            kr = k[row]
+            Pr = P[row]
+            Pr[0] -= kr * p0
+            Pr[1] -= kr * p1
+            Pr[2] -= kr * p2
+
+    def readTemperature(self):
+        """Return the estimated beer temperature, or None before the
+        first readings."""
+        if not self.ready:
+            return None
+        return self.x[BEER]
+
+    def readFridgeTemperature(self):
+        if not self.ready:
+            return None
+        return self.x[FRIDGE]
+
+    def readSlope(self):
+        """Return the estimated beer slope in degrees per hour."""
+        if not self.ready:
+            return 0.0
+        f00, f01, f02 = self._f[0:3]
+        x = self.x
+        perSample = (f00 - 1) * x[BEER] + f01 * x[FRIDGE] + f02 * x[DRIFT]
+        return perSample * 3600 / self.samplePeriod
+
+    def getState(self):
+        """Return the estimate and its covariance, to restore after a
+        restart."""
+        if not self.ready:
+            return None
+        return (tuple(self.x), tuple(tuple(row) for row in self.P))
+
+    def setState(self, state):
+        """Restore state saved by getState()."""
+        self.init()
+        if state is None:
+            return
+        x, P = state
+        self.x[:] = x
+        for row, saved in zip(self.P, P):
+            row[:] = saved
+        self.ready = True
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Read every DS18B20 on a 1-wire bus from one thread."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import threading
+import time
+
+# Where the w1 driver puts the devices and bus masters.  Set
+# FUSCUS_W1_DEVICES to use another tree, such as one made by
+# W1Simulator.py.
+W1_DEVICES = os.environ.get('FUSCUS_W1_DEVICES', "/sys/bus/w1/devices")
+
+# Bus master to use if we can't tell which one a sensor is on
+DEFAULT_MASTER = "w1_bus_master1"
+
+# Conversion time to allow when the bus has no sensors, in seconds
+CONVERSION_TIME = 0.75
+
+# How often to check whether a bulk conversion has finished, in seconds
+POLL_INTERVAL = 0.01
+
+# Sensors due within this many seconds of a sample are read with it,
+# rather than waking the bus again just after
+SCHEDULE_SLACK = 0.1
+
+
+class OneWireBus(threading.Thread):
+    """Threaded class to read all DS18B20 sensors on one bus master.
+
+    When any sensor is due, the bus asks every sensor to convert at the
+    same time by writing 'trigger' to the master's therm_bulk_read
+    attribute, waits for the conversion to finish, then reads the
+    scratchpad of each due sensor with DS18B20.read() and stores the
+    temperature.  One sample of every sensor takes one conversion time.
+    If a reading is bad, the sensor is due again at once, so the next
+    conversion is its retry; the bus never waits on one sensor.
+
+    Each sensor is due every samplePeriod seconds, which may differ
+    between sensors and change while running.  Between samples the bus
+    sleeps until the next sensor is due.
+
+    If the driver has no therm_bulk_read (kernels before 5.10), each
+    read() starts its own conversion, as before, but from this one
+    thread.  If the trigger fails for any other reason, that sample is
+    taken the same way and the next one tries the trigger again.
+
+    Don't create these directly.  DS18B20.start() calls attach(), which
+    finds or starts the bus for the sensor.
+    """
+
+    def __init__(self, master=DEFAULT_MASTER):
+        threading.Thread.__init__(self)
+
+        self.master = master
+        self.bulkReadPath = os.path.join(W1_DEVICES, master, 'therm_bulk_read')
+
+        self.sensors = []
+        self._lock = threading.Lock()
+
+        # Set to end the wait between samples early
+        self._wake = threading.Event()
+
+        self.running = False
+
+        # time.monotonic() time the bus last started converting, for
+        # timing how long a sample takes.  Without bulk conversion, when
+        # it started reading the sensors one by one.
+        self.conversionStart = None
+
+    def addSensor(self, sensor):
+        with self._lock:
+            if sensor not in self.sensors:
+                # Read it now rather than at the next sample.
+                sensor.nextSample = time.monotonic()
+                self.sensors.append(sensor)
+                self._wake.set()
+
+    def wake(self):
+        """Start the next sample now."""
+        self._wake.set()
+
+    def removeSensor(self, sensor):
+        """Remove a sensor.  Returns the number of sensors left."""
+        with self._lock:
+            if sensor in self.sensors:
+                self.sensors.remove(sensor)
+            return len(self.sensors)
+
+    def dueSensors(self, now):
+        """Return the sensors due to be read at time now."""
+        with self._lock:
+            return [sensor for sensor in self.sensors
+                    if sensor.nextSample <= now + SCHEDULE_SLACK]
+
+    def nextDue(self):
+        """Return the time.monotonic() time the next sensor is due."""
+        with self._lock:
+            return min((sensor.nextSample for sensor in self.sensors),
+                       default=time.monotonic() + 1)
+
+    def conversionTime(self):
+        """Return the longest conversion time of the sensors on the bus,
+        which depends on their resolution."""
+        with self._lock:
+            return max((sensor.conversionTime for sensor in self.sensors),
+                       default=CONVERSION_TIME)
+
+    def startConversion(self):
+        """Start a conversion on every sensor on the bus.  Raises
+        FileNotFoundError if the driver can't do that, or another OSError
+        if this conversion could not be started."""
+        # Not open(..., 'w'), which would try to create the file if it is
+        # missing, and fail with some other error.
+        fd = os.open(self.bulkReadPath, os.O_WRONLY)
+        try:
+            os.write(fd, b'trigger\n')
+        finally:
+            os.close(fd)
+
+    def waitConversion(self):
+        """Wait until the bulk conversion has finished, or half as long
+        again as the slowest sensor should take."""
+        deadline = time.monotonic() + self.conversionTime() * 1.5
+        while time.monotonic() < deadline:
+            try:
+                with open(self.bulkReadPath) as f:
+                    # -1 while any sensor is still converting, then 1
+                    # (or 0 if there was nothing to convert)
+                    if f.read().strip() in ('0', '1'):
+                        return
+            except OSError:
+                break
+            time.sleep(POLL_INTERVAL)
+
+    def start(self):
+        # Set here rather than in run(), so a stop() straight after
+        # start() is not lost.
+        self.running = True
+        threading.Thread.start(self)
+
+    def run(self):
+        bulk = True  # Assume the driver can until it says it can't
+
+        while (self.running):
+            start = time.monotonic()
+            self._wake.clear()
+
+            if not self.dueSensors(start):
+                self._wake.wait(max(0, self.nextDue() - start))
+                continue
+
+            self.conversionStart = time.monotonic()
+            if bulk:
+                try:
+                    self.startConversion()
+                except FileNotFoundError:
+                    bulk = False
+                    logging.info("No bulk conversion on %s.  Sensors will convert one by one.",
+                                 self.master)
+                except OSError as e:
+                    # Most likely a glitch on the bus.  The sensors
+                    # convert one by one this time, and the next sample
+                    # tries the bulk conversion again.
+                    logging.warning("Bulk conversion on %s failed: %s", self.master, e)
+                else:
+                    self.waitConversion()
+
+            # Take the list after the conversion: the trigger converts
+            # every sensor on the bus, including any added meanwhile.
+            for sensor in self.dueSensors(start):
+                # Schedule from when it was due, so the period does not
+                # drift by the conversion time, unless it has fallen a
+                # whole period behind.
+                sensor.nextSample += sensor.samplePeriod
+                if sensor.nextSample <= start:
+                    sensor.nextSample = start + sensor.samplePeriod
+                if sensor.present:
+                    temperature = sensor.read()
+                    if sensor.retry:
+                        # Keep the sample back and read the sensor
+                        # again after the next conversion.
+                        sensor.nextSample = start
+                    else:
+                        sensor.setTemperature(temperature)
+                else:
+                    sensor.setTemperature(None)
+
+            self._wake.wait(max(0, self.nextDue() - time.monotonic()))
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+
+# Running buses, by master name
+_buses = {}
+_busesLock = threading.Lock()
+
+
+def masterOf(deviceID):
+    """Return the name of the bus master a device is on."""
+    path = os.path.realpath(os.path.join(W1_DEVICES, deviceID))
+    master = os.path.basename(os.path.dirname(path))
+    if master.startswith('w1_bus_master'):
+        return master
+    return DEFAULT_MASTER
+
+
+def attach(sensor):
+    """Add a sensor to the bus it is on, starting the bus if need be.
+    Returns the bus."""
+    master = masterOf(sensor.deviceID)
+    with _busesLock:
+        bus = _buses.get(master)
+        if bus is None:
+            bus = OneWireBus(master)
+            _buses[master] = bus
+            bus.addSensor(sensor)
+            bus.start()
+        else:
+            bus.addSensor(sensor)
+    return bus
+
+
+def detach(sensor, bus):
+    """Remove a sensor from its bus, and stop the bus if it was the
+    last."""
+    with _busesLock:
+        if bus.removeSensor(sensor) == 0:
+            bus.stop()
+            if _buses.get(bus.master) is bus:
+                del _buses[bus.master]
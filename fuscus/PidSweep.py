@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""Try many sets of control constants on the fridge simulator, in
+parallel, and rank them."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Each --param names a field of tempControl.ControlConstants and the
+# values to try, as a list (Kp=3,5,8) or a range (Kp=2:8:4 for four
+# values from 2 to 8).  Every combination is tried, or with --random N,
+# N combinations drawn at random from the ranges.  e.g.
+#
+#   ./PidSweep.py --param Kp=2:8:4 --param Ki=0.1,0.35,0.6 --csv sweep.csv
+#
+# Each candidate runs through the same simulated fermentation (by
+# default three days with a step up and a step down in the beer
+# setting), with the same sensor noise, in a process pool using every
+# core.  For each one we measure:
+#
+#   overshoot     worst excursion of the beer past a new setting, C
+#   settling      worst time for the beer to stay within SETTLE_BAND of
+#                 a new setting, hours
+#   cycles        heater and compressor starts
+#   shortCycles   compressor runs shorter than MIN_COOL_ON_TIME, or
+#                 restarts sooner than MIN_COOL_OFF_TIME after stopping
+#
+# Candidates with fewer short cycles come first, then the ones with the
+# lowest total of their ranks by overshoot, settling and cycles (equal
+# values share the mean of their ranks).  The best can be written as an
+# EEPROM.cc file, which tempController loads (fuscus.ini has no control
+# constants).
+
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import itertools
+import os
+import pickle
+import random
+import sys
+import time
+
+import FridgeSimulator
+import tempControl
+
+# Default test: hold 18, step up to 21 after a day, and down to 15 after
+# another.  (day, beer setting) points.
+SWEEP_PROFILE = [(0, 18.0), (1, 18.0), (1.001, 21.0), (2, 21.0), (2.001, 15.0), (3, 15.0)]
+
+# A change in setting bigger than this starts a new step
+STEP_THRESHOLD = 0.5
+
+# The beer has settled when it stays this close to the setting, in C
+SETTLE_BAND = 0.25
+
+# Constants which are filter b values, so integers
+FILTER_CONSTANTS = set(tempControl.FILTER_SETTINGS)
+
+METRICS = ['overshoot', 'settling', 'cycles', 'shortCycles', 'rmsError']
+
+
+def parseParam(text):
+    """Parse NAME=a,b,c or NAME=min:max[:count] from the command line.
+    Returns (name, values, limits).  limits is (min, max) for a range
+    and None for a list, and values is None for a range with no
+    count."""
+    name, sep, spec = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError("'%s' should be NAME=values." % text)
+    if name not in vars(tempControl.ControlConstants()) or name == 'tempFormat':
+        raise argparse.ArgumentTypeError("'%s' is not a control constant." % name)
+    convert = int if name in FILTER_CONSTANTS else float
+    try:
+        if ':' in spec:
+            parts = spec.split(':')
+            low, high = float(parts[0]), float(parts[1])
+            values = None
+            if len(parts) > 2:
+                count = int(parts[2])
+                if count < 2:
+                    values = [convert(low)]
+                else:
+                    values = sorted(set(convert(low + (high - low) * i / (count - 1))
+                                        for i in range(count)))
+            return name, values, (low, high)
+        return name, [convert(v) for v in spec.split(',')], None
+    except (ValueError, IndexError):
+        raise argparse.ArgumentTypeError("Can't read the values in '%s'." % text)
+
+
+def candidates(params, count=None, seed=1):
+    """Return a list of dicts of constants: every combination of the
+    values, or count drawn at random."""
+    names = [name for name, values, limits in params]
+    if count is None:
+        for name, values, limits in params:
+            if values is None:
+                raise ValueError("Give a count for %s, or use --random." % name)
+        return [dict(zip(names, combination))
+                for combination in itertools.product(*(values for name, values, limits in params))]
+
+    rand = random.Random(seed)
+    result = []
+    for i in range(count):
+        candidate = {}
+        for name, values, limits in params:
+            if limits is None:
+                candidate[name] = rand.choice(values)
+            elif name in FILTER_CONSTANTS:
+                candidate[name] = rand.randint(int(limits[0]), int(limits[1]))
+            else:
+                candidate[name] = round(rand.uniform(*limits), 3)
+        result.append(candidate)
+    return result
+
+
+class Metrics:
+    """Measures a simulation second by second."""
+
+    def __init__(self):
+        self.steps = []  # [start, setting, direction, overshoot, settled at]
+        self.setting = None
+        self.squaredError = 0.0
+        self.count = 0
+        self.shortCycles = 0
+        self.coolerOn = False
+        self.coolerChanged = None
+
+    def __call__(self, simulator):
+        now = simulator.seconds
+        beer = simulator.model.beer
+        setting = simulator.tempControl.cs.beerSetting
+
+        if setting is not None:
+            if self.setting is None or abs(setting - self.setting) > STEP_THRESHOLD:
+                direction = 0 if self.setting is None else (1 if setting > self.setting else -1)
+                self.steps.append([now, setting, direction, 0.0, None])
+            self.setting = setting
+
+            step = self.steps[-1]
+            step[1] = setting
+            past = (beer - setting) * step[2]
+            if past > step[3]:
+                step[3] = past
+            if abs(beer - setting) <= SETTLE_BAND:
+                if step[4] is None:
+                    step[4] = now
+            else:
+                step[4] = None
+
+            error = beer - setting
+            self.squaredError += error * error
+            self.count += 1
+
+        coolerOn = simulator.cooler.state
+        if coolerOn != self.coolerOn:
+            if self.coolerChanged is not None:
+                # Length of the run that has ended, or of the rest
+                limit = (tempControl.MIN_COOL_ON_TIME if self.coolerOn
+                         else tempControl.MIN_COOL_OFF_TIME)
+                if now - self.coolerChanged < limit:
+                    self.shortCycles += 1
+            self.coolerOn = coolerOn
+            self.coolerChanged = now
+
+    def result(self, simulator):
+        end = simulator.seconds
+        settling = 0.0
+        for start, setting, direction, overshoot, settledAt in self.steps:
+            settling = max(settling, ((settledAt or end) - start) / 3600)
+        return {'overshoot': max((step[3] for step in self.steps), default=0.0),
+                'settling': settling,
+                'cycles': simulator.heater.switches + simulator.cooler.switches,
+                'shortCycles': self.shortCycles,
+                'rmsError': (self.squaredError / self.count) ** 0.5 if self.count else None,
+                }
+
+
+def evaluate(constants, days, profile, seed, fermentation):
+    """Run one candidate through the simulator.  Returns (constants,
+    metrics, all the control constants).  This runs in a worker
+    process."""
+    model = FridgeSimulator.ThermalModel(beer=profile[0][1], ambientSwing=3.0,
+                                         fermentationPower=fermentation)
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        simulator = FridgeSimulator.FridgeSimulator(model, profile=profile, seed=seed)
+        try:
+            tc = simulator.tempControl
+            for name, value in constants.items():
+                setattr(tc.cc, name, value)
+            tc.initFilters()
+            metrics = Metrics()
+            simulator.run(days * 86400, record=metrics, interval=1)
+        finally:
+            simulator.close()
+    return constants, metrics.result(simulator), vars(tc.cc)
+
+
+def rank(results):
+    """Sort the results of evaluate() best first, and add each one's
+    'rank' to its metrics."""
+    rankSums = [0.0] * len(results)
+    for metric in ('overshoot', 'settling', 'cycles'):
+        order = sorted(range(len(results)), key=lambda i: results[i][1][metric])
+        # Results with the same value share the mean of their positions.
+        first = 0
+        while first < len(order):
+            value = results[order[first]][1][metric]
+            last = first
+            while last + 1 < len(order) and results[order[last + 1]][1][metric] == value:
+                last += 1
+            for i in order[first:last + 1]:
+                rankSums[i] += (first + last) / 2
+            first = last + 1
+    for i, result in enumerate(results):
+        result[1]['rank'] = rankSums[i]
+    return sorted(results, key=lambda r: (r[1]['shortCycles'], r[1]['rank']))
+
+
+def writeCSV(path, results, names):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names + METRICS + ['rank'])
+        for constants, metrics, allConstants in results:
+            writer.writerow([constants[name] for name in names] +
+                            [metrics[metric] for metric in METRICS + ['rank']])
+
+
+def writeEeprom(path, allConstants):
+    """Write the control constants of a candidate as an EEPROM.cc file,
+    as tempController.storeConstants() does."""
+    with open(path, 'wb') as f:
+        pickle.dump(allConstants, f, pickle.HIGHEST_PROTOCOL)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--param', action='append', type=parseParam, required=True,
+                        metavar='NAME=VALUES',
+                        help='a control constant and the values to try: a,b,c or min:max:count')
+    parser.add_argument('--random', type=int, metavar='N',
+                        help='try N random combinations instead of every one')
+    parser.add_argument('--days', type=float, default=3,
+                        help='length of each simulation')
+    parser.add_argument('--profile', metavar='CSV',
+                        help="file of 'day,temperature' lines for the beer setting")
+    parser.add_argument('--fermentation', type=float, default=0.0,
+                        help='peak heat of fermentation in W')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for the sensor noise and --random')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--csv', metavar='FILE',
+                        help='write every candidate and its results to FILE')
+    parser.add_argument('--eeprom', metavar='FILE',
+                        help='write the best candidate as an EEPROM.cc file')
+    parser.add_argument('--top', type=int, default=10,
+                        help='how many candidates to show')
+    args = parser.parse_args()
+
+    profile = SWEEP_PROFILE
+    if args.profile:
+        with open(args.profile) as f:
+            profile = [tuple(float(v) for v in line.split(',')) for line in f if line.strip()]
+
+    try:
+        todo = candidates(args.param, args.random, args.seed)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    names = [name for name, values, limits in args.param]
+
+    print("Trying %s candidates for %s days each." % (len(todo), args.days))
+    start = time.perf_counter()
+    # Keep the results in the order of todo, not the order they finish,
+    # so a sweep gives the same output every time.
+    results = [None] * len(todo)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(evaluate, constants, args.days, profile, args.seed,
+                                   args.fermentation): index
+                   for index, constants in enumerate(todo)}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            print("%s of %s done" % (done, len(todo)), end='\r')
+    print("Done in %.1f s.%s" % (time.perf_counter() - start, ' ' * 20))
+
+    results = rank(results)
+
+    print()
+    print(' '.join("%10s" % name[:10] for name in names + METRICS + ['rank']))
+    for constants, metrics, allConstants in results[:args.top]:
+        print(' '.join(["%10s" % constants[name] for name in names] +
+                       ["%10.3f" % metrics[metric] if isinstance(metrics[metric], float)
+                        else "%10s" % metrics[metric] for metric in METRICS + ['rank']]))
+
+    if args.csv:
+        writeCSV(args.csv, results, names)
+        print("Wrote '%s'." % args.csv)
+    if args.eeprom:
+        writeEeprom(args.eeprom, results[0][2])
+        print("Wrote the best constants to '%s'." % args.eeprom)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Estimate temperature slope with a sliding-window least-squares fit."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This file is part of BrewPi.
+#
+# BrewPi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BrewPi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import FilterFixed
+
+# Don't report a slope until we have this many samples
+MIN_SAMPLES = 3
+
+
+class RegressionSlope:
+    """Least-squares slope of the most recent window samples.
+
+    The samples are numbered 0 (oldest) to n-1 (newest), and the fit is
+    kept up to date with two running sums, S0 = sum(y) and
+    S1 = sum(i * y), so each add() costs the same whatever the window
+    size.  The samples are held as integers in the filters' regular fixed
+    point format (1/512 C), so the running sums are exact and do not
+    drift.
+
+    Compared with differencing the slow filter and filtering the result,
+    the fit lags by only half the window, for the same noise.
+    """
+
+    __slots__ = ('window', 'samplePeriod', '_samples', '_next', '_count',
+                 '_s0', '_s1')
+
+    def __init__(self, window=600, samplePeriod=1):
+        """window is the number of samples in the fit, and samplePeriod is
+        the time between samples in seconds."""
+        if window < MIN_SAMPLES:
+            raise ValueError("Slope window must be at least %s samples." % MIN_SAMPLES)
+
+        self.window = window
+        self.samplePeriod = samplePeriod
+        self._samples = [0] * window
+        self.init()
+
+    def init(self):
+        """Discard all samples."""
+        self._next = 0  # position in _samples for the next sample
+        self._count = 0
+        self._s0 = 0
+        self._s1 = 0
+
+    def add(self, val):
+        y = FilterFixed.tempToRegular(val)
+        n = self._count
+        if n < self.window:
+            # Window is filling.  The new sample is number n.
+            self._s1 += n * y
+            self._s0 += y
+            self._count = n + 1
+        else:
+            # Drop the oldest sample, renumber the rest down by one and
+            # add the new sample as number n-1.
+            oldest = self._samples[self._next]
+            self._s1 -= self._s0 - oldest
+            self._s1 += (n - 1) * y
+            self._s0 += y - oldest
+
+        self._samples[self._next] = y
+        self._next = (self._next + 1) % self.window
+
+    def readSlope(self):
+        """Return slope in degrees per hour, or 0.0 if there are not
+        enough samples yet."""
+        n = self._count
+        if n < MIN_SAMPLES:
+            return 0.0
+        # slope = (S1 - mean(i) * S0) / sum((i - mean(i))^2), scaled up
+        # by 12 to keep the numerator an integer.
+        numerator = 12 * self._s1 - 6 * (n - 1) * self._s0
+        denominator = n * (n * n - 1)
+        perSample = numerator / denominator / FilterFixed.TEMP_FIXED_POINT_SCALE
+        return perSample * 3600 / self.samplePeriod
+
+    def getState(self):
+        """Return the samples in the window, oldest first."""
+        n = self._count
+        start = (self._next - n) % self.window
+        return tuple(self._samples[(start + i) % self.window] for i in range(n))
+
+    def setState(self, state):
+        """Restore samples saved by getState()."""
+        if len(state) > self.window:
+            raise ValueError("Slope state has %s samples, window is %s." %
+                             (len(state), self.window))
+        self.init()
+        for y in state:
+            self.add(y / FilterFixed.TEMP_FIXED_POINT_SCALE)
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""Simulate a w1 sysfs tree of DS18B20 sensors for testing without hardware."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# The simulator builds a directory laid out like /sys/bus/w1/devices:
+#
+#   <root>/w1_bus_master1/therm_bulk_read
+#   <root>/w1_bus_master1/28-.../w1_slave
+#   <root>/w1_bus_master1/28-.../resolution
+#   <root>/28-...  ->  w1_bus_master1/28-...
+#
+# and rewrites the w1_slave files as the sensors convert.  Point the
+# sensor code at it with the FUSCUS_W1_DEVICES environment variable (or
+# w1_devices in the [sensors] section of fuscus.ini), e.g.
+#
+#   ./W1Simulator.py --root /tmp/w1 --sensors 3 --crc-failures 0.01 &
+#   FUSCUS_W1_DEVICES=/tmp/w1 ./testTempSensors.py
+
+import argparse
+import bisect
+import math
+import os
+import random
+import shutil
+import threading
+import time
+
+import DS18B20
+
+MASTER = "w1_bus_master1"
+
+# How often to check for a bulk conversion trigger, in seconds
+POLL_INTERVAL = 0.005
+
+# Scratchpad configuration byte for each resolution
+CONFIG_BYTES = {9: 0x1f, 10: 0x3f, 11: 0x5f, 12: 0x7f}
+
+# Scratchpad of a sensor that has not converted since power on (85.0 C)
+POWER_ON_RAW = 0x0550
+
+
+def crc8(data):
+    """Return the Dallas/Maxim 1-wire CRC of data."""
+    crc = 0
+    for byte in data:
+        for i in range(8):
+            mix = (crc ^ byte) & 1
+            crc >>= 1
+            if mix:
+                crc ^= 0x8c
+            byte >>= 1
+    return crc
+
+
+def slaveText(raw, resolution=12, crcError=False):
+    """Return the w1_slave text for a raw 16 bit temperature reading, as
+    the w1_therm driver prints it."""
+    raw &= 0xffff
+    scratchpad = bytearray([raw & 0xff, raw >> 8, 0x4b, 0x46,
+                            CONFIG_BYTES[resolution], 0xff, 0x0c, 0x10])
+    scratchpad.append(crc8(scratchpad))
+    if crcError:
+        # Corrupt a bit in transit, as a noisy bus would.
+        scratchpad[random.randrange(8)] ^= 1 << random.randrange(8)
+    crcOK = crc8(scratchpad[:8]) == scratchpad[8]
+
+    signed = raw - 0x10000 if raw & 0x8000 else raw
+    hexBytes = ' '.join('%02x' % b for b in scratchpad)
+    return "%s : crc=%02x %s\n%s t=%d\n" % (hexBytes, scratchpad[8], 'YES' if crcOK else 'NO',
+                                           hexBytes, int(signed * 1000 / 16))
+
+
+def traceFromPoints(points):
+    """Return a trace function which interpolates (seconds, temperature)
+    points linearly, and holds the first and last values outside them."""
+    times = [t for t, temp in points]
+    temps = [temp for t, temp in points]
+
+    def trace(t):
+        i = bisect.bisect_right(times, t)
+        if i == 0:
+            return temps[0]
+        if i == len(times):
+            return temps[-1]
+        t0, t1 = times[i - 1], times[i]
+        return temps[i - 1] + (temps[i] - temps[i - 1]) * (t - t0) / (t1 - t0)
+
+    return trace
+
+
+def modelTrace(mean=20.0, swing=2.0, period=3600.0, noise=0.05):
+    """Return a trace function for a temperature swinging slowly around
+    mean, with gaussian noise."""
+    phase = random.uniform(0, 2 * math.pi)
+
+    def trace(t):
+        return mean + swing * math.sin(2 * math.pi * t / period + phase) + random.gauss(0, noise)
+
+    return trace
+
+
+class SimulatedSensor:
+    """One simulated DS18B20 in the tree."""
+
+    def __init__(self, deviceID, trace, crcFailureRate=0.0, powerOnRate=0.0):
+        """trace is a function of time in seconds since the simulator
+        started, returning the temperature.  crcFailureRate and
+        powerOnRate are the chance of each conversion giving a CRC error
+        or the 85.0 power on value."""
+        self.deviceID = deviceID
+        self.trace = trace
+        self.crcFailureRate = crcFailureRate
+        self.powerOnRate = powerOnRate
+        # (start, end) times in seconds while the sensor is unplugged
+        self.dropouts = []
+
+        self.present = False
+        self.lastConversion = None
+        self.failed = False  # whether the last conversion was bad
+
+    def isPresent(self, t):
+        return not any(start <= t < end for start, end in self.dropouts)
+
+    def convert(self, t, resolution):
+        """Return the w1_slave text for a conversion at time t."""
+        self.failed = True
+        if random.random() < self.powerOnRate:
+            return slaveText(POWER_ON_RAW, resolution)
+        # Lower resolutions leave the low bits undefined; the sensor
+        # reads them as 0.
+        raw = int(round(self.trace(t) * 16))
+        raw &= ~((1 << (12 - resolution)) - 1)
+        crcError = random.random() < self.crcFailureRate
+        self.failed = crcError
+        return slaveText(raw, resolution, crcError)
+
+
+class W1Simulator(threading.Thread):
+    """Threaded simulator of a w1 bus master with DS18B20 sensors.
+
+    With bulk=True the master has a therm_bulk_read attribute.  When it
+    is triggered, it reads -1 for the conversion time of the slowest
+    sensor, then every w1_slave is rewritten and it reads 1.  Without
+    bulk, each sensor's w1_slave is rewritten every conversion time.
+
+    After a bulk conversion the driver returns the same result until
+    the sensor is read again, which starts a conversion of its own.  A
+    sensor whose last result was bad is therefore converted again after
+    its conversion time, so the reader's retries get a new result.
+
+    Conversion times follow each sensor's resolution file.  A sensor is
+    unplugged by removing its directory, and comes back with a new one.
+    """
+
+    def __init__(self, root, bulk=True, timeScale=1.0):
+        """root is the directory to create.  timeScale speeds up the
+        traces and dropouts relative to real time (the conversions still
+        take real time)."""
+        threading.Thread.__init__(self)
+
+        self.root = root
+        self.bulk = bulk
+        self.timeScale = timeScale
+        self.sensors = []
+        self.conversions = 0
+
+        self.masterPath = os.path.join(root, MASTER)
+        self.bulkReadPath = os.path.join(self.masterPath, 'therm_bulk_read')
+
+        self.running = False
+        self._start = None
+
+    def addSensor(self, sensor):
+        self.sensors.append(sensor)
+
+    def now(self):
+        """Return simulated seconds since the simulator started."""
+        return (time.monotonic() - self._start) * self.timeScale
+
+    def create(self):
+        """Create the tree, with every sensor present."""
+        os.makedirs(self.masterPath, exist_ok=True)
+        if self.bulk:
+            self.writeFile(self.bulkReadPath, '0\n')
+        self._start = time.monotonic()
+        for sensor in self.sensors:
+            self.plugIn(sensor)
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def writeFile(self, path, text):
+        """Rewrite a file in place, so readers holding it open see the
+        new contents."""
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            data = text.encode('ascii')
+            os.pwrite(fd, data, 0)
+            os.ftruncate(fd, len(data))
+        finally:
+            os.close(fd)
+
+    def devicePath(self, sensor):
+        return os.path.join(self.masterPath, sensor.deviceID)
+
+    def plugIn(self, sensor):
+        path = self.devicePath(sensor)
+        os.makedirs(path, exist_ok=True)
+        self.writeFile(os.path.join(path, 'resolution'), '%d\n' % DS18B20.DEFAULT_RESOLUTION)
+        self.writeFile(os.path.join(path, 'w1_slave'),
+                       slaveText(POWER_ON_RAW, DS18B20.DEFAULT_RESOLUTION))
+        link = os.path.join(self.root, sensor.deviceID)
+        if not os.path.islink(link):
+            os.symlink(os.path.join(MASTER, sensor.deviceID), link)
+        sensor.present = True
+
+    def unplug(self, sensor):
+        path = self.devicePath(sensor)
+        # Empty the file first, so a reader holding it open sees nothing.
+        try:
+            self.writeFile(os.path.join(path, 'w1_slave'), '')
+        except OSError:
+            pass
+        try:
+            os.unlink(os.path.join(self.root, sensor.deviceID))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(path, ignore_errors=True)
+        sensor.present = False
+
+    def resolution(self, sensor):
+        try:
+            with open(os.path.join(self.devicePath(sensor), 'resolution')) as f:
+                resolution = int(f.read())
+        except (OSError, ValueError):
+            return DS18B20.DEFAULT_RESOLUTION
+        if resolution not in DS18B20.CONVERSION_TIMES:
+            return DS18B20.DEFAULT_RESOLUTION
+        return resolution
+
+    def updatePresence(self):
+        t = self.now()
+        for sensor in self.sensors:
+            present = sensor.isPresent(t)
+            if present and not sensor.present:
+                self.plugIn(sensor)
+            elif not present and sensor.present:
+                self.unplug(sensor)
+
+    def convert(self, sensor):
+        """Write a new conversion for a sensor."""
+        if not sensor.present:
+            return
+        text = sensor.convert(self.now(), self.resolution(sensor))
+        try:
+            self.writeFile(os.path.join(self.devicePath(sensor), 'w1_slave'), text)
+        except OSError:
+            pass  # Unplugged meanwhile
+        sensor.lastConversion = time.monotonic()
+        self.conversions += 1
+
+    def triggered(self):
+        try:
+            with open(self.bulkReadPath) as f:
+                return f.read().strip() == 'trigger'
+        except OSError:
+            return False
+
+    def start(self):
+        self.create()
+        self.running = True
+        threading.Thread.start(self)
+
+    def run(self):
+        while self.running:
+            self.updatePresence()
+            if self.bulk:
+                if self.triggered():
+                    self.writeFile(self.bulkReadPath, '-1\n')
+                    present = [s for s in self.sensors if s.present]
+                    time.sleep(max((DS18B20.CONVERSION_TIMES[self.resolution(s)]
+                                    for s in present), default=0))
+                    for sensor in present:
+                        self.convert(sensor)
+                    self.writeFile(self.bulkReadPath, '1\n')
+                now = time.monotonic()
+                for sensor in self.sensors:
+                    if (sensor.failed and now - sensor.lastConversion >=
+                            DS18B20.CONVERSION_TIMES[self.resolution(sensor)]):
+                        self.convert(sensor)
+            else:
+                now = time.monotonic()
+                for sensor in self.sensors:
+                    conversionTime = DS18B20.CONVERSION_TIMES[self.resolution(sensor)]
+                    if (sensor.lastConversion is None
+                            or now - sensor.lastConversion >= conversionTime):
+                        self.convert(sensor)
+            time.sleep(POLL_INTERVAL)
+
+    def stop(self):
+        self.running = False
+
+
+def parseDropout(text):
+    """Parse ID:START:LENGTH (seconds) from the command line."""
+    deviceID, start, length = text.rsplit(':', 2)
+    return deviceID, float(start), float(start) + float(length)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--root', default='/tmp/w1',
+                        help='directory for the simulated tree')
+    parser.add_argument('--sensors', type=int, default=3,
+                        help='number of sensors')
+    parser.add_argument('--trace', metavar='CSV',
+                        help="file of 'seconds,temperature' lines for every sensor, "
+                             "instead of the built in model")
+    parser.add_argument('--crc-failures', type=float, default=0.0,
+                        help='chance of a CRC error on each conversion')
+    parser.add_argument('--power-on', type=float, default=0.0,
+                        help='chance of an 85.0 reading on each conversion')
+    parser.add_argument('--dropout', action='append', default=[], type=parseDropout,
+                        metavar='ID:START:LENGTH',
+                        help='unplug a sensor for LENGTH seconds after START seconds')
+    parser.add_argument('--no-bulk', action='store_true',
+                        help='no therm_bulk_read on the bus master')
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help='speed of the traces relative to real time')
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace) as f:
+            points = [tuple(float(v) for v in line.split(',')) for line in f if line.strip()]
+        trace = traceFromPoints(points)
+    else:
+        trace = None
+
+    simulator = W1Simulator(args.root, bulk=not args.no_bulk, timeScale=args.time_scale)
+    for i in range(args.sensors):
+        sensor = SimulatedSensor("28-00000000%04x" % (i + 1),
+                                 trace or modelTrace(mean=18.0 + 2 * i),
+                                 crcFailureRate=args.crc_failures,
+                                 powerOnRate=args.power_on)
+        simulator.addSensor(sensor)
+    for deviceID, start, end in args.dropout:
+        for sensor in simulator.sensors:
+            if sensor.deviceID == deviceID:
+                sensor.dropouts.append((start, end))
+
+    try:
+        simulator.start()
+        print("Simulating %s sensors in '%s'." % (len(simulator.sensors), args.root))
+        print("Run the sensor code with FUSCUS_W1_DEVICES=%s.  Ctrl-C to stop." % args.root)
+        for sensor in simulator.sensors:
+            print("  %s" % sensor.deviceID)
+        while True:
+            time.sleep(1)
+
+    except KeyboardInterrupt:
+        print()
+        print("Ctrl-C detected.  Stopping.")
+
+    finally:
+        simulator.stop()
+        simulator.join()
+        simulator.remove()
+        print("%s conversions." % simulator.conversions)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Read the w1_slave file of a DS18B20 through one open descriptor."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# The w1_therm driver returns two lines like this:
+#
+#   72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+#   72 01 4b 46 7f ff 0e 10 57 t=23125
+#
+# The nine bytes are the scratchpad, YES (or NO) says whether its CRC
+# was good, and t= is the temperature in thousandths of a degree C.
+
+import os
+
+# Large enough for both lines, with room to spare
+BUFFER_SIZE = 128
+
+# Length of the scratchpad at the start of the file, as hex text
+SCRATCHPAD_TEXT_LENGTH = 9 * 3 - 1
+
+
+class W1Slave:
+    """Keeps w1_slave open and rereads it from the start with os.pread().
+
+    Each read() fills the same buffer and finds the CRC status and the
+    temperature with a couple of searches of it, without splitting it
+    into strings.  If the file can't be read (the sensor was unplugged),
+    it is closed, and the next read() opens it again.
+    """
+
+    __slots__ = ('path', 'fd', 'buffer', 'length')
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.length = 0  # bytes of buffer filled by the last read()
+
+    def read(self):
+        """Read the sensor.  Returns (crcOK, milliCelsius), where
+        milliCelsius is None if there is no t= value.  Raises OSError if
+        the file can't be read."""
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        try:
+            n = os.preadv(self.fd, [self.buffer], 0)
+        except OSError:
+            self.close()
+            raise
+        self.length = n
+        if n == 0:
+            # The device has gone.  Open it again next time.
+            self.close()
+            return False, None
+        buf = self.buffer
+
+        end = buf.find(b'\n', 0, n)
+        if end < 0:
+            return False, None
+        crcOK = buf.endswith(b'YES', 0, end)
+
+        start = buf.find(b't=', end, n)
+        if start < 0:
+            return crcOK, None
+        try:
+            return crcOK, int(buf[start + 2:n])
+        except ValueError:
+            return crcOK, None
+
+    def scratchpad(self):
+        """Return the nine scratchpad bytes from the last read(), or None."""
+        if self.length < SCRATCHPAD_TEXT_LENGTH:
+            return None
+        try:
+            return bytes.fromhex(self.buffer[:SCRATCHPAD_TEXT_LENGTH].decode('ascii'))
+        except ValueError:
+            return None
+
+    def text(self):
+        """Return the text from the last read()."""
+        return self.buffer[:self.length].decode('ascii', 'replace')
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
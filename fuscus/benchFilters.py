@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for the temperature filters."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This file is part of BrewPi.
+#
+# BrewPi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BrewPi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Report the cost per sample of FixedFilter.add(), CascadedFilter.add()
+# and CascadedFilter.add_many() for each filter engine, the cost per tick
+# of the nine filters of a chamber's three sensors, of changing the
+# coefficients of a running filter, and of the median spike filter which
+# can run before the cascade.  No hardware is needed.
+#
+# Run it before and after changing the filters, on the same machine,
+# to compare.
+
+import argparse
+import itertools
+import random
+import timeit
+
+import FilterCascaded
+import FilterFixed
+import FilterMedian
+
+# A sensor reading with a fractional part, as returned by the DS18B20
+SAMPLE = 20.0625
+
+# Filters updated every tick: fast, slow and slope for three sensors
+CHAMBER_FILTERS = 9
+
+
+def readings(number):
+    """Return number sensor readings rising 1 C an hour at one a second,
+    with noise, in DS18B20 steps of 1/16 C.  A constant input lets the
+    decimal engine skip work, which real readings do not."""
+    rng = random.Random(1)
+    return [round((SAMPLE + i / 3600 + rng.gauss(0, 0.05)) * 16) / 16
+            for i in range(number)]
+
+
+def benchSection(engine, number):
+    """Return seconds per sample for a single filter section."""
+    section = FilterFixed.ENGINES[engine](b=2)
+    section.init(SAMPLE)
+    samples = [section.toInternal(val) for val in readings(number)]
+
+    def run():
+        for val in samples:
+            section.add(val)
+
+    return min(timeit.repeat(run, number=1, repeat=5)) / number
+
+
+def benchCascade(engine, number):
+    """Return seconds per sample for a 3-section cascaded filter."""
+    cascade = FilterCascaded.CascadedFilter(engine=engine)
+    cascade.init(SAMPLE)
+    samples = readings(number)
+
+    def run():
+        for val in samples:
+            cascade.add(val)
+
+    return min(timeit.repeat(run, number=1, repeat=5)) / number
+
+
+def benchBatch(engine, number):
+    """Return seconds per sample for CascadedFilter.add_many()."""
+    cascade = FilterCascaded.CascadedFilter(engine=engine)
+    cascade.init(SAMPLE)
+    samples = readings(number)
+    return min(timeit.repeat(lambda: cascade.add_many(samples),
+                             number=1, repeat=5)) / number
+
+
+def benchTick(engine, number):
+    """Return seconds per tick to add a reading to each of a chamber's
+    filters."""
+    filters = [FilterCascaded.CascadedFilter(engine=engine) for i in range(CHAMBER_FILTERS)]
+    for f in filters:
+        f.init(SAMPLE)
+    samples = readings(number)
+
+    def run():
+        for val in samples:
+            for f in filters:
+                f.add(val)
+
+    return min(timeit.repeat(run, number=1, repeat=5)) / number
+
+
+def benchChange(engine, number):
+    """Return seconds to change the coefficients of a cascaded filter."""
+    cascade = FilterCascaded.CascadedFilter(engine=engine)
+    cascade.init(SAMPLE)
+    # Alternate between two values so every call is a real change
+    bValues = itertools.cycle((1, 4))
+    return min(timeit.repeat(lambda: cascade.changeCoefficients(next(bValues)),
+                             number=number, repeat=5)) / number
+
+
+def benchMedian(window, number):
+    """Return seconds per sample for the median spike filter."""
+    median = FilterMedian.MedianFilter(window=window)
+    # Readings wandering by a few steps of the sensor resolution
+    samples = itertools.cycle([SAMPLE + 0.0625 * (i % 7 - 3) for i in range(window * 3)])
+    return min(timeit.repeat(lambda: median.add(next(samples)),
+                             number=number, repeat=5)) / number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', '-n', type=int, default=20000,
+                        help='samples per timing run')
+    args = parser.parse_args()
+
+    print("%-8s %12s %12s %12s" % ('engine', 'section', 'cascade', 'batch'))
+    for engine in FilterFixed.ENGINES:
+        print("%-8s %9.2f us %9.2f us %9.2f us" % (
+            engine,
+            benchSection(engine, args.number) * 1e6,
+            benchCascade(engine, args.number) * 1e6,
+            benchBatch(engine, args.number) * 1e6))
+
+    print()
+    print("%-8s %12s" % ('engine', 'tick'))
+    for engine in FilterFixed.ENGINES:
+        print("%-8s %9.2f us" % (engine, benchTick(engine, args.number // CHAMBER_FILTERS) * 1e6))
+
+    print()
+    print("%-8s %12s" % ('engine', 'change b'))
+    for engine in FilterFixed.ENGINES:
+        print("%-8s %9.2f us" % (engine, benchChange(engine, args.number) * 1e6))
+
+    print()
+    print("%-8s %12s" % ('window', 'median'))
+    for window in (3, 5, 9, 31):
+        print("%-8d %9.2f us" % (window, benchMedian(window, args.number) * 1e6))
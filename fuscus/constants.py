@@ -23,8 +23,12 @@
 import argparse
 import configparser
 
+import Calibration
+import DeviceWatcher
 import EepromManager
+import KalmanFusion
 import Menu
+import OneWireBus
 import door
 import lcd
 import piLink
@@ -41,6 +45,9 @@ parser.add_argument('--config', '-c',
                     nargs='?',
                     default='fuscus.ini',
                     help='configuration file name')
+parser.add_argument('--record',
+                    metavar='FILE',
+                    help='record what the controller sees to FILE, for ControlRecorder.py to replay')
 
 args = parser.parse_args()
 
@@ -55,7 +62,7 @@ else:
 
 calibration = configparser.ConfigParser()
 calibration.read('calibrate.ini')
-if 'offset' in calibration:
+if calibration.sections():
     print("Using calibration file 'calibrate.ini'")
 else:
     print("No 'calibration.ini' file or no calibration values present.")
@@ -152,6 +159,10 @@ print("Cold relay on pin %s (%s)" % (relay_COLD, 'inverted' if invert_cold else
 # One-wire bus (implemented by external system) (1 GPIO + 3.3V + GND)
 one_wire = 7  # This number is for reference only
 
+# Where to find the one-wire devices.  This can point at a tree made by
+# W1Simulator.py for testing.
+OneWireBus.W1_DEVICES = config['sensors'].get('w1_devices', OneWireBus.W1_DEVICES)
+
 # One-wire sensor IDs
 ID_fridge = config['sensors'].get('fridge')
 ID_beer = config['sensors'].get('beer')
@@ -177,6 +188,67 @@ if 'offset' in calibration:
     if ID_ambient:
         ambientCalibrationOffset = calibration['offset'].getfloat(ID_ambient,0.0)
 
+# Per-sensor options, passed to tempSensor.sensor
+sensorOptions = {'fridge': {}, 'beer': {}, 'ambient': {}}
+
+for role in sensorOptions:
+    filter_engine = config['sensors'].get('%s_filter_engine' % role, 'decimal')
+    if filter_engine not in ('decimal', 'integer'):
+        raise ValueError("Filter engine '%s' for %s sensor not recognised in 'fuscus.ini'." % (filter_engine, role))
+    sensorOptions[role]['filterEngine'] = filter_engine
+
+    slope = config['sensors'].get('%s_slope' % role, 'filter')
+    if slope not in ('filter', 'regression'):
+        raise ValueError("Slope source '%s' for %s sensor not recognised in 'fuscus.ini'." % (slope, role))
+    sensorOptions[role]['slopeSource'] = slope
+    sensorOptions[role]['slopeWindow'] = config['sensors'].getint('%s_slope_window' % role, 600)
+    sensorOptions[role]['medianWindow'] = config['sensors'].getint('%s_median_window' % role, 0)
+    sensorOptions[role]['spikeLimit'] = config['sensors'].getfloat('%s_spike_limit' % role, 2.0)
+
+    resolution = config['sensors'].getint('%s_resolution' % role, None)
+    if resolution is not None and not 9 <= resolution <= 12:
+        raise ValueError("Resolution %s for %s sensor must be 9 to 12 bits in 'fuscus.ini'." % (resolution, role))
+    sensorOptions[role]['resolution'] = resolution
+
+# Multi-point calibration, for sensors with their own section in
+# calibrate.ini
+for role, deviceID in (('fridge', ID_fridge), ('beer', ID_beer), ('ambient', ID_ambient)):
+    curve = Calibration.fromConfig(calibration, deviceID)
+    if curve is not None:
+        print("Calibration curve for %s sensor: %s points, scale %s, offset %+.2f" % (
+            role, len(curve.points), curve.scale, curve.offset))
+    sensorOptions[role]['calibration'] = curve
+
+# Optionally estimate the beer temperature and slope for the PID from
+# the beer and fridge sensors and the relays, instead of the beer filters
+beer_estimator = config['sensors'].get('beer_estimator', 'filter')
+if beer_estimator == 'filter' or beer_estimator == '':
+    beerEstimator = None
+elif beer_estimator == 'kalman':
+    beerEstimator = KalmanFusion.BeerEstimator(
+        beerTimeConstant=config['sensors'].getfloat('kalman_beer_time_constant', 4.0) * 3600,
+        beerNoise=config['sensors'].getfloat('kalman_beer_noise', KalmanFusion.BEER_NOISE))
+    print("Beer temperature for PID estimated by Kalman filter.")
+else:
+    raise ValueError("Beer estimator '%s' not recognised in 'fuscus.ini'." % beer_estimator)
+
+# Watch for sensors being unplugged and plugged in again
+if config['sensors'].getboolean('hotplug', True):
+    deviceWatcher = DeviceWatcher.DeviceWatcher()
+else:
+    deviceWatcher = None
+
+# Read the sensors at a fixed rate, or faster while heating and cooling
+# and slower while idle
+sampling = config['sensors'].get('sampling', 'fixed')
+if sampling == 'fixed':
+    samplingPolicy = None
+elif sampling == 'adaptive':
+    samplingPolicy = tempControl.SAMPLING_POLICY
+    print("Sensor sample rate follows the controller state.")
+else:
+    raise ValueError("Sampling '%s' not recognised in 'fuscus.ini'." % sampling)
+
 print("Fridge sensor : %-15s (%+.2f)"%(ID_fridge,fridgeCalibrationOffset))
 print("Beer sensor   : %-15s (%+.2f)"%(ID_beer,beerCalibrationOffset))
 print("Ambient sensor: %-15s (%+.2f)"%(ID_ambient,ambientCalibrationOffset))
@@ -226,7 +298,11 @@ cooler = relay.relay(relay_COLD, invert=invert_cold)
 LCD = lcd.lcd(lines=6, chars=20, hardware=LCD_hardware)
 
 tempControl = tempControl.tempController(ID_fridge, ID_beer, ID_ambient,
-                                         cooler=cooler, heater=heater, door=DOOR)
+                                         cooler=cooler, heater=heater, door=DOOR,
+                                         sensorOptions=sensorOptions,
+                                         beerEstimator=beerEstimator,
+                                         deviceWatcher=deviceWatcher,
+                                         samplingPolicy=samplingPolicy)
 
 # Set the temperature calibration offsets (if available)
 # FIXME - This should be part of deviceManager & saved to/loaded from the eeprom
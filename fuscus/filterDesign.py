@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Characteristics of the cascaded temperature filters for each b value."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This file is part of BrewPi.
+#
+# BrewPi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BrewPi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BrewPi.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# This replaces the MATLAB script in the FixedFilter docstring.  For each
+# b value it calculates the delay (samples for the step response to
+# reach 0.5), the -3dB bandwidth and the step response of 1 to N
+# cascaded sections, with a = 2b + 4 as used by FixedFilter.
+#
+# Run it to print the table:
+#   ./filterDesign.py
+#   ./filterDesign.py --sections 5 --step 4
+
+import argparse
+import cmath
+import functools
+import math
+import time
+
+# b values accepted for the filters, as in the FixedFilter docstring
+B_VALUES = range(0, 7)
+
+# Number of sections in the filters used by tempSensor
+DEFAULT_SECTIONS = 3
+
+# Stop the step response when the last section reaches this level
+STEP_SETTLED = 0.999
+
+
+def coefficients(b):
+    """Return (NUM, DEN) of one filter section, as in the docstring of
+    FixedFilter, for coefficients of z^0, z^-1 and z^-2."""
+    a = b * 2 + 4
+    num = (2 ** -a, 2 * 2 ** -a, 2 ** -a)
+    den = (1.0, -2 + 2 ** -b, 1 - 2 ** -b + 4 * 2 ** -a)
+    return num, den
+
+
+def stepResponses(b, maxSections):
+    """Return the step responses of 1 to maxSections cascaded sections.
+
+    All sections are evaluated together in one pass, the output of
+    section k being the step response of k sections.  The result is a
+    list with one list of samples per number of sections."""
+    (n0, n1, n2), (d0, d1, d2) = coefficients(b)
+    x = [[0.0, 0.0] for i in range(maxSections)]  # previous two inputs
+    y = [[0.0, 0.0] for i in range(maxSections)]  # previous two outputs
+    responses = [[] for i in range(maxSections)]
+    val = 0.0
+    while not responses[-1] or responses[-1][-1] < STEP_SETTLED:
+        val = 1.0
+        for k in range(maxSections):
+            xk = x[k]
+            yk = y[k]
+            out = (n0 * val + n1 * xk[0] + n2 * xk[1] -
+                   d1 * yk[0] - d2 * yk[1]) / d0
+            xk[1] = xk[0]
+            xk[0] = val
+            yk[1] = yk[0]
+            yk[0] = out
+            responses[k].append(out)
+            val = out
+    return responses
+
+
+def gain(b, sections, frequency):
+    """Return the gain of sections cascaded sections at frequency, in
+    cycles per sample."""
+    num, den = coefficients(b)
+    z1 = cmath.exp(-2j * math.pi * frequency)
+    z2 = z1 * z1
+    h = (num[0] + num[1] * z1 + num[2] * z2) / (den[0] + den[1] * z1 + den[2] * z2)
+    return abs(h) ** sections
+
+
+def bandwidth(b, sections):
+    """Return the -3dB frequency in cycles per sample."""
+    target = 1 / math.sqrt(2)
+    low, high = 0.0, 0.5
+    # The gain falls steadily from 1 at DC, so bisect for the target.
+    for i in range(50):
+        mid = (low + high) / 2
+        if gain(b, sections, mid) > target:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+@functools.lru_cache(maxsize=None)
+def characteristics(maxSections=DEFAULT_SECTIONS):
+    """Return a dict of the filter characteristics for every b value in
+    B_VALUES and every number of sections from 1 to maxSections.
+
+    The dict is keyed by (b, sections), and each entry is a dict with
+    'delay' (samples for the step response to reach 0.5), 'bandwidth'
+    (-3dB frequency in cycles per sample) and 'step' (the step response,
+    until it reaches STEP_SETTLED).  The table is computed once, and
+    cached."""
+    table = {}
+    for b in B_VALUES:
+        for k, response in enumerate(stepResponses(b, maxSections), 1):
+            delay = next(i for i, val in enumerate(response) if val >= 0.5)
+            table[(b, k)] = {'delay': delay,
+                             'bandwidth': bandwidth(b, k),
+                             'step': response,
+                             }
+    return table
+
+
+def isValidFilterSetting(b, sections=DEFAULT_SECTIONS):
+    """Return True if b is a filter setting in the table."""
+    return (b, sections) in characteristics()
+
+
+def filterDelay(b, sections=DEFAULT_SECTIONS):
+    """Return the delay in samples of a filter with setting b."""
+    return characteristics()[(b, sections)]['delay']
+
+
+def sectionCount(text):
+    """Parse a number of sections from the command line."""
+    try:
+        sections = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not a number." % text)
+    if sections < 1:
+        raise argparse.ArgumentTypeError("There must be at least 1 section.")
+    return sections
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sections', '-s', type=sectionCount, default=DEFAULT_SECTIONS,
+                        help='maximum number of cascaded sections')
+    parser.add_argument('--step', type=int, choices=B_VALUES, metavar='B',
+                        help='also print the step response for this b value (%d to %d)' % (
+                            min(B_VALUES), max(B_VALUES)))
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.sections == DEFAULT_SECTIONS:
+        table = characteristics()
+    else:
+        table = characteristics(args.sections)
+    elapsed = time.perf_counter() - start
+
+    print("Delay is samples for the step response to reach 0.5.")
+    print("Bandwidth is the -3dB frequency in cycles per sample.  At one sample")
+    print("per second, changes faster than the period shown are attenuated.")
+    print()
+    print("%2s %2s %3s %8s %12s %10s" % ('b', 'a', 'n', 'delay', 'bandwidth', 'period'))
+    for (b, k), entry in sorted(table.items()):
+        print("%2d %2d %3d %8d %12.6f %8.0f s" % (
+            b, 2 * b + 4, k, entry['delay'], entry['bandwidth'], 1 / entry['bandwidth']))
+
+    if args.step is not None:
+        print()
+        print("Step response, b = %d, %d sections" % (args.step, args.sections))
+        step = table[(args.step, args.sections)]['step']
+        for i in range(0, len(step), max(1, len(step) // 40)):
+            print("%6d %8.4f %s" % (i, step[i], '#' * int(step[i] * 50)))
+
+    print()
+    print("Table computed in %.3f s" % elapsed)
@@ -26,10 +26,14 @@ logging.basicConfig(filename='fuscus.log', level=logging.DEBUG)
 #
 
 
+import os
+import selectors
 import time
 import signal
 
 import AppConfigDefault  # FIXME is this needed?
+import ControlRecorder
+import ticks
 
 # import piLink
 # piLink = piLink.piLink()
@@ -43,6 +47,22 @@ from constants import *
 
 keepRunning = True
 
+# How often to save the sensor filter state, in seconds
+SENSOR_STATE_INTERVAL = 60
+
+# How long to wait at startup for the first reading from the sensors
+SENSOR_STARTUP_TIMEOUT = 2
+
+# Seconds between updates of the controller
+UPDATE_INTERVAL = 1.0
+
+# Spinner on the display, to show we haven't crashed
+SPINNER = '|/-\\'
+spinIndex = 0
+
+# ControlRecorder.Recorder, with --record
+recorder = None
+
 
 # ValueActuator alarm;
 # UI ui;
@@ -68,12 +88,16 @@ def setup():
     logging.debug("started")
     # tempControl.init()
 
+    for sensor in tempControl.waitForSensors(SENSOR_STARTUP_TIMEOUT):
+        print("No reading from sensor '%s' after %s seconds." % (sensor.deviceID, SENSOR_STARTUP_TIMEOUT))
+        logging.warning("No reading from sensor %s at startup", sensor.deviceID)
+
     # This loads the settings if saved (and the defaults, if not)
     eepromManager.applySettings()  # NOTE - This replaces settingsManager.loadSettings()
 
-    start = time.time()
+    start = ticks.seconds()
     delay = ui.showStartupPage(piLink.portName)
-    while (time.time() - start <= delay):
+    while (ticks.timeSince(start) <= delay):
         ui.ticks()
 
     ui.showControllerPage()
@@ -82,47 +106,87 @@ def setup():
     print("init complete")
 
 
-def loop():
-    '''Main loop.'''
-    lastUpdate = -1  # initialise at -1 to update immediately
+def buttonPushed():
+    # ui.ticks() takes the push from the encoder.
+    ui.ticks()
 
-    oldState = None
 
-    spinner = '|/-\\'
-    spinindex = 0
+def update():
+    '''Update the controller and the display.  Run every second.'''
+    global spinIndex
 
-    while keepRunning:
-        ui.ticks()
-        if (time.time() - lastUpdate >= 1.0):  # update settings every second
-            # round to nearest 1 second boundary to keep in sync with real time
-            lastUpdate = round(time.time())
+    oldState = tempControl.getState()
+    if recorder is not None:
+        recorder.update()
+    else:
+        tempControl.update()
+
+    if (oldState != tempControl.getState()):
+        print("State changed from %s to %s" % (oldState, tempControl.getState()))
+        piLink.printTemperatures()  # add a data point at every state transition
+
+    ui.update()
 
-            tempControl.updateTemperatures()
-            tempControl.detectPeaks()
-            tempControl.updatePID()
-            oldState = tempControl.getState()
-            tempControl.updateState()
+    # We have two lines free at the bottom of the display.
 
-            if (oldState != tempControl.getState()):
-                print("State changed from %s to %s" % (oldState, tempControl.getState()))
-                piLink.printTemperatures()  # add a data point at every state transition
+    # Show local time YYYY-MM-DD hh:mm (16 characters.)
+    ui.LCD.printat(0, 5, time.strftime("%Y-%m-%d %H:%M"))
 
-            tempControl.updateOutputs()
-            ui.update()
+    # Last character is a spinner to show we haven't crashed
+    ui.LCD.print("%s" % SPINNER[spinIndex])
+    spinIndex = (spinIndex + 1) % len(SPINNER)
 
-            # We have two lines free at the bottom of the display.
 
-            # Show local time YYYY-MM-DD hh:mm (16 characters.)
-            ui.LCD.printat(0, 5, time.strftime("%Y-%m-%d %H:%M"))
+def loop():
+    '''Main loop.  Sleeps until a command arrives from BrewPi, the
+    rotary encoder button is pushed, or it is time for a scheduled job,
+    and handles whichever it was straight away.'''
+    global recorder
+
+    receive = piLink.receiveAll
+    pushed = buttonPushed
+    if args.record:
+        print("Recording to '%s'" % args.record)
+        logging.info("Recording to %s", args.record)
+        recorder = ControlRecorder.Recorder(args.record, tempControl)
+        receive = recorder.command('piLink', receive)
+        pushed = recorder.command('menu', pushed)
+
+    scheduler = ticks.Scheduler()
+    scheduler.every(UPDATE_INTERVAL, update)  # update settings every second
+    scheduler.every(SENSOR_STATE_INTERVAL, tempControl.storeSensorState,
+                    start=ticks.seconds() + SENSOR_STATE_INTERVAL)
+
+    selector = selectors.DefaultSelector()
+    selector.register(piLink, selectors.EVENT_READ, receive)
+    selector.register(encoder, selectors.EVENT_READ, pushed)
+
+    # A signal writes to this pipe, so SIGINT or SIGTERM stops the loop
+    # at once rather than at the next update.
+    wakeRead, wakeWrite = os.pipe()
+    os.set_blocking(wakeRead, False)
+    os.set_blocking(wakeWrite, False)
+    signal.set_wakeup_fd(wakeWrite)
+    selector.register(wakeRead, selectors.EVENT_READ, lambda: os.read(wakeRead, 64))
 
-            # Last character is a spinner to show we haven't crashed
-            ui.LCD.print("%s" % spinner[spinindex])
-            spinindex = (spinindex + 1) % 4
+    while keepRunning:
+        scheduler.runDue()
 
         # listen for incoming serial connections while waiting to update
-        piLink.receive()
+        for key, events in selector.select(scheduler.timeout()):
+            key.data()
+
+    for line in scheduler.report():
+        print(line)
+        logging.info(line)
+
+    signal.set_wakeup_fd(-1)
+    selector.close()
+    os.close(wakeRead)
+    os.close(wakeWrite)
 
-        time.sleep(0.05)  # Don't hog the processor
+    if recorder is not None:
+        recorder.close()
 
     piLink.cleanup()
     ui.LCD.printat(0, 5, "Shutting down.   ")
@@ -139,6 +203,8 @@ if __name__ == "__main__":
     loop()  # loop() will exit if we get one of the above signals
     heater.off()
     cooler.off()
+    print("Saving sensor state")
+    tempControl.storeSensorState()
     print("Stopping threads")
     tempControl.beerSensor.stop()
     tempControl.ambientSensor.stop()
@@ -31,6 +31,7 @@ import logging
 import termios
 import datetime
 
+import filterDesign
 import ui
 from constants import *
 from JsonKeys import *
@@ -43,6 +44,10 @@ STR_FRIDGE_TEMP = "Fridge temp"
 STR_FMT_SET_TO = " set to %s "
 
 
+# Most bytes to read from the pty at once
+READ_SIZE = 4096
+
+
 class piLink:
     def __init__(self, tempControl, path, eepromManager):
         # Set up a pty to accept serial input as if we are an Arduino
@@ -77,6 +82,7 @@ class piLink:
         self.portName = port_name
         self.path = path
         self.buf = ''
+        self.received = ''  # Everything read by the last receiveAll()
 
         self.tempControl = tempControl
         self.tempControl.piLink = self  # FIXME is this good practice?
@@ -90,21 +96,41 @@ class piLink:
             except Exception:
                 pass
 
+    def fileno(self):
+        """The pty, so the main loop can wait for commands with select."""
+        return self.f.fileno()
+
+    def fillBuffer(self):
+        """Append whatever has arrived to the buffer, without waiting."""
+        ready_to_read, ready_to_write, in_error = select.select([self.f], [], [], 0)
+
+        if ready_to_read:
+            # Take everything there is, not one byte per call
+            data = os.read(self.f.fileno(), READ_SIZE).decode("utf-8", "replace")
+            self.buf += data
+            self.received += data
+
     def updateBuffer(self):
         """ Fetch new data into the buffer and return the first character
         of the buffer
         """
-        ready_to_read, ready_to_write, in_error = select.select([self.f], [], [], 0)
+        if not self.buf:
+            self.fillBuffer()
 
-        # read a byte and append it to the buffer
-        if ready_to_read:
-            self.buf += self.f.read(1).decode("utf-8")  # Convert byte to character
-
-        # return a single byte (if there is one)
-        inByte = self.buf[0:]
+        # return a single character (if there is one)
+        inByte = self.buf[0:1]
         self.buf = self.buf[1:]
         return inByte
 
+    def receiveAll(self):
+        """Handle every command that has arrived.  The main loop calls
+        this when the pty is readable.  Returns the text received."""
+        self.received = ''
+        self.fillBuffer()
+        while self.buf:
+            self.receive()
+        return self.received
+
     def receive(self):
 
         inByte = self.updateBuffer()
@@ -483,19 +509,35 @@ class piLink:
         if JSONKEY_rotaryHalfSteps in newSettings:
             self.tempControl.cc.rotaryHalfSteps = int(newSettings[JSONKEY_rotaryHalfSteps])
 
+        # JSON_CONVERT(JSONKEY_fridgeFastFilter, MAKE_FILTER_SETTING_TARGET(FAST, FRIDGE), applyFilterSetting),
+        # JSON_CONVERT(JSONKEY_fridgeSlowFilter, MAKE_FILTER_SETTING_TARGET(SLOW, FRIDGE), applyFilterSetting),
+        # JSON_CONVERT(JSONKEY_fridgeSlopeFilter, MAKE_FILTER_SETTING_TARGET(SLOPE, FRIDGE), applyFilterSetting),
+        # JSON_CONVERT(JSONKEY_beerFastFilter, MAKE_FILTER_SETTING_TARGET(FAST, BEER), applyFilterSetting),
+        # JSON_CONVERT(JSONKEY_beerSlowFilter, MAKE_FILTER_SETTING_TARGET(SLOW, BEER), applyFilterSetting),
+        # JSON_CONVERT(JSONKEY_beerSlopeFilter, MAKE_FILTER_SETTING_TARGET(SLOPE, BEER), applyFilterSetting)
+
+        if JSONKEY_fridgeFastFilter in newSettings:
+            self.applyFilterSetting('fridgeFastFilter', newSettings[JSONKEY_fridgeFastFilter])
+
+        if JSONKEY_fridgeSlowFilter in newSettings:
+            self.applyFilterSetting('fridgeSlowFilter', newSettings[JSONKEY_fridgeSlowFilter])
+
+        if JSONKEY_fridgeSlopeFilter in newSettings:
+            self.applyFilterSetting('fridgeSlopeFilter', newSettings[JSONKEY_fridgeSlopeFilter])
+
+        if JSONKEY_beerFastFilter in newSettings:
+            self.applyFilterSetting('beerFastFilter', newSettings[JSONKEY_beerFastFilter])
+
+        if JSONKEY_beerSlowFilter in newSettings:
+            self.applyFilterSetting('beerSlowFilter', newSettings[JSONKEY_beerSlowFilter])
+
+        if JSONKEY_beerSlopeFilter in newSettings:
+            self.applyFilterSetting('beerSlopeFilter', newSettings[JSONKEY_beerSlopeFilter])
+
         self.eepromManager.storeTempConstantsAndSettings()  # Note - this is merged into the code called by virtually
                                                             # all of the above lines. Factoring it out to here instead.
         print(vars(self.tempControl.cc))
 
-    # FIXME Still to do
-    # JSON_CONVERT(JSONKEY_fridgeFastFilter, MAKE_FILTER_SETTING_TARGET(FAST, FRIDGE), applyFilterSetting),
-    # JSON_CONVERT(JSONKEY_fridgeSlowFilter, MAKE_FILTER_SETTING_TARGET(SLOW, FRIDGE), applyFilterSetting),
-    # JSON_CONVERT(JSONKEY_fridgeSlopeFilter, MAKE_FILTER_SETTING_TARGET(SLOPE, FRIDGE), applyFilterSetting),
-    # JSON_CONVERT(JSONKEY_beerFastFilter, MAKE_FILTER_SETTING_TARGET(FAST, BEER), applyFilterSetting),
-    # JSON_CONVERT(JSONKEY_beerSlowFilter, MAKE_FILTER_SETTING_TARGET(SLOW, BEER), applyFilterSetting),
-    # JSON_CONVERT(JSONKEY_beerSlopeFilter, MAKE_FILTER_SETTING_TARGET(SLOPE, BEER), applyFilterSetting)
-
-
     # FIXME A lot of unneeded code copied from original source should be deleted
     # static void (*ParseJsonCallback)(const char* key, const char* val, void* data);
 
@@ -602,6 +644,19 @@ class piLink:
 
         self.tempControl.setFridgeTemp(newTemp)
 
+    def applyFilterSetting(self, name, val):
+        try:
+            b = int(val)
+        except (TypeError, ValueError):
+            b = None
+        if b is None or not filterDesign.isValidFilterSetting(b):
+            print("Invalid value '%s' for %s.  Ignored." % (val, name))
+            logging.warning("Invalid value '%s' for %s", val, name)
+            return
+
+        print("%s set to %d (delay %d samples)" % (name, b, filterDesign.filterDelay(b)))
+        self.tempControl.applyFilterSetting(name, b)
+
     def setTempFormat(self, val):
         self.tempControl.setTempFormat(val)
         self.eepromManager.storeTempConstantsAndSettings()
@@ -18,6 +18,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
 import threading
 import time
 
@@ -27,7 +28,12 @@ GPIO.setmode(GPIO.BOARD)
 
 
 class rotaryEncoder(threading.Thread):
-    """A threaded rotary encoder driver.  Read .pos or .pushed any time."""
+    """A threaded rotary encoder driver.  Read .pos or .pushed any time.
+
+    When the button is pushed, a byte is written to a pipe, so a main
+    loop using select can wait on the encoder (it has a fileno()) rather
+    than polling .pushed.  takePushed() says whether the button has been
+    pushed, even if it has been let go since, and forgets the push."""
 
     def __init__(self, A, B, PB, dummy=False):
         """Initialise hardware.  A and B are the quadrature pins, PB is the pushbutton."""
@@ -55,6 +61,12 @@ class rotaryEncoder(threading.Thread):
         self.pos = 0  # infinite position value.  +ve is clockwise
         self.last_pos = 0
 
+        # Pipe to wake a select() when the button is pushed
+        self._eventRead, self._eventWrite = os.pipe()
+        os.set_blocking(self._eventRead, False)
+        os.set_blocking(self._eventWrite, False)
+        self._wasPushed = False
+
         self.running = False
 
     def run(self):
@@ -112,6 +124,12 @@ class rotaryEncoder(threading.Thread):
             if self._state & 0x03 == 0:
                 self.internal_pos = self.pos * 4
 
+            # Signal the button being pushed, but not held
+            pushed = self.pushed
+            if pushed and not self._wasPushed:
+                self._notify()
+            self._wasPushed = pushed
+
             if self._dummy:
                 # If there's no hardware, don't sample often
                 time.sleep(2)
@@ -121,6 +139,34 @@ class rotaryEncoder(threading.Thread):
     def stop(self):
         self.running = False
 
+    def _notify(self):
+        try:
+            os.write(self._eventWrite, b'P')
+        except BlockingIOError:
+            pass  # The pipe is full of events nobody has read yet
+
+    def fileno(self):
+        """Readable when the button has been pushed."""
+        return self._eventRead
+
+    def takePushed(self):
+        """Return True if the button has been pushed since the last call
+        or clearEvents(), and forget the push."""
+        try:
+            pushed = bool(os.read(self._eventRead, 64))
+        except BlockingIOError:
+            return False
+        self.clearEvents()
+        return pushed
+
+    def clearEvents(self):
+        """Forget the button pushes signalled so far."""
+        try:
+            while os.read(self._eventRead, 64):
+                pass
+        except BlockingIOError:
+            pass
+
     @property
     def pushed(self):
         if not self._dummy:
@@ -22,6 +22,7 @@
 
 import logging
 import pickle
+import time
 
 import ticks
 
@@ -50,6 +51,29 @@ MIN_SWITCH_TIME = 600
 COOL_PEAK_DETECT_TIME = 1800
 HEAT_PEAK_DETECT_TIME = 900
 
+# Sensor filter state is saved to this file, and reloaded at startup if
+# it was saved less than SENSOR_STATE_MAX_AGE seconds ago.
+SENSOR_STATE_FILE = 'SENSORS.state'
+SENSOR_STATE_MAX_AGE = 600
+
+# Sample periods of the sensors in seconds, for adaptive sampling.  While
+# heating, cooling or waiting for a peak the fridge is read faster; when
+# idle everything is read less often.  Sensors round these to a power of
+# two, and won't go faster than their conversion time.
+SAMPLING_POLICY = {'active': {'fridge': 0.5, 'beer': 1, 'ambient': 4},
+                   'idle': {'fridge': 2, 'beer': 4, 'ambient': 8},
+                   }
+
+# Filter settings in ControlConstants, and the sensor and setter each
+# one applies to.
+FILTER_SETTINGS = {'fridgeFastFilter': ('fridgeSensor', 'setFastFilterCoefficients'),
+                   'fridgeSlowFilter': ('fridgeSensor', 'setSlowFilterCoefficients'),
+                   'fridgeSlopeFilter': ('fridgeSensor', 'setSlopeFilterCoefficients'),
+                   'beerFastFilter': ('beerSensor', 'setFastFilterCoefficients'),
+                   'beerSlowFilter': ('beerSensor', 'setSlowFilterCoefficients'),
+                   'beerSlopeFilter': ('beerSensor', 'setSlopeFilterCoefficients'),
+                   }
+
 MODES = {'MODE_FRIDGE_CONSTANT': 'f',
          'MODE_BEER_CONSTANT': 'b',
          'MODE_BEER_PROFILE': 'p',
@@ -125,9 +149,35 @@ class ControlConstants:
 
 
 class tempController:
-    def __init__(self, ID_fridge, ID_beer=None, ID_ambient=None, cooler=None, heater=None, door=None):
+    def __init__(self, ID_fridge, ID_beer=None, ID_ambient=None, cooler=None, heater=None, door=None,
+                 sensorOptions=None, beerEstimator=None,
+                 deviceWatcher=None, samplingPolicy=None, sensorClass=None):
         # We must have at least a fridge sensor
 
+        # sensorOptions maps 'fridge', 'beer' and 'ambient' to a dict of
+        # extra keyword arguments for that tempSensor.sensor.
+        if sensorOptions is None:
+            sensorOptions = {}
+
+        # sensorClass replaces tempSensor.sensor, to run the controller
+        # with simulated sensors (see FridgeSimulator.py and ControlRecorder.py).
+        if sensorClass is None:
+            sensorClass = tempSensor.sensor
+
+        # If beerEstimator (a KalmanFusion.BeerEstimator) is given, the
+        # PID uses its beer temperature and slope instead of the beer
+        # sensor's slow and slope filters.
+        self.beerEstimator = beerEstimator
+
+        # If deviceWatcher (a DeviceWatcher.DeviceWatcher) is given, sensors
+        # which are unplugged and plugged in again are picked up again.
+        self.deviceWatcher = deviceWatcher
+
+        # If samplingPolicy (like SAMPLING_POLICY) is given, the sensors'
+        # sample periods follow whether the controller is active or idle.
+        self.samplingPolicy = samplingPolicy
+        self.samplingState = None
+
         self.cs = ControlSettings()
         self.cv = ControlVariables()
         self.cc = ControlConstants()
@@ -156,12 +206,18 @@ class tempController:
 
         # this is for cases where the device manager hasn't configured beer/fridge sensor.
         # if (self.beerSensor==None):
-        self.beerSensor = tempSensor.sensor(ID_beer)
+        self.beerSensor = sensorClass(ID_beer, **sensorOptions.get('beer', {}))
 
         # if (self.fridgeSensor==None):
-        self.fridgeSensor = tempSensor.sensor(ID_fridge)
+        self.fridgeSensor = sensorClass(ID_fridge, **sensorOptions.get('fridge', {}))
 
-        self.ambientSensor = tempSensor.sensor(ID_ambient)
+        self.ambientSensor = sensorClass(ID_ambient, **sensorOptions.get('ambient', {}))
+
+        # Restore the filters from the last run, if we can.  Sensors that
+        # are restored are already initialised, so init() does nothing,
+        # and already have their coefficients, so initFilters() does not
+        # rescale them.
+        self.loadSensorState()
 
         self.beerSensor.init()
         self.fridgeSensor.init()
@@ -183,20 +239,50 @@ class tempController:
     # piLink will insert a reference to itself as self.piLink here
 
 
+    def waitForSensors(self, timeout):
+        """Wait up to timeout seconds for the first reading from every
+        connected sensor, then initialise their filters.  The sensors
+        are read together, so this takes one conversion time.  Returns
+        the sensors that did not respond."""
+        deadline = time.monotonic() + timeout
+        missing = []
+        for sensor in (self.beerSensor, self.fridgeSensor, self.ambientSensor):
+            if not sensor.isConnected():
+                continue
+            if not sensor.waitReady(max(0, deadline - time.monotonic())):
+                missing.append(sensor)
+            sensor.init()
+        return missing
+
     def reset(self):
         self.doPosPeakDetect = False
         self.doNegPeakDetect = False
 
+    def update(self):
+        """Read the sensors, then update the PID, the state and the
+        outputs.  The main loop runs this every second."""
+        self.updateTemperatures()
+        self.detectPeaks()
+        self.updatePID()
+        self.updateState()
+        self.updateOutputs()
+
     def updateSensor(self, sensor):
-        sensor.update()
+        return sensor.update()
 
     # if not (sensor.isConnected()):
     #	sensor.init();
 
 
     def updateTemperatures(self):
-        self.updateSensor(self.beerSensor)
-        self.updateSensor(self.fridgeSensor)
+        if self.deviceWatcher is not None:
+            self.updateDevices()
+
+        if self.samplingPolicy is not None:
+            self.updateSampling()
+
+        beerUpdated = self.updateSensor(self.beerSensor)
+        fridgeUpdated = self.updateSensor(self.fridgeSensor)
 
         # Read ambient sensor to keep the value up to date.
         # If no sensor is connected, this does nothing.
@@ -206,6 +292,62 @@ class tempController:
         # ambientSensor->init(); # try to reconnect a disconnected, but installed sensor
         self.updateSensor(self.ambientSensor)
 
+        if self.beerEstimator is not None:
+            self.updateBeerEstimator(beerUpdated, fridgeUpdated)
+
+    def updateDevices(self):
+        """Tell the sensors which devices have been unplugged or plugged
+        in since the last tick."""
+        added, removed = self.deviceWatcher.poll()
+        if not (added or removed):
+            return
+
+        sensors = {sensor.deviceID: sensor
+                   for sensor in (self.beerSensor, self.fridgeSensor, self.ambientSensor)
+                   if sensor.isConnected()}
+        for deviceID in removed:
+            if deviceID in sensors:
+                print("Sensor '%s' unplugged." % deviceID)
+                logging.warning("Sensor %s unplugged", deviceID)
+                sensors[deviceID].deviceRemoved()
+        for deviceID in added:
+            if deviceID in sensors:
+                print("Sensor '%s' plugged in again." % deviceID)
+                logging.info("Sensor %s plugged in again", deviceID)
+                sensors[deviceID].deviceAdded()
+            else:
+                print("Found sensor '%s', which is not in the config file." % deviceID)
+                logging.info("Found unconfigured sensor %s", deviceID)
+
+    def updateSampling(self):
+        """Change the sensors' sample periods when the controller goes
+        from idle to active or back."""
+        active = (self.stateIsHeating() or self.stateIsCooling() or
+                  bool(self.doPosPeakDetect) or bool(self.doNegPeakDetect))
+        samplingState = 'active' if active else 'idle'
+        if samplingState == self.samplingState:
+            return
+        self.samplingState = samplingState
+
+        periods = self.samplingPolicy[samplingState]
+        for role, sensor in (('fridge', self.fridgeSensor),
+                             ('beer', self.beerSensor),
+                             ('ambient', self.ambientSensor)):
+            if sensor.isConnected() and role in periods:
+                sensor.setSamplePeriod(periods[role])
+        logging.debug("Sampling for %s: fridge %s s, beer %s s, ambient %s s",
+                      samplingState, self.fridgeSensor.samplePeriod,
+                      self.beerSensor.samplePeriod, self.ambientSensor.samplePeriod)
+
+    def updateBeerEstimator(self, beerUpdated, fridgeUpdated):
+        """Give the new readings and the relay states to the beer
+        estimator."""
+        beer = self.beerSensor.readInput() if beerUpdated else None
+        fridge = self.fridgeSensor.readInput() if fridgeUpdated else None
+        heating = self.heater is not None and self.heater.state
+        cooling = self.cooler is not None and self.cooler.state
+        self.beerEstimator.update(beer, fridge, heating, cooling)
+
     def modeIsBeer(self):
         return self.cs.mode in (MODES['MODE_BEER_CONSTANT'],
                                 MODES['MODE_BEER_PROFILE'])
@@ -224,8 +366,12 @@ class tempController:
 
             # fridge setting is calculated with PID algorithm.
             # Beer temperature error is input to PID
-            self.cv.beerDiff = self.cs.beerSetting - self.beerSensor.readSlowFiltered()
-            self.cv.beerSlope = self.beerSensor.readSlope()
+            if self.beerEstimator is not None and self.beerEstimator.ready:
+                self.cv.beerDiff = self.cs.beerSetting - self.beerEstimator.readTemperature()
+                self.cv.beerSlope = self.beerEstimator.readSlope()
+            else:
+                self.cv.beerDiff = self.cs.beerSetting - self.beerSensor.readSlowFiltered()
+                self.cv.beerSlope = self.beerSensor.readSlope()
             fridgeFastFiltered = self.fridgeSensor.readFastFiltered()
 
             self.integralUpdateCounter += 1
@@ -614,6 +760,49 @@ class tempController:
 
         self.initFilters()
 
+    def storeSensorState(self):
+        """Write the filter state of all sensors to SENSOR_STATE_FILE."""
+        data = {'time': time.time(),
+                'fridge': self.fridgeSensor.getFilterState(),
+                'beer': self.beerSensor.getFilterState(),
+                'ambient': self.ambientSensor.getFilterState(),
+                'beerEstimator': (self.beerEstimator.getState()
+                                  if self.beerEstimator is not None else None),
+                }
+        # Write a new file and rename it, so a crash while writing does
+        # not leave a damaged state file.
+        temp_name = SENSOR_STATE_FILE + '.new'
+        with open(temp_name, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_name, SENSOR_STATE_FILE)
+
+    def loadSensorState(self, maxAge=SENSOR_STATE_MAX_AGE):
+        """Restore the filter state of all sensors from SENSOR_STATE_FILE
+        if it is less than maxAge seconds old."""
+        try:
+            with open(SENSOR_STATE_FILE, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning("Could not read '%s': %s", SENSOR_STATE_FILE, e)
+            return
+
+        age = time.time() - data.get('time', 0)
+        if not (0 <= age < maxAge):
+            logging.info("Sensor state is %d seconds old.  Not restoring.", age)
+            return
+
+        for role, sensor in (('fridge', self.fridgeSensor),
+                             ('beer', self.beerSensor),
+                             ('ambient', self.ambientSensor)):
+            if role in data and sensor.setFilterState(data[role]):
+                logging.info("Restored %s sensor filters (%d seconds old).", role, age)
+
+        if self.beerEstimator is not None and data.get('beerEstimator'):
+            self.beerEstimator.setState(data['beerEstimator'])
+            logging.info("Restored beer estimator (%d seconds old).", age)
+
     def hasStoredSettings(self):
         # This is a departure from the Arduino implementation - This is designed to circumvent the hack that is used
         # in eepromManager to determine if we have settings to load.
@@ -686,6 +875,19 @@ class tempController:
         self.beerSensor.setSlowFilterCoefficients(self.cc.beerSlowFilter)
         self.beerSensor.setSlopeFilterCoefficients(self.cc.beerSlopeFilter)
 
+    def applyFilterSetting(self, name, b):
+        """Set filter constant name (a key of FILTER_SETTINGS) to b, and
+        apply it to the running filter without resetting its history.
+
+        Returns the time taken to apply the change, in seconds."""
+        start = time.perf_counter()
+        setattr(self.cc, name, b)
+        sensorName, setter = FILTER_SETTINGS[name]
+        getattr(getattr(self, sensorName), setter)(b)
+        elapsed = time.perf_counter() - start
+        logging.info("Filter setting %s changed to %d in %.1f us", name, b, elapsed * 1e6)
+        return elapsed
+
     def setMode(self, newMode, force=False):
         logging.debug("TempControl::setMode from %s to %s", self.cs.mode, newMode)
 
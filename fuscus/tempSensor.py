@@ -23,21 +23,41 @@
 from DS18B20 import DS18B20
 
 import FilterCascaded
+import FilterMedian
+import SlopeRegression
+import filterDesign
+import ticks
 
-import time
 import logging
+import math
 
 
 # tempSensor class for BrewPi
-# Subclassed from DS18B20, which is a general purpose threaded class
-# for reading DS18B20 one-wire temperature sensors.
+# Subclassed from DS18B20, which is a general purpose class for reading
+# DS18B20 one-wire temperature sensors in the background.
 
 # This class adds filtering and other functions to the sensor.
 
 class sensor(DS18B20):
-    def __init__(self, deviceID, calibrationOffset=0.0):
+    def __init__(self, deviceID, calibrationOffset=0.0, filterEngine='decimal',
+                 slopeSource='filter', slopeWindow=600,
+                 medianWindow=0, spikeLimit=2.0, resolution=None, calibration=None):
+        """filterEngine selects the filter implementation, 'decimal' or
+        'integer'.
 
-        super().__init__(deviceID, samplePeriod=1, calibrationOffset=calibrationOffset)
+        slopeSource selects where readSlope() comes from: 'filter' for
+        the slope filter, or 'regression' for a least-squares fit over the
+        last slopeWindow samples.
+
+        If medianWindow is not 0, readings are checked against the median
+        of the last medianWindow readings before they reach the filters,
+        and readings more than spikeLimit degrees from it are replaced by
+        the median.
+
+        resolution and calibration are passed to DS18B20."""
+
+        super().__init__(deviceID, samplePeriod=1, calibrationOffset=calibrationOffset,
+                         resolution=resolution, calibration=calibration)
 
         self.deviceID = deviceID
 
@@ -51,39 +71,136 @@ class sensor(DS18B20):
         self.failedReadCount = 255
         self.updateCounter = 255
 
-        self.fastFilter = FilterCascaded.CascadedFilter()
-        self.slowFilter = FilterCascaded.CascadedFilter()
-        self.slopeFilter = FilterCascaded.CascadedFilter()
+        # ticks.seconds() time of the last reading given to the filters
+        self.lastSampleTime = None
+
+        # Peaks in the slow filter output found by the last readings, for
+        # detectPosPeak() and detectNegPeak().  They are looked for after
+        # every reading, so none are missed when there are several
+        # readings per update.
+        self.posPeak = None
+        self.negPeak = None
+
+        # The filter b values as set, before compensating for the sample
+        # period, and the sample period as a power of two seconds.
+        self.filterBValues = {'fast': None, 'slow': None, 'slope': None}
+        self.periodShift = 0
+
+        self.fastFilter = FilterCascaded.CascadedFilter(engine=filterEngine)
+        self.slowFilter = FilterCascaded.CascadedFilter(engine=filterEngine)
+        self.slopeFilter = FilterCascaded.CascadedFilter(engine=filterEngine)
         self.prevOutputForSlope = None
 
-        time.sleep(1)  # Wait for at least one reading to be ready.
+        if slopeSource == 'regression':
+            self.regressionSlope = SlopeRegression.RegressionSlope(window=slopeWindow,
+                                                                   samplePeriod=self.samplePeriod)
+        elif slopeSource == 'filter':
+            self.regressionSlope = None
+        else:
+            raise ValueError("Unknown slope source '%s'." % slopeSource)
+
+        if medianWindow:
+            self.medianFilter = FilterMedian.MedianFilter(window=medianWindow,
+                                                          spikeLimit=spikeLimit)
+        else:
+            self.medianFilter = None
 
     def isConnected(self):
         return self.deviceID is not None
 
-    def init(self):
+    def init(self, temp=None):
+        """Initialise the filters with temp, or the latest reading, if
+        there has been no good reading for a while."""
         logging.debug("tempsensor::init - begin %d", self.failedReadCount);
         # if (_sensor && _sensor->init() && failedReadCount>60) {
         if (self.failedReadCount > 60):
-            temp = self.temperature
+            if temp is None:
+                temp = self.temperature
             if (temp is not None):
                 logging.debug("initializing filters with value %d", temp)
                 self.fastFilter.init(temp)
                 self.slowFilter.init(temp)
                 self.slopeFilter.init(0)
-                self.prevOutputForSlope = self.slowFilter.readOutput()
+                self.prevOutputForSlope = self.slowFilter.readOutputDoublePrecision()
+                if self.regressionSlope is not None:
+                    self.regressionSlope.init()
+                if self.medianFilter is not None:
+                    self.medianFilter.init()
                 self.failedReadCount = 0
 
     def update(self):
+        """Add every new reading to the filters.  Returns the number of
+        readings."""
+        readings = self.newReadings()
+        if readings:
+            # Like the filter outputs, peaks last until the next readings.
+            self.posPeak = None
+            self.negPeak = None
+        for temp in readings:
+            self.addReading(temp)
+            self.updateSlope()
+        return len(readings)
+
+    def newReadings(self):
+        """Return the good readings since the last call, oldest first.
+        failedReadCount counts the failed readings since the last good
+        one."""
+        readings = []
+        samples = self.takeSamples()
+        for sampleTime, temp in samples:
+            if (temp is None):
+                if (self.failedReadCount < 255):  # limit
+                    self.failedReadCount += 1
+            else:
+                # Initialise the filters with the first reading after
+                # startup or a long disconnect.
+                if (self.failedReadCount > 60):
+                    self.init(temp)
+                self.failedReadCount = 0
+                readings.append(temp)
+                self.lastSampleTime = sampleTime
+
         # if (!_sensor || (temp=_sensor->read())==TEMP_SENSOR_DISCONNECTED) {
-        temp = self.temperature
-        if (temp is None):
+        if not samples and self.temperature is None:
+            # Not connected, or the bus has stopped.
             if (self.failedReadCount < 255):  # limit
                 self.failedReadCount += 1
-            return
+        return readings
+
+    def addReading(self, temp):
+        if self.medianFilter is not None:
+            temp = self.medianFilter.add(temp)
 
         self.fastFilter.add(temp)
         self.slowFilter.add(temp)
+        # Keep the first of each kind of peak, as peak detection stops at
+        # the first one it sees.
+        if self.posPeak is None:
+            self.posPeak = self.slowFilter.detectPosPeak()
+        if self.negPeak is None:
+            self.negPeak = self.slowFilter.detectNegPeak()
+        if self.regressionSlope is not None:
+            self.regressionSlope.add(temp)
+
+    def deviceAdded(self):
+        """The device is back after being unplugged.  If it was gone for
+        longer than 60 readings, start the filters again from its first
+        reading, as failed reads would have.  After a short glitch the
+        filters carry on."""
+        super().deviceAdded()
+        age = self.readAge()
+        if age is None or age > 60 * self.samplePeriod:
+            self.failedReadCount = 255
+
+    def readAge(self):
+        """Return the age in seconds of the newest reading given to the
+        filters, or None if there has been none."""
+        if self.lastSampleTime is None:
+            return None
+        return ticks.timeSince(self.lastSampleTime)
+
+    def updateSlope(self):
+        """Update the slope filter after a new reading."""
         # update slope filter every 3 samples.
         # averaged differences will give the slope. Use the slow filter as input
         self.updateCounter -= 1
@@ -91,10 +208,10 @@ class sensor(DS18B20):
         # prevents an influence for the startup inaccuracy.
         if (self.updateCounter == 4):
             # only happens once after startup.
-            self.prevOutputForSlope = self.slowFilter.readOutput()
+            self.prevOutputForSlope = self.slowFilter.readOutputDoublePrecision()
 
         if (self.updateCounter <= 0):
-            slowFilterOutput = self.slowFilter.readOutput()
+            slowFilterOutput = self.slowFilter.readOutputDoublePrecision()
             diff = slowFilterOutput - self.prevOutputForSlope
             # diff_upper = diff >> 16
             # if(diff_upper > 27){ // limit to prevent overflow INT_MAX/1200 = 27.14
@@ -104,10 +221,78 @@ class sensor(DS18B20):
             #	diff = (-27l << 16);
             # }
 
-            self.slopeFilter.add(1200 * diff)  # Multiply by 1200 (1h/4s), shift to single precision
+            # Multiply by 1200 (1h/3s), or less if the samples are
+            # further apart.
+            self.slopeFilter.add(3600 / (3 * self.samplePeriod) * diff)
             self.prevOutputForSlope = slowFilterOutput
             self.updateCounter = 3
 
+    def getFilterState(self):
+        """Return everything needed to restore the filters after a
+        restart, as a dict."""
+        return {'deviceID': self.deviceID,
+                'engine': self.fastFilter.engine,
+                'fastFilter': self.fastFilter.getState(),
+                'slowFilter': self.slowFilter.getState(),
+                'slopeFilter': self.slopeFilter.getState(),
+                'filterBValues': dict(self.filterBValues),
+                'periodShift': self.periodShift,
+                'prevOutputForSlope': self.prevOutputForSlope,
+                'failedReadCount': self.failedReadCount,
+                'updateCounter': self.updateCounter,
+                'regressionSlope': (self.regressionSlope.getState()
+                                    if self.regressionSlope is not None else None),
+                'medianFilter': (self.medianFilter.getState()
+                                 if self.medianFilter is not None else None),
+                }
+
+    def setFilterState(self, state):
+        """Restore filter state saved by getFilterState().
+
+        The state is ignored if it was saved for a different device or
+        filter engine, or with the filters not initialised.  Returns True
+        if the state was restored."""
+        if (state.get('deviceID') != self.deviceID or
+                state.get('engine') != self.fastFilter.engine or
+                state.get('failedReadCount', 255) > 60):
+            return False
+
+        # The history only makes sense with the coefficients it was saved
+        # with, so set those first, without rescaling.  initFilters() then
+        # finds them unchanged and leaves the history alone.
+        try:
+            self.filterBValues = dict(state['filterBValues'])
+            self.periodShift = state['periodShift']
+            for name, filt in (('fast', self.fastFilter),
+                               ('slow', self.slowFilter),
+                               ('slope', self.slopeFilter)):
+                b = self.filterBValues[name]
+                if b is not None:
+                    filt.setCoefficients(b - self.periodShift)
+                filt.setState(state[name + 'Filter'])
+        except (KeyError, ValueError) as e:
+            logging.warning("Could not restore filter state for %s: %s", self.deviceID, e)
+            self.failedReadCount = 255
+            return False
+
+        if self.regressionSlope is not None and state.get('regressionSlope'):
+            samples = state['regressionSlope'][-self.regressionSlope.window:]
+            self.regressionSlope.setState(samples)
+
+        if self.medianFilter is not None and state.get('medianFilter'):
+            self.medianFilter.setState(state['medianFilter'])
+
+        super().setSamplePeriod(2.0 ** self.periodShift)
+        self.prevOutputForSlope = state['prevOutputForSlope']
+        self.failedReadCount = state['failedReadCount']
+        self.updateCounter = state['updateCounter']
+        return True
+
+    def readInput(self):
+        """Return the most recent reading given to the filters, after
+        calibration and spike rejection."""
+        return self.fastFilter.readInput()
+
     def readFastFiltered(self):
         return self.fastFilter.readOutput()  # return most recent unfiltered value
 
@@ -116,22 +301,82 @@ class sensor(DS18B20):
 
     def readSlope(self):
         """Return slope per hour."""
+        if self.regressionSlope is not None:
+            return self.regressionSlope.readSlope()
         return self.slopeFilter.readOutput()
 
+    def readRejectedCount(self):
+        """Return the number of readings rejected as spikes."""
+        if self.medianFilter is not None:
+            return self.medianFilter.rejectedCount
+        return 0
+
     def detectPosPeak(self):
-        return self.slowFilter.detectPosPeak()
+        """Return and forget the positive peak found by the last readings,
+        or None."""
+        peak, self.posPeak = self.posPeak, None
+        return peak
 
     def detectNegPeak(self):
-        return self.slowFilter.detectNegPeak()
+        """Return and forget the negative peak found by the last readings,
+        or None."""
+        peak, self.negPeak = self.negPeak, None
+        return peak
+
+    def setFilterCoefficients(self, filt, b):
+        # Once the filters hold data, rescale it for the new coefficients
+        # so the output does not jump.  Filters restored by
+        # setFilterState() already have the b they were saved with, so
+        # setting the same b again leaves them alone.
+        if (self.failedReadCount > 60):
+            filt.setCoefficients(b)
+        else:
+            filt.changeCoefficients(b)
 
     def setFastFilterCoefficients(self, b):
-        self.fastFilter.setCoefficients(b)
+        self.filterBValues['fast'] = b
+        self.setFilterCoefficients(self.fastFilter, b - self.periodShift)
 
     def setSlowFilterCoefficients(self, b):
-        self.slowFilter.setCoefficients(b)
+        self.filterBValues['slow'] = b
+        self.setFilterCoefficients(self.slowFilter, b - self.periodShift)
 
     def setSlopeFilterCoefficients(self, b):
-        self.slopeFilter.setCoefficients(b)
+        self.filterBValues['slope'] = b
+        self.setFilterCoefficients(self.slopeFilter, b - self.periodShift)
+
+    def setSamplePeriod(self, samplePeriod):
+        """Change the sample period, rounded to a power of two seconds,
+        and change the filter coefficients to keep their delay in
+        seconds.  Returns the new period.
+
+        Each step in b doubles the delay of a filter in samples (see
+        filterDesign.py), so doubling the period and taking one from b
+        keeps the filter's behaviour in time.  The period is limited so
+        every b stays in range.  It is not changed when the slope comes
+        from the regression, which needs evenly spaced samples."""
+        if self.regressionSlope is not None:
+            return self.samplePeriod
+
+        shift = round(math.log2(samplePeriod))
+        while 2.0 ** shift < self.minSamplePeriod():
+            shift += 1
+        bValues = [b for b in self.filterBValues.values() if b is not None]
+        if bValues:
+            shift = min(shift, min(bValues) - min(filterDesign.B_VALUES))
+            shift = max(shift, max(bValues) - max(filterDesign.B_VALUES))
+        if shift == self.periodShift:
+            return self.samplePeriod
+
+        logging.debug("Sensor %s sample period %s s", self.deviceID, 2.0 ** shift)
+        self.periodShift = shift
+        super().setSamplePeriod(2.0 ** shift)
+        for name, setter in (('fast', self.setFastFilterCoefficients),
+                             ('slow', self.setSlowFilterCoefficients),
+                             ('slope', self.setSlopeFilterCoefficients)):
+            if self.filterBValues[name] is not None:
+                setter(self.filterBValues[name])
+        return self.samplePeriod
 
     def hasSlowFilter():
         return True
@@ -141,3 +386,64 @@ class sensor(DS18B20):
 
     def hasSlopeFilter():
         return True
+
+
+if __name__ == "__main__":
+
+    # Simple test code: filters restored from a saved state, then given
+    # the same coefficients again as initFilters() does, must carry on
+    # exactly where the saved ones left off.  No sensor is needed.
+    saved = sensor(None)
+    saved.setSamplePeriod(2)
+    for setter, b in ((saved.setFastFilterCoefficients, 1),
+                      (saved.setSlowFilterCoefficients, 4),
+                      (saved.setSlopeFilterCoefficients, 3)):
+        setter(b)
+    for i in range(100):
+        saved.samples.append((i, 20.0 + i / 16.0))
+        saved.update()
+    state = saved.getFilterState()
+
+    restored = sensor(None)
+    assert restored.setFilterState(state), "state was not restored"
+    restored.init()
+    for name, b in saved.filterBValues.items():
+        getattr(restored, 'set%sFilterCoefficients' % name.capitalize())(b)
+    assert restored.getFilterState() == state, "restored state differs"
+    for s in (saved, restored):
+        s.samples.append((100, 26.0))
+        s.update()
+    assert ((restored.readFastFiltered(), restored.readSlowFiltered(), restored.readSlope()) ==
+            (saved.readFastFiltered(), saved.readSlowFiltered(), saved.readSlope())), \
+        "restored filters give a different output"
+    print("Filter state restored: OK")
+
+    # Simple test code: a peak found by a reading which is not the last
+    # of an update must still be reported.
+    readings = [20.0 + 2.0 * math.sin(i / 10.0) for i in range(60)]
+
+    # Find which reading shows the peak when there is one per update.
+    single = sensor(None)
+    for index, temp in enumerate(readings):
+        single.samples.append((index, temp))
+        single.update()
+        peak = single.detectPosPeak()
+        if peak is not None:
+            break
+    else:
+        raise AssertionError("no peak found")
+
+    # Give the same readings two per update, with the peak on the first.
+    paired = sensor(None)
+    start = index % 2
+    for i in range(start):
+        paired.samples.append((i, readings[i]))
+    paired.update()
+    for i in range(start, index + 2, 2):
+        paired.samples.append((i, readings[i]))
+        paired.samples.append((i + 1, readings[i + 1]))
+        paired.update()
+    assert paired.slowFilter.detectPosPeak() is None, "peak was on the last reading"
+    assert paired.detectPosPeak() == peak, "peak on an intermediate reading was lost"
+    assert paired.detectPosPeak() is None, "peak was not consumed"
+    print("Peak %.3f found on reading %d: OK" % (peak, index))
@@ -1,58 +1,292 @@
 #!/usr/bin/env python3
-import DS18B20
+"""Sample every temperature sensor for a while and report how it behaves,
+optionally calibrating them against a reference sensor."""
+
+#
+# Copyright 2015 Andrew Errington
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Finds every DS18B20, reads them all together (they share the bus
+# conversion) for --duration seconds, printing the readings as it goes,
+# then reports for each sensor:
+#
+#   mean, sd      of its readings
+#   noise         sd of the difference between one reading and the
+#                 next, over root 2, which ignores slow changes in
+#                 temperature
+#   offset, sd    of the reference minus this sensor, read together
+#   conv          mean and worst time from the bus starting the
+#                 conversion to having this sensor's reading
+#   read          mean and worst time for the bus to read it, after
+#                 the conversion
+#   interval      mean time between its readings
+#   failed        readings which failed after all retries
+#
+# The W1 driver must be working, or set FUSCUS_W1_DEVICES to the
+# directory made by W1Simulator.py.  Put all the sensors in the same
+# place (a stirred water bath is best) to calibrate them, e.g.
+#
+#   ./testTempSensors.py --duration 600 --reference 28-000006f04264 --write
+#
+# writes the offsets into calibrate.ini.  With --curve, the readings are
+# also sorted into bins by temperature, and each sensor gets a curve with
+# a point per bin, for runs where the temperature is swept (say from
+# crash cooling to a diacetyl rest).  Writing calibrate.ini keeps its
+# other entries but not its comments.
+
+import argparse
+import configparser
+import datetime
+import math
+import os
 import sys
 import time
-import os
-import datetime
 
-# Get a list of temperature sensors and report their values every second.
-# The W1 driver must be working.
+import Calibration
+import DS18B20
+import OneWireBus
+from RunningStats import RunningStats
 
-sensors = []
+# Readings needed in a bin before it becomes a calibration point
+MIN_BIN_COUNT = 30
 
-devices = os.listdir("/sys/bus/w1/devices/")
 
-for device in devices:
-    if device[:2] == "28":
-        print("Found device: %s" % device)
-        sensors.append(DS18B20.DS18B20(device))
+class TestSensor(DS18B20.DS18B20):
+    """DS18B20 which keeps statistics of its readings."""
 
-if not sensors:
-    print("No sensors found in /sys/bus/w1/devices")
-    sys.exit()
-else:
-    print("Found %s temperature sensors." % len(sensors))
+    def __init__(self, deviceID, resolution=None, calibration=None):
+        super().__init__(deviceID, resolution=resolution, calibration=calibration)
+        self.readings = RunningStats()
+        self.steps = RunningStats()  # Differences between readings
+        self.offsets = RunningStats()  # Reference minus this sensor
+        self.readTimes = RunningStats()
+        self.sampleTimes = RunningStats()  # From conversion to reading
+        self.intervals = RunningStats()
+        self.failed = 0
+        self.bins = {}  # Bin: (stats of this sensor, stats of the reference)
+        self.last = None  # (time, temperature) of the last good reading
+        self.lastCompared = None  # Time of the last reading compared
+
+    def read(self):
+        """Time the read done by the bus thread, and the whole sample
+        from the start of the conversion."""
+        start = time.monotonic()
+        temperature = super().read()
+        end = time.monotonic()
+        self.readTimes.add(end - start)
+        if self.bus is not None and self.bus.conversionStart is not None:
+            self.sampleTimes.add(end - self.bus.conversionStart)
+        return temperature
+
+    def addSample(self, sampleTime, temperature):
+        """Count a reading taken from the queue."""
+        if temperature is None:
+            self.failed += 1
+            return
+        self.readings.add(temperature)
+        if self.last is not None:
+            self.steps.add(temperature - self.last[1])
+            self.intervals.add(sampleTime - self.last[0])
+        self.last = (sampleTime, temperature)
+
+    def addReference(self, reference, binWidth):
+        """Compare the last reading with the reference's last reading, if
+        they are from the same conversion."""
+        if self.last is None or reference.last is None:
+            return
+        if self.last[0] == self.lastCompared:
+            return
+        if abs(self.last[0] - reference.last[0]) > self.conversionTime:
+            return
+        self.lastCompared = self.last[0]
+        temperature = self.last[1]
+        referenceTemperature = reference.last[1]
+        self.offsets.add(referenceTemperature - temperature)
+        if binWidth:
+            key = round(temperature / binWidth)
+            if key not in self.bins:
+                self.bins[key] = (RunningStats(), RunningStats())
+            readings, references = self.bins[key]
+            readings.add(temperature)
+            references.add(referenceTemperature)
+
+    def noise(self):
+        return self.steps.stdev() / math.sqrt(2)
+
+    def failureRate(self):
+        total = self.readings.count + self.failed
+        return self.failed / total if total else 0.0
+
+    def curvePoints(self):
+        """Return (reading, actual) points from the bins with enough
+        readings."""
+        return [(readings.mean, references.mean)
+                for readings, references in (self.bins[key] for key in sorted(self.bins))
+                if readings.count >= MIN_BIN_COUNT]
+
+
+def findSensors():
+    """Return the IDs of the DS18B20s in the w1 device directory."""
+    try:
+        devices = sorted(os.listdir(OneWireBus.W1_DEVICES))
+    except OSError:
+        return []
+    return [device for device in devices if device[:3] == "28-"]
+
+
+def report(sensors, reference):
     print()
+    print("%-16s %8s %6s %6s %7s %6s %12s %10s %8s %7s" % (
+        "Sensor", "mean", "sd", "noise", "offset", "sd", "conv ms", "read ms", "interval",
+        "failed"))
+    for sensor in sensors:
+        if sensor is reference:
+            offset = "ref"
+            offsetSD = ""
+        elif sensor.offsets.count:
+            offset = "%+.3f" % sensor.offsets.mean
+            offsetSD = "%.3f" % sensor.offsets.stdev()
+        else:
+            offset = offsetSD = "-"
+        print("%-16s %8.3f %6.3f %6.3f %7s %6s %5.0f/%-6.0f %4.1f/%-5.1f %8.3f %6.1f%%" % (
+            sensor.deviceID, sensor.readings.mean, sensor.readings.stdev(),
+            sensor.noise(), offset, offsetSD,
+            sensor.sampleTimes.mean * 1000, (sensor.sampleTimes.maximum or 0) * 1000,
+            sensor.readTimes.mean * 1000, (sensor.readTimes.maximum or 0) * 1000,
+            sensor.intervals.mean, sensor.failureRate() * 100))
+
+
+def writeCalibration(path, sensors, reference, curves):
+    """Write the offsets, or curves, of the sensors compared with the
+    reference into the calibration file at path."""
+    calibration = configparser.ConfigParser()
+    calibration.read(path)
+    if 'offset' not in calibration:
+        calibration['offset'] = {}
 
-try:
-    print("Starting threads for %s sensors." % len(sensors))
     for sensor in sensors:
-        print("Starting %s" % sensor.deviceID)
-        sensor.start()
+        if sensor is reference or sensor.offsets.count == 0:
+            continue
+        points = sensor.curvePoints() if curves else []
+        if len(points) >= 2:
+            calibration[sensor.deviceID] = {
+                'points': ', '.join("%.4f:%.4f" % point for point in points),
+                'offset': '0.0'}
+            calibration['offset'].pop(sensor.deviceID, None)
+            print("%s: curve of %s points" % (sensor.deviceID, len(points)))
+        else:
+            if curves:
+                print("%s: not enough temperatures for a curve" % sensor.deviceID)
+            calibration['offset'][sensor.deviceID] = "%.3f" % sensor.offsets.mean
+            calibration.remove_section(sensor.deviceID)
+            print("%s: offset %+.3f" % (sensor.deviceID, sensor.offsets.mean))
+
+    with open(path, 'w') as f:
+        calibration.write(f)
+    print("Wrote '%s'." % path)
+
 
-    while (True):
-        time.sleep(1)  # You can read the sensor as often as you like,
-        # but it only changes every samplePeriod seconds.
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--duration', type=float, default=60,
+                        help='seconds to sample for (Ctrl-C stops early)')
+    parser.add_argument('--reference', metavar='ID',
+                        help='sensor to compare the others with.  Its own '
+                             'calibration in calibrate.ini is used.')
+    parser.add_argument('--resolution', type=int, choices=sorted(DS18B20.CONVERSION_TIMES),
+                        help='set the resolution of every sensor, in bits')
+    parser.add_argument('--curve', type=float, nargs='?', const=1.0, default=None,
+                        metavar='BIN',
+                        help='fit curves with a point per BIN degrees (default 1.0)')
+    parser.add_argument('--write', nargs='?', const='calibrate.ini', default=None,
+                        metavar='FILE',
+                        help='write the calibration to FILE (default calibrate.ini)')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't print the readings as they are taken")
+    args = parser.parse_args()
+
+    deviceIDs = findSensors()
+    if not deviceIDs:
+        print("No sensors found in %s" % OneWireBus.W1_DEVICES)
+        sys.exit(1)
+    if args.reference and args.reference not in deviceIDs:
+        print("Reference sensor '%s' not found." % args.reference)
+        sys.exit(1)
+    if args.write and not args.reference:
+        print("A reference sensor is needed to write a calibration.")
+        sys.exit(1)
+
+    existing = configparser.ConfigParser()
+    existing.read(args.write or 'calibrate.ini')
+
+    sensors = []
+    reference = None
+    for deviceID in deviceIDs:
+        print("Found device: %s" % deviceID)
+        if deviceID == args.reference:
+            calibration = Calibration.fromConfig(existing, deviceID)
+            if calibration is None and 'offset' in existing:
+                calibration = Calibration.CalibrationCurve(
+                    offset=existing['offset'].getfloat(deviceID, 0.0))
+            sensor = TestSensor(deviceID, resolution=args.resolution, calibration=calibration)
+            reference = sensor
+        else:
+            sensor = TestSensor(deviceID, resolution=args.resolution)
+        sensors.append(sensor)
+    print("Found %s temperature sensors." % len(sensors))
+    print()
+
+    try:
+        print("Starting %s sensors." % len(sensors))
+        for sensor in sensors:
+            sensor.start()
+
+        print("Sampling for %s s.  Ctrl-C to stop." % args.duration)
+        end = time.monotonic() + args.duration
+        while time.monotonic() < end:
+            time.sleep(1)  # The sensors are read together every second.
+            for sensor in sensors:
+                for sampleTime, temperature in sensor.takeSamples():
+                    sensor.addSample(sampleTime, temperature)
+            if reference is not None:
+                for sensor in sensors:
+                    if sensor is not reference:
+                        sensor.addReference(reference, args.curve)
+            if not args.quiet:
+                print(datetime.datetime.utcnow().strftime('%H:%M:%S'),
+                      ' '.join("%7s" % ('%.3f' % sensor.temperature
+                                        if sensor.temperature is not None else 'None')
+                               for sensor in sensors))
+
+    except KeyboardInterrupt:
         print()
-        print("%s Ctrl-C to stop." % datetime.datetime.utcnow())
+        print("Ctrl-C detected.  Stopping.")
+
+    finally:
         for sensor in sensors:
-            print(sensor.deviceID, sensor.temperature)  # Result is float in degrees C,
-        # or None for error
+            sensor.stop()
+        for sensor in sensors:
+            sensor.join()
 
-except KeyboardInterrupt:
-    print()
-    print("Ctrl-C detected.  Stopping.")
+    report(sensors, reference)
 
-except:
-    print("Temperature sensor error:", sys.exc_info()[0])
-    raise
+    if args.write:
+        print()
+        writeCalibration(args.write, sensors, reference, args.curve)
 
-finally:
-    print("Stopping threads for %s sensors." % len(sensors))
-    for sensor in sensors:
-        print("Stopping %s." % sensor.deviceID)
-        sensor.stop()
-        print("Waiting for %s to finish." % sensor.deviceID)
-        sensor.join()
 
-print("Done.")
+if __name__ == "__main__":
+    main()
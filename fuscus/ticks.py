@@ -21,14 +21,118 @@
 #
 
 
+# The clock is time.monotonic(), so setting the system clock (NTP does
+# at boot) doesn't shorten or stretch the minimum on and off times or
+# the peak detect windows.  The times are only good for comparing with
+# each other, not as dates.
+#
+# Scheduler runs jobs at a fixed rate for a main loop that waits with
+# select().  Each run is scheduled from when the last one was due, not
+# when it ran, so the jobs don't drift.  A job which falls a whole
+# period or more behind either catches up, running once per pass of the
+# main loop until it is back on time, or skips the runs it missed.  How
+# late each run starts is kept, to see how steady the ticks are.
+
+import logging
 import time
 
+from RunningStats import RunningStats
+
+# What a job does when it falls a period or more behind
+CATCH_UP = 'catch up'
+SKIP = 'skip'
+
+_clock = time.monotonic
+
 
 def timeSince(t):
     """Return number of seconds since time t."""
-    return time.time() - t
+    return _clock() - t
 
 
 def seconds():
     """Return current time in seconds."""
-    return time.time()
+    return _clock()
+
+
+def setClock(clock):
+    """Use clock, a function returning seconds, instead of
+    time.monotonic().  None goes back to time.monotonic()."""
+    global _clock
+    _clock = clock or time.monotonic
+
+
+def getClock():
+    """Return the clock in use, as set by setClock()."""
+    return _clock
+
+
+class Job:
+    """A job run every period seconds by a Scheduler."""
+
+    def __init__(self, name, period, callback, nextRun, overrun):
+        self.name = name
+        self.period = period
+        self.callback = callback
+        self.nextRun = nextRun
+        self.overrun = overrun
+        self.runs = 0
+        self.skipped = 0
+        self.lateness = RunningStats()  # Seconds each run started late
+
+
+class Scheduler:
+    """Runs jobs at a fixed rate.  Call runDue(), then wait up to
+    timeout() seconds for anything else to do, and repeat."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def every(self, period, callback, name=None, start=None, overrun=SKIP):
+        """Run callback() every period seconds, first at start (now if
+        None).  overrun is CATCH_UP or SKIP.  Returns the Job."""
+        if overrun not in (CATCH_UP, SKIP):
+            raise ValueError("Overrun must be '%s' or '%s', not '%s'." % (CATCH_UP, SKIP, overrun))
+        job = Job(name or callback.__name__, period, callback,
+                  seconds() if start is None else start, overrun)
+        self.jobs.append(job)
+        return job
+
+    def nextDue(self):
+        """Return the time the next job is due, or None if there are no
+        jobs."""
+        return min((job.nextRun for job in self.jobs), default=None)
+
+    def timeout(self):
+        """Return how long to wait for the next job, in seconds, or None
+        to wait for ever."""
+        due = self.nextDue()
+        if due is None:
+            return None
+        return max(0.0, due - seconds())
+
+    def runDue(self):
+        """Run each job that is due, once.  Returns the number run."""
+        count = 0
+        for job in self.jobs:
+            now = seconds()
+            if now < job.nextRun:
+                continue
+            job.lateness.add(now - job.nextRun)
+            job.runs += 1
+            job.nextRun += job.period
+            if job.nextRun <= now and job.overrun == SKIP:
+                missed = int((now - job.nextRun) // job.period) + 1
+                job.skipped += missed
+                job.nextRun += missed * job.period
+                logging.debug("Job %s skipped %s runs", job.name, missed)
+            job.callback()
+            count += 1
+        return count
+
+    def report(self):
+        """Return a line for each job about how late its runs were."""
+        return ["%s: %s runs, %s skipped, late by %.1f ms mean, %.1f ms sd, %.1f ms worst" % (
+                    job.name, job.runs, job.skipped, job.lateness.mean * 1000,
+                    job.lateness.stdev() * 1000, (job.lateness.maximum or 0) * 1000)
+                for job in self.jobs]
@@ -94,8 +94,12 @@ def update():
 
 def ticks():
     # Do UI housekeeping
-    if (encoder.pushed):
+    # A short push may be over before we get here, so ask the encoder
+    # whether there was one rather than reading the button.
+    if (encoder.takePushed()):
         # rotaryEncoder.resetPushed();
         while encoder.pushed:  # Wait for button to be released
             pass
         menu.pickSettingToChange()
+        # The menu reads the button itself.  Forget the pushes it used.
+        encoder.clearEvents()